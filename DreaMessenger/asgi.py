@@ -2,6 +2,22 @@
 ASGI config for DreaMessenger project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+HTTP requests are handled by Django, WebSocket connections to the events endpoint
+are handled by ``messenger.websocket``.
+
+With ``ASYNC_VIEWS=True`` the read endpoints (dialogue and message lists, pictures, user suggestions
+and the events long poll) are served by ``messenger.async_views``, so a waiting request holds no thread.
+Their database work runs in a pool of ``ASYNC_DB_THREADS`` threads per worker process, which also bounds
+the database connections of a worker. The Procfile serves it with uvicorn, which starts
+``WEB_CONCURRENCY`` worker processes::
+
+    ASYNC_VIEWS=True ASYNC_DB_THREADS=10 uvicorn DreaMessenger.asgi:application --host 0.0.0.0 --port $PORT
+
+``ASYNC_VIEWS=False`` serves the sync views there as well, ``DreaMessenger.wsgi`` is still available for
+WSGI servers.
+Streaming responses, like the dialogue export, are iterated in the thread of their sync view
+by ``messenger.handlers.StreamingASGIHandler``, as they read the database while streaming.
+Compare both setups with ``python manage.py bench_concurrency``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
@@ -9,8 +25,22 @@ https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'DreaMessenger.settings')
 
-application = get_asgi_application()
+# The same as get_asgi_application() with the handler replaced
+django.setup(set_prefix=False)
+
+from messenger import websocket  # noqa: E402, Django has to be set up first
+from messenger.handlers import StreamingASGIHandler  # noqa: E402
+
+django_application = StreamingASGIHandler()
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'websocket':
+        if scope['path'] == websocket.EVENTS_PATH:
+            return await websocket.events_websocket(scope, receive, send)
+        return await websocket.reject_websocket(scope, receive, send)
+    return await django_application(scope, receive, send)
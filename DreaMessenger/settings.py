@@ -49,15 +49,17 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'messenger.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'messenger.replicas.ReplicaMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    'messenger.middleware.AsyncWhiteNoiseMiddleware',
 ]
 
 
@@ -115,6 +117,104 @@ elif db_name == 'postgresql':
 else:
     raise ValueError(f'Unknown database name: {db_name}')
 
+# Read replicas as comma separated database URLs, e.g. sqlite:////path/to/db.replica.sqlite3 for a copy of
+# the SQLite database. Dialogue list, message history, picture and user suggestion reads go to them,
+# see messenger.replicas.
+# Users who wrote read from the primary for REPLICA_STICKY_SECONDS, which should exceed the replication lag.
+# The sticky window is kept in the cache, so replicas need REDIS_URL, the application fails to start without it.
+
+DATABASE_REPLICAS = []
+for index, url in enumerate(parse_urls(os.getenv('DATABASE_REPLICA_URLS')), start=1):
+    DATABASES[f'replica{index}'] = dict(dj_database_url.parse(url), TEST={'MIRROR': 'default'})
+    DATABASE_REPLICAS.append(f'replica{index}')
+
+DATABASE_ROUTERS = ['messenger.replicas.ReplicaRouter']
+REPLICA_STICKY_SECONDS = int(os.getenv('REPLICA_STICKY_SECONDS', 5))
+
+# Picture storage: 'database' keeps bytes in PictureV2.data, 'filesystem' keeps them under PICTURE_STORAGE_ROOT
+
+PICTURE_STORAGE = os.getenv('PICTURE_STORAGE', 'database')
+PICTURE_STORAGE_ROOT = os.getenv('PICTURE_STORAGE_ROOT', os.path.join(BASE_DIR, 'pictures'))
+
+# Downscaled copies generated for every uploaded picture, selectable with PictureView ?size=
+PICTURE_RENDITION_SIZES = (64, 256, 1024)
+
+# Uploaded images are decoded and re-encoded in a process pool, 0 workers processes them inline.
+# Uploads beyond IMAGE_POOL_QUEUE_SIZE waiting tasks are rejected with 503.
+IMAGE_POOL_WORKERS = int(os.getenv('IMAGE_POOL_WORKERS', 2))
+IMAGE_POOL_QUEUE_SIZE = int(os.getenv('IMAGE_POOL_QUEUE_SIZE', 8))
+IMAGE_POOL_TIMEOUT_SECONDS = int(os.getenv('IMAGE_POOL_TIMEOUT_SECONDS', 30))
+
+# Uploaded files over PICTURE_UPLOAD_MAX_BYTES are rejected with 413 while they are being received.
+# Images over PICTURE_MAX_PIXELS are rejected from their header, before decoding.
+# Originals are stored at full resolution. Setting PICTURE_MAX_DIMENSION downscales them to that size on
+# the longer side, JPEGs are decoded at a reduced scale for that; the full resolution is lost then.
+PICTURE_UPLOAD_MAX_BYTES = int(os.getenv('PICTURE_UPLOAD_MAX_BYTES', 20 * 1024 * 1024))
+PICTURE_MAX_PIXELS = int(os.getenv('PICTURE_MAX_PIXELS', 50_000_000))
+PICTURE_MAX_DIMENSION = int(os.getenv('PICTURE_MAX_DIMENSION', 0))
+
+MESSAGE_BATCH_MAX_PICTURES = int(os.getenv('MESSAGE_BATCH_MAX_PICTURES', 20))
+
+USER_BULK_LOOKUP_MAX = int(os.getenv('USER_BULK_LOOKUP_MAX', 300))
+
+# Delta sync scans again this far back before the previous sync, so that rows committed late are not missed.
+# It has to be longer than the longest write transaction plus the clock difference between servers.
+SYNC_OVERLAP_SECONDS = int(os.getenv('SYNC_OVERLAP_SECONDS', 30))
+
+# Messages older than this are moved to the archive table by the archive_messages command, run it periodically
+MESSAGE_ARCHIVE_AFTER_DAYS = int(os.getenv('MESSAGE_ARCHIVE_AFTER_DAYS', 180))
+
+# Real-time events, see messenger.events. InMemoryBroker only reaches clients of its own process,
+# with REDIS_URL worker processes share events through the cache with CacheBroker.
+EVENTS_BROKER = os.getenv('EVENTS_BROKER', 'messenger.events.CacheBroker' if os.getenv('REDIS_URL')
+                          else 'messenger.events.InMemoryBroker')
+EVENTS_CACHE_TIMEOUT_SECONDS = int(os.getenv('EVENTS_CACHE_TIMEOUT_SECONDS', 60))
+EVENTS_BUFFER_SIZE = int(os.getenv('EVENTS_BUFFER_SIZE', 100))
+EVENTS_LONG_POLL_TIMEOUT_SECONDS = int(os.getenv('EVENTS_LONG_POLL_TIMEOUT_SECONDS', 25))
+# A waiting sync poll holds a whole WSGI worker, so without ASYNC_VIEWS clients poll again after this instead.
+# Long polling needs the ASGI deployment, see DreaMessenger.asgi.
+EVENTS_SYNC_POLL_TIMEOUT_SECONDS = int(os.getenv('EVENTS_SYNC_POLL_TIMEOUT_SECONDS', 1))
+
+# Cache, local memory by default and Redis when REDIS_URL is set
+
+if os.getenv('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv('REDIS_URL'),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+PROFILE_CACHE_TIMEOUT_SECONDS = int(os.getenv('PROFILE_CACHE_TIMEOUT_SECONDS', 3600))
+
+# Authenticated users are resolved through the cache for this long, 0 disables the user cache
+AUTH_USER_CACHE_TIMEOUT_SECONDS = int(os.getenv('AUTH_USER_CACHE_TIMEOUT_SECONDS', 30))
+
+AUTHENTICATION_BACKENDS = [
+    'messenger.authentication.CachedModelBackend',
+    'django.contrib.auth.backends.ModelBackend',
+]
+
+# 'django.contrib.sessions.backends.cached_db' keeps sessions in the cache as well
+SESSION_ENGINE = os.getenv('SESSION_ENGINE', 'django.contrib.sessions.backends.db')
+
+# Serve read endpoints with async views, for deployments running DreaMessenger.asgi, see its docstring.
+# Their database work runs in a pool of ASYNC_DB_THREADS threads, which bounds database connections per process.
+ASYNC_VIEWS = (os.getenv('ASYNC_VIEWS') == 'True')
+ASYNC_DB_THREADS = int(os.getenv('ASYNC_DB_THREADS', 10))
+
+# Per-request metrics exposed at api/v1/metrics/ to staff, or with METRICS_TOKEN when it is set.
+# METRICS_SERVER_TIMING also sends the timings of every request in the Server-Timing header.
+METRICS_ENABLED = (os.getenv('METRICS_ENABLED', 'True') == 'True')
+METRICS_SERVER_TIMING = (os.getenv('METRICS_SERVER_TIMING') == 'True')
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
 
@@ -156,12 +256,17 @@ LOGGING = {
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'messenger.authentication.CachedJWTAuthentication',
         'rest_framework.authentication.SessionAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
+    # Uses orjson when it is installed
+    'DEFAULT_RENDERER_CLASSES': [
+        'messenger.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
 }
 
 # Internationalization
@@ -4,5 +4,8 @@ from messenger import models
 
 admin.site.register(models.Dialogue)
 admin.site.register(models.Message)
+admin.site.register(models.ArchivedMessage)
 admin.site.register(models.PictureV2)
+admin.site.register(models.PictureRendition)
 admin.site.register(models.UserInfo)
+admin.site.register(models.DialogueReadState)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class MessengerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'messenger'
+
+    def ready(self):
+        from messenger import events, signals  # noqa: F401
+        events.check_broker()
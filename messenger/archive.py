@@ -0,0 +1,115 @@
+"""
+Messages older than ``MESSAGE_ARCHIVE_AFTER_DAYS`` are moved from ``Message`` to ``ArchivedMessage``
+by the ``archive_messages`` command, so that the hot table and its indexes only hold recent messages.
+Message history reads both tables through ``MessageHistory``.
+"""
+import datetime
+
+from django.db import transaction
+from django.utils import timezone
+
+from messenger import models
+
+ARCHIVED_FIELDS = ('id', 'dialogue_id', 'from_user_id', 'picture_id', 'is_edited', 'edited_at', 'created_at')
+
+
+def get_union_field(field):
+    # The union is ordered by its columns, where the primary key is only known as id
+    if field.lstrip('-') == 'pk':
+        return field.replace('pk', 'id')
+    return field
+
+
+class MessageHistory:
+    """
+    Queryset-like pair of hot and archived message querysets for the pagination classes, yielding ``fields`` rows.
+    Filters apply to both, counts and slices run as a single ``UNION ALL`` query over them.
+    """
+    ordered = True
+
+    def __init__(self, hot, archived, fields, ordering=()):
+        self.hot = hot
+        self.archived = archived
+        self.fields = fields
+        self.ordering = ordering
+
+    def filter(self, *args, **kwargs):
+        return MessageHistory(self.hot.filter(*args, **kwargs), self.archived.filter(*args, **kwargs),
+                              self.fields, self.ordering)
+
+    def exclude(self, *args, **kwargs):
+        return MessageHistory(self.hot.exclude(*args, **kwargs), self.archived.exclude(*args, **kwargs),
+                              self.fields, self.ordering)
+
+    def order_by(self, *fields):
+        return MessageHistory(self.hot, self.archived, self.fields, fields)
+
+    def get_union(self, fields):
+        # Not every database allows ordering the parts of a union, so only the union is ordered
+        return self.hot.values(*fields).order_by().union(self.archived.values(*fields).order_by(), all=True)
+
+    def count(self):
+        # Without the joins of the row fields
+        return self.get_union(['id']).count()
+
+    def get_ordered_union(self):
+        return self.get_union(self.fields).order_by(*(get_union_field(field) for field in self.ordering))
+
+    def __getitem__(self, key):
+        return self.get_ordered_union()[key]
+
+    def __iter__(self):
+        return iter(self.get_ordered_union())
+
+    def iterator(self, chunk_size=2000):
+        return self.get_ordered_union().iterator(chunk_size)
+
+
+def get_archivable_messages(cutoff):
+    """
+    Messages created before ``cutoff``, except the last messages of dialogues and read markers,
+    which other tables reference.
+    """
+    return models.Message.objects \
+        .filter(created_at__lt=cutoff) \
+        .exclude(id__in=models.Dialogue.objects.filter(last_message__isnull=False).values('last_message_id')) \
+        .exclude(id__in=models.DialogueReadState.objects.filter(last_read_message__isnull=False)
+                 .values('last_read_message_id'))
+
+
+def select_batch(cutoff, batch_size):
+    return list(get_archivable_messages(cutoff).order_by('created_at', 'id')
+                .select_for_update().values(*ARCHIVED_FIELDS)[:batch_size])
+
+
+def archive_batch(cutoff, batch_size):
+    """
+    Moves up to ``batch_size`` of the oldest archivable messages in one transaction, returns how many were moved.
+    """
+    with transaction.atomic():
+        rows = select_batch(cutoff, batch_size)
+        # Messages may have become read markers while their locks were awaited. Once locked they can't,
+        # as ``read_states.mark_read`` locks the message it moves a marker to.
+        archivable_ids = set(get_archivable_messages(cutoff).filter(id__in=[row['id'] for row in rows])
+                             .values_list('id', flat=True))
+        rows = [row for row in rows if row['id'] in archivable_ids]
+        if not rows:
+            return 0
+        models.ArchivedMessage.objects.bulk_create([models.ArchivedMessage(**row) for row in rows])
+        models.Message.objects.filter(id__in=[row['id'] for row in rows]).delete()
+    return len(rows)
+
+
+def archive_messages(days, batch_size, on_batch=None):
+    """
+    Archives messages older than ``days`` in batches, each one committed separately so that locks are short.
+    """
+    cutoff = timezone.now() - datetime.timedelta(days=days)
+    total = 0
+    while True:
+        moved = archive_batch(cutoff, batch_size)
+        if not moved:
+            return total
+        total += moved
+        if on_batch is not None:
+            on_batch(total)
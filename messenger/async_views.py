@@ -0,0 +1,124 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections
+from rest_framework.views import APIView
+
+from messenger import events, metrics, views
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# The request an async view is serving, and the last one each pool thread ran database work for
+_current_request = contextvars.ContextVar('messenger_async_request', default=None)
+_thread_state = threading.local()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers=settings.ASYNC_DB_THREADS,
+                                                              thread_name_prefix='messenger-db')
+        return _executor
+
+
+def database_sync_to_async(func):
+    """
+    Django 4.0 has no async ORM, so database work of async views runs in a pool of
+    ``ASYNC_DB_THREADS`` threads. Unlike ``sync_to_async``, which gives every request its own thread,
+    the pool bounds the number of threads and database connections however many requests are waiting.
+    Outdated connections are closed once per request in each thread, before its first call there,
+    as a sync request does when it starts.
+    """
+
+    def run(*args, **kwargs):
+        request = _current_request.get()
+        if request is None or getattr(_thread_state, 'request', None) is not request:
+            close_old_connections()
+            _thread_state.request = request
+        with metrics.capture_queries():
+            return func(*args, **kwargs)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            _get_executor(), functools.partial(context.run, run, *args, **kwargs))
+
+    return wrapper
+
+
+class AsyncAPIView(APIView):
+    """
+    ``APIView`` with an async ``dispatch``, served by Django's async request path under ASGI.
+    Authentication, permissions and sync handlers run in ``database_sync_to_async``,
+    coroutine handlers run on the event loop.
+    """
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        # Django 4.0 only recognizes async views by this marker, 4.1 sets it for async handlers itself
+        view._is_coroutine = asyncio.coroutines._is_coroutine
+        return view
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+        # A new object per request, the thread state must not keep requests alive
+        token = _current_request.set(object())
+
+        try:
+            await database_sync_to_async(self.initial)(request, *args, **kwargs)
+
+            handler = None
+            if request.method.lower() in self.http_method_names:
+                handler = getattr(self, request.method.lower(), None)
+            if handler is None:
+                self.http_method_not_allowed(request, *args, **kwargs)
+            elif asyncio.iscoroutinefunction(handler):
+                response = await handler(request, *args, **kwargs)
+            else:
+                response = await database_sync_to_async(handler)(request, *args, **kwargs)
+        except Exception as exc:
+            response = self.handle_exception(exc)
+        finally:
+            _current_request.reset(token)
+
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+
+
+class AsyncMyDialoguesView(AsyncAPIView, views.MyDialoguesView):
+    pass
+
+
+class AsyncMessagesByDialogueView(AsyncAPIView, views.MessagesByDialogueView):
+    pass
+
+
+class AsyncPictureView(AsyncAPIView, views.PictureView):
+    pass
+
+
+class AsyncUserSuggestView(AsyncAPIView, views.UserSuggestView):
+    pass
+
+
+class AsyncEventsPollView(AsyncAPIView, views.EventsPollView):
+    """
+    Waits for events on the event loop, so a waiting client holds no thread.
+    """
+
+    async def get(self, request):
+        pending, cursor = await events.get_broker().wait_async(request.user.id, self.get_since(request),
+                                                               settings.EVENTS_LONG_POLL_TIMEOUT_SECONDS)
+        return self.create_response(pending, cursor)
@@ -0,0 +1,88 @@
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+
+# Fields of cached users, everything but the password hash
+CACHED_USER_FIELDS = ('id', 'username', 'first_name', 'last_name', 'email', 'is_active', 'is_staff', 'is_superuser',
+                      'last_login', 'date_joined')
+
+
+def get_cache_key(user_id):
+    return f'messenger:auth-user:{user_id}'
+
+
+def dump_user(user):
+    return {
+        'fields': {name: getattr(user, name) for name in CACHED_USER_FIELDS},
+        # Sessions are verified against this hash of the password, see django.contrib.auth.get_user
+        'session_auth_hash': user.get_session_auth_hash(),
+    }
+
+
+def load_user(entry):
+    fields = entry['fields']
+    # The password is deferred, reading it loads it from the database
+    names = [field.attname for field in User._meta.concrete_fields if field.attname in fields]
+    user = User.from_db(DEFAULT_DB_ALIAS, names, [fields[name] for name in names])
+    session_auth_hash = entry['session_auth_hash']
+    user.get_session_auth_hash = lambda: session_auth_hash
+    return user
+
+
+def get_cached_user(user_id):
+    """
+    Loads a user by id through a short-lived cache, returns None for unknown users.
+    Entries are dropped on every user change and on logout (see ``messenger.signals``),
+    ``AUTH_USER_CACHE_TIMEOUT_SECONDS`` bounds staleness for caches that are not shared between workers.
+    """
+    timeout = settings.AUTH_USER_CACHE_TIMEOUT_SECONDS
+    if timeout <= 0:
+        return User.objects.filter(pk=user_id).first()
+
+    key = get_cache_key(user_id)
+    entry = cache.get(key)
+    if entry is not None:
+        return load_user(entry)
+    user = User.objects.filter(pk=user_id).first()
+    if user is not None:
+        cache.set(key, dump_user(user), timeout)
+    return user
+
+
+def invalidate_cached_user(user_id):
+    cache.delete(get_cache_key(user_id))
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+
+        user = get_cached_user(user_id)
+        if user is None:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+
+        if not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+
+        return user
+
+
+class CachedModelBackend(ModelBackend):
+    """
+    Resolves session users through the user cache. Sessions created by the plain ``ModelBackend``
+    keep working through it until the next login.
+    """
+
+    def get_user(self, user_id):
+        user = get_cached_user(user_id)
+        return user if user is not None and self.user_can_authenticate(user) else None
@@ -0,0 +1,29 @@
+import statistics
+import time
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(int(round(fraction * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def summarize(durations):
+    return {
+        'count': len(durations),
+        'mean_ms': statistics.mean(durations) * 1000 if durations else 0.0,
+        'p50_ms': percentile(durations, 0.5) * 1000,
+        'p95_ms': percentile(durations, 0.95) * 1000,
+        'p99_ms': percentile(durations, 0.99) * 1000,
+    }
+
+
+def measure(func, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return summarize(durations)
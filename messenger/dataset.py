@@ -0,0 +1,168 @@
+import hashlib
+import io
+import random
+import uuid
+
+import PIL.Image
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+
+from messenger import models, storage
+
+PASSWORD = 'dataset-password'
+USERNAME_PREFIX = 'dataset-user'
+BATCH_SIZE = 1000
+
+SYLLABLES = ('an', 'bel', 'cor', 'da', 'el', 'fin', 'gor', 'ha', 'is', 'jor', 'ka', 'lin',
+             'mar', 'nor', 'ol', 'pet', 'ra', 'sel', 'tin', 'ul', 'vik', 'yan', 'zo')
+
+
+def parse_members_distribution(value):
+    """
+    Parses ``"2:80,3-8:15,9-50:5"`` into ``[((2, 2), 80), ((3, 8), 15), ((9, 50), 5)]``:
+    the dialogue size is drawn from a range with probability proportional to its weight.
+    """
+    distribution = []
+    for item in value.split(','):
+        sizes, weight = item.split(':')
+        low, _, high = sizes.partition('-')
+        low, high = int(low), int(high or low)
+        if low < 2 or high < low:
+            raise ValueError(f'Invalid dialogue size range: {sizes}')
+        distribution.append(((low, high), float(weight)))
+    return distribution
+
+
+def generate_name(rng, syllables):
+    return ''.join(rng.choice(SYLLABLES) for _ in range(syllables))
+
+
+def generate_picture_data(rng, size=16):
+    image = PIL.Image.frombytes('RGB', (size, size), bytes(rng.getrandbits(8) for _ in range(size * size * 3)))
+    file = io.BytesIO()
+    image.save(file, format='JPEG')
+    return file.getvalue()
+
+
+def create_pictures(rng, count):
+    picture_storage = storage.get_storage()
+    pictures = {}
+    while len(pictures) < count:
+        data = generate_picture_data(rng)
+        sha256 = hashlib.sha256(data).hexdigest()
+        if sha256 not in pictures:
+            pictures[sha256] = models.PictureV2(uuid=uuid.UUID(int=rng.getrandbits(128), version=4), sha256=sha256,
+                                                storage=picture_storage.name, **picture_storage.save(sha256, data))
+    return models.PictureV2.objects.bulk_create(pictures.values(), batch_size=BATCH_SIZE)
+
+
+def create_users(rng, count, pictures):
+    password = make_password(PASSWORD)
+    users = [
+        User(username=f'{USERNAME_PREFIX}{index}', password=password,
+             first_name=generate_name(rng, 2).capitalize(), last_name=generate_name(rng, 3).capitalize())
+        for index in range(count)
+    ]
+    avatars = [rng.choice(pictures) if pictures and rng.random() < 0.8 else None for _ in users]
+    User.objects.bulk_create(users, batch_size=BATCH_SIZE)
+
+    users = list(User.objects.filter(username__startswith=USERNAME_PREFIX).order_by('id'))
+    models.UserInfo.objects.bulk_create([
+        models.UserInfo(user=user, avatar=avatar) for user, avatar in zip(users, avatars)
+    ], batch_size=BATCH_SIZE)
+    return users
+
+
+def choose_members(rng, users, distribution):
+    (low, high), = rng.choices([sizes for sizes, _ in distribution], weights=[weight for _, weight in distribution])
+    return rng.sample(users, min(rng.randint(low, high), len(users)))
+
+
+def create_dialogues(rng, count, users, distribution):
+    dialogues = []
+    members = []
+    pairs = set()
+    for _ in range(count):
+        dialogue_members = choose_members(rng, users, distribution)
+        dialogue = models.Dialogue()
+        if len(dialogue_members) == 2:
+            pair_key = models.Dialogue.pair_key(*dialogue_members)
+            pair = tuple(pair_key.values())
+            # Every pair gets a single tete-a-tete, repeated pairs become group dialogues of two
+            if pair not in pairs:
+                pairs.add(pair)
+                dialogue = models.Dialogue(is_tetatet=True, **pair_key)
+        dialogues.append(dialogue)
+        members.append(dialogue_members)
+    models.Dialogue.objects.bulk_create(dialogues, batch_size=BATCH_SIZE)
+
+    dialogues = list(models.Dialogue.objects.order_by('-id')[:count])[::-1]
+    through = models.Dialogue.users.through
+    through.objects.bulk_create([
+        through(dialogue_id=dialogue.id, user_id=user.id)
+        for dialogue, dialogue_members in zip(dialogues, members)
+        for user in dialogue_members
+    ], batch_size=BATCH_SIZE)
+    return list(zip(dialogues, members))
+
+
+def create_messages(rng, count, dialogues, pictures):
+    if not dialogues:
+        return
+    # Activity is heavy-tailed: a few dialogues get most of the messages
+    weights = [rng.paretovariate(1.2) for _ in dialogues]
+    messages = []
+    for dialogue, dialogue_members in rng.choices(dialogues, weights=weights, k=count):
+        messages.append(models.Message(dialogue=dialogue, from_user=rng.choice(dialogue_members),
+                                       picture=rng.choice(pictures) if pictures else None))
+    models.Message.objects.bulk_create(messages, batch_size=BATCH_SIZE)
+
+
+def create_read_states(rng, dialogues):
+    dialogue_ids = [dialogue.id for dialogue, _ in dialogues]
+    messages_by_dialogue = {dialogue_id: [] for dialogue_id in dialogue_ids}
+    for dialogue_id, message_id, from_user_id in models.Message.objects \
+            .filter(dialogue_id__in=dialogue_ids) \
+            .order_by('created_at', 'id') \
+            .values_list('dialogue_id', 'id', 'from_user_id') \
+            .iterator():
+        messages_by_dialogue[dialogue_id].append((message_id, from_user_id))
+
+    read_states = []
+    for dialogue, dialogue_members in dialogues:
+        messages = messages_by_dialogue[dialogue.id]
+        for user in dialogue_members:
+            unread = messages[len(messages) - rng.randint(0, min(len(messages), 20)):] if messages else []
+            last_read = messages[len(messages) - len(unread) - 1][0] if len(unread) < len(messages) else None
+            read_states.append(models.DialogueReadState(
+                user=user, dialogue=dialogue, last_read_message_id=last_read,
+                unread_count=sum(1 for _, from_user_id in unread if from_user_id != user.id),
+            ))
+        if messages:
+            dialogue.last_message_id = messages[-1][0]
+    models.DialogueReadState.objects.bulk_create(read_states, batch_size=BATCH_SIZE)
+    models.Dialogue.objects.bulk_update([dialogue for dialogue, _ in dialogues], ['last_message'],
+                                        batch_size=BATCH_SIZE)
+
+
+def generate(users, dialogues, messages, pictures, members_distribution, seed=0):
+    """
+    Fills the database with synthetic users, dialogues, messages and deduplicated pictures.
+    The same arguments always produce the same data, except for ids and timestamps.
+    Generated users are named ``<USERNAME_PREFIX><index>`` and share the ``PASSWORD``.
+    """
+    rng = random.Random(seed)
+    distribution = parse_members_distribution(members_distribution)
+
+    created_pictures = create_pictures(rng, pictures)
+    created_users = create_users(rng, users, created_pictures)
+    created_dialogues = create_dialogues(rng, dialogues, created_users, distribution)
+    create_messages(rng, messages, created_dialogues, created_pictures)
+    create_read_states(rng, created_dialogues)
+
+    return {
+        'users': len(created_users),
+        'dialogues': len(created_dialogues),
+        'messages': messages if created_dialogues else 0,
+        'pictures': len(created_pictures),
+    }
@@ -0,0 +1,218 @@
+import asyncio
+import collections
+import logging
+import os
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+from rest_framework.fields import DateTimeField
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_NEW = 'message.new'
+DIALOGUE_UPDATED = 'dialogue.updated'
+DIALOGUE_READ = 'dialogue.read'
+
+CURSOR_KEY = 'messenger:events:cursor'
+# How often every process checks the cache for new events, and how many it reads at a time
+FOLLOW_INTERVAL_SECONDS = 0.1
+FOLLOW_BATCH_SIZE = 1000
+# A publisher stores its event right after taking a cursor, an event missing for longer is skipped
+PUBLISH_GRACE_SECONDS = 1.0
+
+
+class Broker:
+    """
+    Delivers events to users. Every event gets a cursor, which is increasing for a user,
+    so that a client can ask for everything published after the last cursor it has seen.
+    """
+
+    def publish(self, user_ids, event):
+        raise NotImplementedError()
+
+    def get_cursor(self):
+        """
+        Returns the cursor of the latest published event.
+        """
+        raise NotImplementedError()
+
+    def wait(self, user_id, since, timeout):
+        """
+        Blocks until there are events for ``user_id`` after the ``since`` cursor or ``timeout`` expires.
+        ``since=None`` means "from now on". Returns a list of events and a cursor to pass next time.
+        """
+        raise NotImplementedError()
+
+    async def wait_async(self, user_id, since, timeout):
+        return await sync_to_async(self.wait, thread_sensitive=False)(user_id, since, timeout)
+
+
+class InMemoryBroker(Broker):
+    """
+    Keeps the last ``EVENTS_BUFFER_SIZE`` events of every user in process memory.
+    Only suitable for a single process, e.g. tests and development.
+    """
+
+    def __init__(self):
+        self.buffer_size = settings.EVENTS_BUFFER_SIZE
+        self.condition = threading.Condition()
+        self.cursor = 0
+        self.events = collections.defaultdict(lambda: collections.deque(maxlen=self.buffer_size))
+        self.listeners = collections.defaultdict(set)
+
+    def publish(self, user_ids, event):
+        with self.condition:
+            self._deliver(self.cursor + 1, user_ids, event)
+
+    def _deliver(self, cursor, user_ids, event):
+        # Called with the condition held
+        self.cursor = cursor
+        for user_id in user_ids:
+            self.events[user_id].append((cursor, event))
+            for loop, listener in self.listeners[user_id]:
+                loop.call_soon_threadsafe(listener.set)
+        self.condition.notify_all()
+
+    def get_cursor(self):
+        with self.condition:
+            return self.cursor
+
+    def _collect(self, user_id, since):
+        return [dict(event, cursor=cursor) for cursor, event in self.events.get(user_id, ()) if cursor > since]
+
+    def wait(self, user_id, since, timeout):
+        with self.condition:
+            if since is None:
+                since = self.cursor
+            self.condition.wait_for(lambda: self._collect(user_id, since), timeout)
+            return self._collect(user_id, since), self.cursor
+
+    async def wait_async(self, user_id, since, timeout):
+        listener = (asyncio.get_running_loop(), asyncio.Event())
+        with self.condition:
+            if since is None:
+                since = self.cursor
+            pending = self._collect(user_id, since)
+            if not pending:
+                self.listeners[user_id].add(listener)
+        if not pending:
+            try:
+                await asyncio.wait_for(listener[1].wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self.condition:
+                    self.listeners[user_id].discard(listener)
+        with self.condition:
+            return self._collect(user_id, since), self.cursor
+
+
+def get_event_key(cursor):
+    return f'messenger:events:{cursor}'
+
+
+class CacheBroker(InMemoryBroker):
+    """
+    Shares events between worker processes through the default cache, which all of them have to use (Redis).
+    Every event is stored under its own cursor for ``EVENTS_CACHE_TIMEOUT_SECONDS``. A thread of every process
+    follows the cursor and passes new events on to the requests of the process waiting for them.
+    """
+
+    def __init__(self):
+        if isinstance(caches['default'], (LocMemCache, DummyCache)):
+            raise ImproperlyConfigured('CacheBroker needs a cache shared by all workers, set REDIS_URL')
+        super().__init__()
+        # Events published before the process started are not delivered
+        self.cursor = cache.get(CURSOR_KEY, 0)
+        self.missing_since = None
+        self.stopped = threading.Event()
+        threading.Thread(target=self.follow, name='messenger-events', daemon=True).start()
+
+    def publish(self, user_ids, event):
+        cache.add(CURSOR_KEY, 0, timeout=None)
+        cursor = cache.incr(CURSOR_KEY)
+        cache.set(get_event_key(cursor), (list(user_ids), event), settings.EVENTS_CACHE_TIMEOUT_SECONDS)
+
+    def follow(self):
+        while not self.stopped.wait(FOLLOW_INTERVAL_SECONDS):
+            try:
+                self.receive()
+            except Exception:
+                logger.exception('Failed to receive events from the cache')
+
+    def receive(self):
+        latest = min(cache.get(CURSOR_KEY, 0), self.cursor + FOLLOW_BATCH_SIZE)
+        if latest <= self.cursor:
+            return
+        keys = {get_event_key(cursor): cursor for cursor in range(self.cursor + 1, latest + 1)}
+        stored = cache.get_many(list(keys))
+        with self.condition:
+            for key, cursor in keys.items():
+                if key in stored:
+                    self._deliver(cursor, *stored[key])
+                else:
+                    if self.missing_since is None:
+                        self.missing_since = time.monotonic()
+                    if time.monotonic() - self.missing_since < PUBLISH_GRACE_SECONDS:
+                        break
+                    # Expired or never stored, as its publisher failed
+                    self.cursor = cursor
+                self.missing_since = None
+
+    def close(self):
+        self.stopped.set()
+
+
+def check_broker():
+    """
+    Warns at startup when events published by one worker process can't reach clients of the others.
+    """
+    workers = int(os.getenv('WEB_CONCURRENCY', 1))
+    if workers > 1 and import_string(settings.EVENTS_BROKER) is InMemoryBroker:
+        logger.warning('InMemoryBroker only delivers events to clients of the process that published them, '
+                       'but WEB_CONCURRENCY=%d, set REDIS_URL to share events through the cache', workers)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            _broker = import_string(settings.EVENTS_BROKER)()
+        return _broker
+
+
+def publish_message_events(messages, user_ids):
+    timestamp_field = DateTimeField()
+    for message in messages:
+        get_broker().publish(user_ids, {
+            'type': MESSAGE_NEW,
+            'dialogue': message.dialogue_id,
+            'message': message.id,
+            'from_user': message.from_user.username if message.from_user is not None else None,
+            'created_at': timestamp_field.to_representation(message.created_at),
+        })
+    get_broker().publish(user_ids, {
+        'type': DIALOGUE_UPDATED,
+        'dialogue': messages[-1].dialogue_id,
+        'updated_at': timestamp_field.to_representation(messages[-1].dialogue.updated_at),
+    })
+
+
+def publish_read_event(read_state):
+    get_broker().publish([read_state.user_id], {
+        'type': DIALOGUE_READ,
+        'dialogue': read_state.dialogue_id,
+        'last_read_message': read_state.last_read_message_id,
+        'unread_count': read_state.unread_count,
+    })
@@ -0,0 +1,101 @@
+"""
+Dialogue export: a ZIP archive with ``manifest.json``, holding the dialogue and its messages,
+and every picture of the dialogue once under ``pictures/``. The archive is yielded while it is written,
+messages and pictures are read with ``iterator()``, so memory does not grow with the dialogue size
+apart from the ZIP central directory, which keeps a small record per picture.
+"""
+import json
+import zipfile
+
+from django.db.models import Q
+from django.utils import timezone
+
+from messenger import archive, models, storage
+
+CHUNK_SIZE = 500
+MESSAGE_FIELDS = ('id', 'from_user__username', 'picture_id', 'is_edited', 'edited_at', 'created_at')
+
+
+class StreamBuffer:
+    """
+    Write-only file for ``zipfile.ZipFile``, which writes data descriptors to files it can't seek in.
+    Written bytes are taken out by the generator after every entry or batch of messages.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def get_picture_path(picture_uuid):
+    return f'pictures/{picture_uuid}.jpg'
+
+
+def format_datetime(value):
+    return value.isoformat() if value is not None else None
+
+
+def build_message(row):
+    return {
+        'id': row['id'],
+        'from_user': row['from_user__username'],
+        'picture': get_picture_path(row['picture_id']) if row['picture_id'] is not None else None,
+        'is_edited': bool(row['is_edited']),
+        'edited_at': format_datetime(row['edited_at']),
+        'created_at': format_datetime(row['created_at']),
+    }
+
+
+def create_entry(name, date_time, compress_type):
+    info = zipfile.ZipInfo(name, date_time=date_time)
+    info.compress_type = compress_type
+    return info
+
+
+def generate_export(dialogue):
+    hot = models.Message.objects.filter(dialogue=dialogue)
+    archived = models.ArchivedMessage.objects.filter(dialogue=dialogue)
+    messages = archive.MessageHistory(hot, archived, MESSAGE_FIELDS).order_by('created_at', 'id')
+    pictures = models.PictureV2.objects \
+        .filter(Q(uuid__in=hot.values('picture_id')) | Q(uuid__in=archived.values('picture_id'))) \
+        .defer('data') \
+        .order_by('uuid')
+
+    # Shared by all entries, which stay in memory until the central directory is written
+    date_time = timezone.now().timetuple()[:6]
+    buffer = StreamBuffer()
+    with zipfile.ZipFile(buffer, 'w') as export:
+        with export.open(create_entry('manifest.json', date_time, zipfile.ZIP_DEFLATED), 'w',
+                         force_zip64=True) as manifest:
+            header = {
+                'id': dialogue.id,
+                'is_tetatet': dialogue.is_tetatet,
+                'users': list(dialogue.users.order_by('username').values('username', 'first_name', 'last_name')),
+                'exported_at': format_datetime(timezone.now()),
+            }
+            manifest.write(f'{{"dialogue": {json.dumps(header)}, "messages": ['.encode())
+            for index, row in enumerate(messages.iterator(CHUNK_SIZE)):
+                manifest.write(((', ' if index else '') + json.dumps(build_message(row))).encode())
+                if index % CHUNK_SIZE == CHUNK_SIZE - 1:
+                    yield buffer.take()
+            manifest.write(b']}')
+        yield buffer.take()
+
+        for picture in pictures.iterator(CHUNK_SIZE):
+            # Pictures are JPEG already, so they are stored as they are
+            path = get_picture_path(picture.uuid)
+            with export.open(create_entry(path, date_time, zipfile.ZIP_STORED), 'w') as file:
+                file.write(storage.read_picture(picture))
+            yield buffer.take()
+    yield buffer.take()
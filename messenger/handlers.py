@@ -0,0 +1,58 @@
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIHandler
+
+# Bytes of a streaming response read per switch to the request thread
+STREAMING_READ_SIZE = 64 * 1024
+
+
+def read_parts(iterator, size):
+    """
+    Returns the next parts of a response iterator, at least ``size`` bytes of them unless it ends.
+    """
+    parts = []
+    length = 0
+    for part in iterator:
+        parts.append(part)
+        length += len(part)
+        if length >= size:
+            break
+    return parts
+
+
+class StreamingASGIHandler(ASGIHandler):
+    """
+    Django 4.0 iterates streaming responses on the event loop, where generators reading the database,
+    like the dialogue export, raise ``SynchronousOnlyOperation``. Here they are iterated in the thread
+    the sync view ran in, so their database connection stays the same for the whole response.
+    """
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super().send_response(response, send)
+
+        response_headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode('ascii')
+            if isinstance(value, str):
+                value = value.encode('latin1')
+            response_headers.append((bytes(header), bytes(value)))
+        for cookie in response.cookies.values():
+            response_headers.append((b'Set-Cookie', cookie.output(header='').encode('ascii').strip()))
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': response_headers,
+        })
+
+        iterator = iter(response)
+        read = sync_to_async(read_parts, thread_sensitive=True)
+        while True:
+            parts = await read(iterator, STREAMING_READ_SIZE)
+            if not parts:
+                break
+            for part in parts:
+                for chunk, _ in self.chunk_bytes(part):
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body'})
+        await sync_to_async(response.close, thread_sensitive=True)()
@@ -0,0 +1,215 @@
+import concurrent.futures
+import hashlib
+import io
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+import PIL.Image
+from django.conf import settings
+from rest_framework.exceptions import APIException
+
+
+class ImagePoolSaturated(APIException):
+    status_code = 503
+    default_detail = 'Image processing is overloaded, try again later.'
+    default_code = 'image_pool_saturated'
+
+
+class ImageTooLarge(ValueError):
+    pass
+
+
+class HashingBuffer(io.BytesIO):
+    """
+    Computes sha256 of the encoded image while the encoder writes it, instead of another pass over the bytes.
+    The JPEG encoder only appends, so the hash matches the buffer contents.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.sha256.update(data)
+        return super().write(data)
+
+
+def encode_jpeg(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+def encode_hashed_jpeg(image):
+    buffer = HashingBuffer()
+    image.save(buffer, format='JPEG')
+    return buffer.getvalue(), buffer.sha256.hexdigest()
+
+
+def create_renditions(image, sizes):
+    """
+    Returns JPEG renditions keyed by size for every size smaller than the image.
+    Each rendition fits into a ``size`` x ``size`` box and keeps the aspect ratio.
+    """
+    renditions = {}
+    for size in sorted(sizes, reverse=True):
+        if max(image.size) <= size:
+            continue
+        # Downscaling from the previous rendition is much cheaper than from the original
+        image = image.copy()
+        image.thumbnail((size, size), PIL.Image.LANCZOS)
+        renditions[size] = encode_jpeg(image)
+    return renditions
+
+
+def get_fitting_size(size, max_dimension):
+    width, height = size
+    scale = max_dimension / max(width, height)
+    return max(round(width * scale), 1), max(round(height * scale), 1)
+
+
+def open_image(source, max_dimension, max_pixels):
+    """
+    Opens an image from bytes or a file path and decodes it, at most ``max_dimension`` pixels on the longer side.
+    Only the header is read before the pixel count is checked. JPEGs larger than the target
+    are decoded at a reduced scale (draft mode), which skips most of the decoding and memory.
+    """
+    try:
+        image = PIL.Image.open(source if isinstance(source, str) else io.BytesIO(source))
+    except PIL.Image.DecompressionBombError:
+        raise ImageTooLarge()
+    if max_pixels and image.width * image.height > max_pixels:
+        raise ImageTooLarge()
+
+    if max_dimension and max(image.size) > max_dimension:
+        image.draft('RGB', get_fitting_size(image.size, max_dimension))
+        image = image.convert('RGB')
+        image.thumbnail((max_dimension, max_dimension), PIL.Image.LANCZOS)
+        return image
+    return image.convert('RGB')
+
+
+def process_upload(source, rendition_sizes, max_dimension=0, max_pixels=0):
+    """
+    Decodes an uploaded image (bytes or a file path) and re-encodes it as JPEG together with its renditions.
+    Runs inside the worker pool, so it takes and returns plain picklable values only.
+    """
+    start = time.perf_counter()
+    image = open_image(source, max_dimension, max_pixels)
+    decoded = time.perf_counter()
+
+    data, sha256 = encode_hashed_jpeg(image)
+    result = {
+        'data': data,
+        'sha256': sha256,
+        'renditions': create_renditions(image, rendition_sizes),
+    }
+    encoded = time.perf_counter()
+
+    result['timings'] = {
+        'decode': decoded - start,
+        'encode': encoded - decoded,
+    }
+    return result
+
+
+def get_upload_source(file):
+    """
+    Uploads spooled to disk are opened by path in the worker instead of being read and sent over.
+    """
+    if hasattr(file, 'temporary_file_path'):
+        return file.temporary_file_path()
+    return file.read()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_slots = None
+
+
+def _get_executor():
+    global _executor, _slots
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ProcessPoolExecutor(max_workers=settings.IMAGE_POOL_WORKERS)
+            _slots = threading.BoundedSemaphore(settings.IMAGE_POOL_WORKERS + settings.IMAGE_POOL_QUEUE_SIZE)
+        return _executor, _slots
+
+
+def _reset_executor(executor):
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False)
+
+
+def run_in_pool(func, *args):
+    """
+    Runs ``func`` in the image worker pool. At most ``IMAGE_POOL_QUEUE_SIZE`` tasks may wait for a free
+    worker; beyond that the request is shed with 503 instead of piling up.
+    ``IMAGE_POOL_WORKERS = 0`` runs ``func`` inline.
+    """
+    result, error = run_many_in_pool(func, [args])[0]
+    if error is not None:
+        raise error
+    return result
+
+
+def run_many_in_pool(func, args_list):
+    """
+    Runs ``func`` for every tuple of arguments in parallel and returns a ``(result, exception)`` pair for each.
+    A batch takes at most one pool slot per worker and runs in chunks of that size, so batches larger
+    than the pool queue are accepted too. The whole batch is shed with 503 if the pool cannot take it.
+    """
+    if settings.IMAGE_POOL_WORKERS == 0:
+        outcomes = []
+        for args in args_list:
+            try:
+                outcomes.append((func(*args), None))
+            except Exception as e:
+                outcomes.append((None, e))
+        return outcomes
+    if not args_list:
+        return []
+
+    executor, slots = _get_executor()
+    chunk_size = min(len(args_list), settings.IMAGE_POOL_WORKERS)
+    acquired = 0
+    futures = []
+    try:
+        for _ in range(chunk_size):
+            if not slots.acquire(blocking=False):
+                raise ImagePoolSaturated()
+            acquired += 1
+
+        deadline = time.monotonic() + settings.IMAGE_POOL_TIMEOUT_SECONDS
+        outcomes = []
+        for start in range(0, len(args_list), chunk_size):
+            futures = [executor.submit(func, *args) for args in args_list[start:start + chunk_size]]
+            done, not_done = concurrent.futures.wait(futures, timeout=max(deadline - time.monotonic(), 0))
+            if not_done:
+                for future in not_done:
+                    future.cancel()
+                raise ImagePoolSaturated()
+
+            for future in futures:
+                try:
+                    outcomes.append((future.result(), None))
+                except BrokenProcessPool:
+                    _reset_executor(executor)
+                    raise ImagePoolSaturated()
+                except Exception as e:
+                    outcomes.append((None, e))
+        return outcomes
+    except BrokenProcessPool:
+        _reset_executor(executor)
+        raise ImagePoolSaturated()
+    finally:
+        # Pictures of a timed out batch still being processed keep their slots until they are done
+        running = [future for future in futures if not future.done()][:acquired]
+        for _ in range(acquired - len(running)):
+            slots.release()
+        for future in running:
+            future.add_done_callback(lambda _: slots.release())
@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from messenger import archive
+
+
+class Command(BaseCommand):
+    help = 'Moves messages older than --days from the message table to the archive table in batches. ' \
+           'Last messages of dialogues and read markers stay in the message table.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.MESSAGE_ARCHIVE_AFTER_DAYS)
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, days, batch_size, verbosity, **options):
+        def report(total):
+            if verbosity > 1:
+                self.stdout.write(f'Archived {total} messages')
+
+        archived = archive.archive_messages(days, batch_size, report)
+        self.stdout.write(self.style.SUCCESS(f'Archived {archived} messages older than {days} days'))
@@ -0,0 +1,44 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework_simplejwt.tokens import AccessToken
+
+
+class Command(BaseCommand):
+    help = 'Measures requests per second of a single worker on an authenticated endpoint ' \
+           'with and without the user cache. The benchmark user is rolled back afterwards.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000)
+        parser.add_argument('--path', default='/api/v1/hello/')
+
+    def run(self, client, path, requests, **headers):
+        client.get(path, **headers)
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            for _ in range(requests):
+                response = client.get(path, **headers)
+            elapsed = time.perf_counter() - start
+        assert response.status_code == 200, response.status_code
+        return requests / elapsed, len(queries) / requests
+
+    def handle(self, *args, requests, path, **options):
+        with transaction.atomic():
+            user = User.objects.create_user(username='bench-auth-user', password='bench-auth-password')
+            token = str(AccessToken.for_user(user))
+
+            session_client = Client(HTTP_HOST='localhost')
+            session_client.force_login(user, backend='messenger.authentication.CachedModelBackend')
+            jwt_client = Client(HTTP_HOST='localhost')
+
+            for timeout, label in ((0, 'without cache'), (30, 'with cache')):
+                with override_settings(AUTH_USER_CACHE_TIMEOUT_SECONDS=timeout):
+                    rps, queries = self.run(jwt_client, path, requests, HTTP_AUTHORIZATION=f'Bearer {token}')
+                    self.stdout.write(f'JWT {label:>14}: {rps:8.0f} req/s, {queries:.2f} queries/request')
+                    rps, queries = self.run(session_client, path, requests)
+                    self.stdout.write(f'session {label:>10}: {rps:8.0f} req/s, {queries:.2f} queries/request')
+            transaction.set_rollback(True)
@@ -0,0 +1,202 @@
+import asyncio
+import io
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from rest_framework_simplejwt.tokens import AccessToken
+
+from messenger import benchmarks, dataset, models
+
+SERVERS = ('wsgi', 'asgi')
+
+
+def get_endpoints(user):
+    dialogue = models.Dialogue.objects.filter(users=user) \
+        .annotate(message_count=Count('messages')).order_by('-message_count').first()
+    picture = models.PictureV2.objects.filter(messages__dialogue=dialogue).first()
+    if dialogue is None or picture is None:
+        raise CommandError('The dataset has no dialogues with pictures')
+    return {
+        'my_dialogues': ('/api/v1/dialogue/my/', ''),
+        'messages': (f'/api/v1/dialogue/{dialogue.id}/messages/', ''),
+        'picture': (f'/api/v1/picture/{picture.uuid}/', ''),
+        'suggest_users': ('/api/v1/user/suggest/', f'name_substring={user.first_name[:3]}'),
+        # Nothing is published, so every poll waits for --poll-timeout
+        'events_poll': ('/api/v1/events/poll/', ''),
+    }
+
+
+def run_wsgi(path, query, token, clients, workers, duration):
+    """
+    ``clients`` threads send requests one after another, at most ``workers`` of them are handled at a time,
+    like by a server with ``workers`` sync workers. Latencies include waiting for a free worker.
+    """
+    from DreaMessenger.wsgi import application
+
+    slots = threading.BoundedSemaphore(workers)
+    durations = []
+    statuses = {}
+    deadline = time.perf_counter() + duration
+
+    def client():
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            with slots:
+                status = []
+                body = application({
+                    'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': query, 'SCRIPT_NAME': '',
+                    'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1',
+                    'HTTP_HOST': 'localhost', 'HTTP_AUTHORIZATION': f'Bearer {token}',
+                    'wsgi.input': io.BytesIO(), 'wsgi.errors': sys.stderr, 'wsgi.url_scheme': 'http',
+                    'wsgi.version': (1, 0), 'wsgi.multithread': True, 'wsgi.multiprocess': False,
+                    'wsgi.run_once': False,
+                }, lambda response_status, headers, exc_info=None: status.append(response_status))
+                for _ in body:
+                    pass
+                body.close()
+            durations.append(time.perf_counter() - start)
+            code = status[0].split()[0]
+            statuses[code] = statuses.get(code, 0) + 1
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return durations, statuses
+
+
+def run_asgi(path, query, token, clients, duration):
+    """
+    ``clients`` coroutines send requests one after another to the ASGI application in one event loop.
+    """
+    from DreaMessenger.asgi import application
+
+    durations = []
+    statuses = {}
+
+    async def request():
+        status = []
+        received = asyncio.Event()
+
+        async def receive():
+            if not received.is_set():
+                received.set()
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            await asyncio.Event().wait()
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                status.append(message['status'])
+
+        await application({
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+            'path': path, 'raw_path': path.encode(), 'query_string': query.encode(), 'root_path': '',
+            'headers': [(b'host', b'localhost'), (b'authorization', f'Bearer {token}'.encode())],
+            'client': ('127.0.0.1', 0), 'server': ('localhost', 80),
+        }, receive, send)
+        return str(status[0])
+
+    async def client(deadline):
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            code = await request()
+            durations.append(time.perf_counter() - start)
+            statuses[code] = statuses.get(code, 0) + 1
+
+    async def main():
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(*(client(deadline) for _ in range(clients)))
+
+    asyncio.run(main())
+    return durations, statuses
+
+
+class Command(BaseCommand):
+    help = 'Compares throughput and latency of read endpoints served by the sync WSGI application ' \
+           'and by the async views through the ASGI application at increasing client counts. ' \
+           'Both servers run in-process, each in its own subprocess. Needs data from generate_dataset.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', default='1,10,100,500')
+        parser.add_argument('--duration', type=float, default=5.0, help='Seconds per endpoint and client count')
+        parser.add_argument('--wsgi-workers', type=int, default=4,
+                            help='Requests the WSGI server handles at a time, like gunicorn sync workers')
+        parser.add_argument('--poll-timeout', type=int, default=1)
+        parser.add_argument('--endpoints', help='Comma separated endpoint names, all by default')
+        parser.add_argument('--server', choices=SERVERS, help='Run only one server, used internally')
+        parser.add_argument('--output', help='File to write JSON results to')
+
+    def handle(self, *args, clients, duration, wsgi_workers, poll_timeout, endpoints, server, output, **options):
+        user = User.objects.filter(username__startswith=dataset.USERNAME_PREFIX) \
+            .annotate(dialogue_count=Count('dialogues')).order_by('-dialogue_count', 'id').first()
+        if user is None:
+            raise CommandError('No dataset users, run generate_dataset first')
+        available = get_endpoints(user)
+        names = endpoints.split(',') if endpoints else list(available)
+        unknown = set(names) - set(available)
+        if unknown:
+            raise CommandError(f'Unknown endpoints: {", ".join(sorted(unknown))}')
+
+        if server is not None:
+            self.run_server(server, user, available, names, [int(count) for count in clients.split(',')],
+                            duration, wsgi_workers)
+            return
+
+        results = {}
+        for server in SERVERS:
+            env = dict(os.environ, ASYNC_VIEWS=str(server == 'asgi'),
+                       EVENTS_LONG_POLL_TIMEOUT_SECONDS=str(poll_timeout),
+                       EVENTS_SYNC_POLL_TIMEOUT_SECONDS=str(poll_timeout))
+            completed = subprocess.run([
+                sys.executable, sys.argv[0], 'bench_concurrency', '--server', server, '--clients', clients,
+                '--duration', str(duration), '--wsgi-workers', str(wsgi_workers), '--endpoints', ','.join(names),
+            ], env=env, stdout=subprocess.PIPE, check=True, text=True)
+            results[server] = json.loads(completed.stdout.splitlines()[-1])
+
+        self.stdout.write(f'{"endpoint":>14} {"clients":>8} {"wsgi req/s":>11} {"p99 ms":>8} '
+                          f'{"asgi req/s":>11} {"p99 ms":>8}')
+        for name in names:
+            for count in clients.split(','):
+                wsgi, asgi = results['wsgi'][name][count], results['asgi'][name][count]
+                self.stdout.write(f'{name:>14} {count:>8} {wsgi["throughput_rps"]:11.0f} {wsgi["p99_ms"]:8.1f} '
+                                  f'{asgi["throughput_rps"]:11.0f} {asgi["p99_ms"]:8.1f}')
+
+        if output:
+            with open(output, 'w') as file:
+                json.dump({
+                    'wsgi_workers': wsgi_workers,
+                    'async_db_threads': settings.ASYNC_DB_THREADS,
+                    'poll_timeout': poll_timeout,
+                    'duration': duration,
+                    'results': results,
+                }, file, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Results written to {output}'))
+
+    def run_server(self, server, user, available, names, client_counts, duration, wsgi_workers):
+        token = str(AccessToken.for_user(user))
+        results = {}
+        for name in names:
+            path, query = available[name]
+            results[name] = {}
+            for clients in client_counts:
+                if server == 'wsgi':
+                    durations, statuses = run_wsgi(path, query, token, clients, wsgi_workers, duration)
+                else:
+                    durations, statuses = run_asgi(path, query, token, clients, duration)
+                stats = benchmarks.summarize(durations)
+                stats.update({
+                    'throughput_rps': len(durations) / duration,
+                    'statuses': statuses,
+                })
+                results[name][str(clients)] = stats
+        # The parent process reads the last line
+        self.stdout.write(json.dumps(results))
@@ -0,0 +1,57 @@
+import hashlib
+import time
+import tracemalloc
+import uuid
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from messenger import export, models
+
+
+class Command(BaseCommand):
+    help = 'Streams exports of dialogues of increasing size and reports throughput and peak Python memory ' \
+           'measured with tracemalloc. The dialogues are rolled back afterwards.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', default='1000,10000,50000', help='Comma separated dialogue sizes')
+        parser.add_argument('--picture-every', type=int, default=10, help='Every n-th message has a new picture')
+        parser.add_argument('--picture-size', type=int, default=20000, help='Bytes per picture')
+
+    def create_dialogue(self, count, picture_every, picture_size):
+        users = [User.objects.create(username=f'bench-export-{uuid.uuid4().hex}') for _ in range(2)]
+        dialogue = models.Dialogue.objects.create()
+        dialogue.users.set(users)
+
+        pictures = []
+        for _ in range((count + picture_every - 1) // picture_every):
+            data = uuid.uuid4().bytes * (picture_size // 16)
+            pictures.append(models.PictureV2(uuid=uuid.uuid4(), data=data, sha256=hashlib.sha256(data).hexdigest()))
+        models.PictureV2.objects.bulk_create(pictures, batch_size=100)
+
+        models.Message.objects.bulk_create([
+            models.Message(dialogue=dialogue, from_user=users[index % 2],
+                           picture=pictures[index // picture_every] if index % picture_every == 0 else None)
+            for index in range(count)
+        ], batch_size=1000)
+        return dialogue, len(pictures)
+
+    def handle(self, *args, messages, picture_every, picture_size, **options):
+        self.stdout.write(f'{"messages":>9} {"pictures":>9} {"MB":>8} {"seconds":>8} {"MB/s":>7} {"peak MB":>8}')
+        for count in (int(count) for count in messages.split(',')):
+            with transaction.atomic():
+                dialogue, picture_count = self.create_dialogue(count, picture_every, picture_size)
+
+                tracemalloc.start()
+                start = time.perf_counter()
+                size = 0
+                for chunk in export.generate_export(dialogue):
+                    size += len(chunk)
+                duration = time.perf_counter() - start
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+
+                self.stdout.write(f'{count:9} {picture_count:9} {size / 2 ** 20:8.1f} {duration:8.2f} '
+                                  f'{size / 2 ** 20 / duration:7.1f} {peak / 2 ** 20:8.2f}')
+                transaction.set_rollback(True)
@@ -0,0 +1,50 @@
+import hashlib
+import os
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from messenger import benchmarks, models, serializers
+
+
+def create_serializer(data):
+    serializer = serializers.PictureSerializer(data={})
+    serializer.cleaned_data = {'data': data}
+    return serializer
+
+
+class Command(BaseCommand):
+    help = 'Measures PictureSerializer.save for duplicate and new pictures as the picture table grows. ' \
+           'Everything is rolled back afterwards.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--table-sizes', default='1000,10000,100000')
+        parser.add_argument('--repeat', type=int, default=200)
+        parser.add_argument('--picture-size', type=int, default=64 * 1024)
+
+    def handle(self, *args, table_sizes, repeat, picture_size, **options):
+        duplicate = os.urandom(picture_size)
+
+        with transaction.atomic():
+            create_serializer(duplicate).save()
+            rows = 1
+            for table_size in map(int, table_sizes.split(',')):
+                while rows < table_size:
+                    batch = []
+                    for _ in range(min(1000, table_size - rows)):
+                        data = os.urandom(16)
+                        batch.append(models.PictureV2(uuid=uuid.uuid4(), data=data,
+                                                      sha256=hashlib.sha256(data).hexdigest()))
+                    models.PictureV2.objects.bulk_create(batch)
+                    rows += len(batch)
+
+                duplicate_stats = benchmarks.measure(lambda: create_serializer(duplicate).save(), repeat)
+                new_stats = benchmarks.measure(lambda: create_serializer(os.urandom(picture_size)).save(), repeat)
+                rows += repeat
+                self.stdout.write(f'{table_size:>10} rows: '
+                                  f'duplicate p50 {duplicate_stats["p50_ms"]:.3f} ms, '
+                                  f'p95 {duplicate_stats["p95_ms"]:.3f} ms; '
+                                  f'new p50 {new_stats["p50_ms"]:.3f} ms, '
+                                  f'p95 {new_stats["p95_ms"]:.3f} ms')
+            transaction.set_rollback(True)
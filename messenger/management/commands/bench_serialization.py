@@ -0,0 +1,83 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import IntegerField, Value
+from django.test import override_settings
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory
+
+from messenger import benchmarks, dataset, models, renderers, representations, serializers
+
+
+class Command(BaseCommand):
+    help = 'Measures per-item cost of building and rendering message and dialogue lists with DRF serializers ' \
+           'and with the values() based builders. The dataset is rolled back afterwards.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=100)
+        parser.add_argument('--repeat', type=int, default=50)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def report(self, name, stats, items):
+        self.stdout.write(f'{name:>28}: {stats["p50_ms"] * 1000 / items:8.1f} us/item (p50), '
+                          f'{stats["p95_ms"] * 1000 / items:8.1f} us/item (p95)')
+
+    def handle(self, *args, items, repeat, seed, **options):
+        with transaction.atomic():
+            dataset.generate(users=items * 2, dialogues=items * 2, messages=items * 4, pictures=items,
+                             members_distribution='2:80,3-8:20', seed=seed)
+            user = models.User.objects.filter(username__startswith=dataset.USERNAME_PREFIX).first()
+            request = APIRequestFactory(HTTP_HOST='localhost').get('/api/v1/')
+            request.user = user
+
+            messages = list(models.Message.objects
+                            .select_related('from_user__info__avatar', 'picture')
+                            .defer('from_user__info__avatar__data', 'picture__data')
+                            .order_by('-created_at', '-id')[:items])
+            message_rows = list(models.Message.objects
+                                .values(*representations.MESSAGE_FIELDS)
+                                .order_by('-created_at', '-id')[:items])
+            dialogues = list(models.Dialogue.objects.filter(id__in=[message.dialogue_id for message in messages])
+                             .values_list('id', flat=True))
+            dialogue_instances = list(models.Dialogue.objects.filter(id__in=dialogues)
+                                      .prefetch_related('users__info__avatar')
+                                      .select_related('last_message__from_user__info__avatar',
+                                                      'last_message__picture')
+                                      .defer('last_message__from_user__info__avatar__data',
+                                             'last_message__picture__data'))
+            for dialogue in dialogue_instances:
+                dialogue.unread_count, dialogue.last_read_message = 0, None
+            dialogue_rows = list(models.Dialogue.objects.filter(id__in=dialogues)
+                                 .annotate(unread_count=Value(0), last_read_message=Value(None, IntegerField()))
+                                 .values(*representations.DIALOGUE_FIELDS))
+            context = {'request': request}
+
+            def serializer_messages():
+                request._profiles = {}
+                return serializers.MessageResponseSerializer(messages, many=True, context=context).data
+
+            def builder_messages():
+                return representations.Builder(request).build_messages(message_rows)
+
+            def serializer_dialogues():
+                request._profiles = {}
+                return serializers.DialogueResponseSerializer(dialogue_instances, many=True, context=context).data
+
+            def builder_dialogues():
+                return representations.Builder(request).build_dialogues(dialogue_rows)
+
+            no_cache = {'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}
+            for name, func, count in (('messages serializer', serializer_messages, len(messages)),
+                                      ('messages builder', builder_messages, len(message_rows)),
+                                      ('dialogues serializer', serializer_dialogues, len(dialogue_instances)),
+                                      ('dialogues builder (+1 query)', builder_dialogues, len(dialogue_rows))):
+                if 'serializer' in name:
+                    # Profiles are rendered every time on profile cache misses
+                    with override_settings(CACHES=no_cache):
+                        self.report(f'{name} (cold)', benchmarks.measure(func, repeat), count)
+                self.report(name, benchmarks.measure(func, repeat), count)
+
+            data = builder_messages()
+            for name, renderer in (('messages JSONRenderer', JSONRenderer()),
+                                   ('messages FastJSONRenderer', renderers.FastJSONRenderer())):
+                self.report(name, benchmarks.measure(lambda: renderer.render(data), repeat), len(data))
+            transaction.set_rollback(True)
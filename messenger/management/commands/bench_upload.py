@@ -0,0 +1,75 @@
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+import PIL.Image
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from messenger import imaging
+
+FORMATS = ('JPEG', 'PNG')
+
+
+def process_file(path, max_dimension, max_pixels):
+    """
+    Runs in a fresh process, so that the peak resident memory of the process is the peak of one upload.
+    Processes inherit the peak of the process they are forked from, so they are forked from a fork server
+    started before the generated images take up memory.
+    Without a path only the peak of the idle process is returned.
+    """
+    start = time.perf_counter()
+    outcome = None
+    if path is not None:
+        try:
+            imaging.process_upload(path, settings.PICTURE_RENDITION_SIZES, max_dimension, max_pixels)
+            outcome = 'ok'
+        except imaging.ImageTooLarge:
+            outcome = 'rejected'
+    duration = time.perf_counter() - start
+    # Kilobytes on Linux
+    return outcome, duration, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Command(BaseCommand):
+    help = 'Processes generated uploads of increasing resolution and reports time and peak resident memory ' \
+           'of full decoding next to the bounded path with --max-dimension and PICTURE_MAX_PIXELS. ' \
+           'Every upload is processed in a new process, read from a temporary file like a spooled upload.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--megapixels', default='1,12,24,48', help='Comma separated image sizes')
+        parser.add_argument('--formats', default=','.join(FORMATS))
+        parser.add_argument('--max-dimension', type=int, default=settings.PICTURE_MAX_DIMENSION or 2560,
+                            help='Longer side of stored originals on the bounded path')
+
+    def create_file(self, directory, megapixels, image_format):
+        # 4:3 noise, which compresses like a photo rather than like a flat color
+        width = int((megapixels * 1_000_000 * 4 / 3) ** 0.5)
+        height = width * 3 // 4
+        image = PIL.Image.effect_noise((width, height), 64).convert('RGB')
+        path = os.path.join(directory, f'{megapixels}.{image_format.lower()}')
+        image.save(path, format=image_format)
+        return path
+
+    def handle(self, *args, megapixels, formats, max_dimension, **options):
+        context = multiprocessing.get_context('forkserver')
+
+        def run(*arguments):
+            with context.Pool(1) as pool:
+                return pool.apply(process_file, arguments)
+
+        idle_peak = run(None, 0, 0)[2]
+        self.stdout.write(f'Peak memory above an idle worker ({idle_peak:.1f} MB)')
+        self.stdout.write(f'{"format":>6} {"MP":>4} {"file MB":>8} {"full s":>7} {"full MB":>8} '
+                          f'{"bounded s":>9} {"bounded MB":>10} {"outcome":>8}')
+        with tempfile.TemporaryDirectory() as directory:
+            for image_format in formats.split(','):
+                for size in (int(size) for size in megapixels.split(',')):
+                    path = self.create_file(directory, size, image_format)
+                    _, full_duration, full_peak = run(path, 0, 0)
+                    outcome, duration, peak = run(path, max_dimension, settings.PICTURE_MAX_PIXELS)
+                    self.stdout.write(f'{image_format:>6} {size:4} {os.path.getsize(path) / 2 ** 20:8.1f} '
+                                      f'{full_duration:7.2f} {full_peak - idle_peak:8.1f} '
+                                      f'{duration:9.2f} {peak - idle_peak:10.1f} {outcome:>8}')
@@ -0,0 +1,55 @@
+import random
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from messenger import benchmarks, views
+
+SYLLABLES = ('an', 'bel', 'cor', 'da', 'el', 'fin', 'gor', 'ha', 'is', 'jor', 'ka', 'lin',
+             'mar', 'nor', 'ol', 'pet', 'ra', 'sel', 'tin', 'ul', 'vik', 'yan', 'zo')
+
+
+def generate_name(rng, syllables):
+    return ''.join(rng.choice(SYLLABLES) for _ in range(syllables))
+
+
+class Command(BaseCommand):
+    help = 'Measures user/suggest/ latency over a table of synthetic users. ' \
+           'Users are created in a transaction that is rolled back afterwards.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000000)
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--queries', default='mar,belcor,anna,ka lin,zzz')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, users, repeat, queries, seed, **options):
+        rng = random.Random(seed)
+        factory = APIRequestFactory(HTTP_HOST='localhost')
+        view = views.UserSuggestView.as_view()
+
+        with transaction.atomic():
+            for start in range(0, users, 10000):
+                User.objects.bulk_create([
+                    User(username=f'{generate_name(rng, 3)}{index}', password='!',
+                         first_name=generate_name(rng, 2).capitalize(), last_name=generate_name(rng, 3).capitalize())
+                    for index in range(start, min(start + 10000, users))
+                ])
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute(f'ANALYZE {connection.ops.quote_name(User._meta.db_table)}')
+            self.stdout.write(f'Created {users} users')
+
+            searcher = User.objects.first()
+            for query in queries.split(','):
+                def suggest():
+                    request = factory.get('/api/v1/user/suggest/', {'name_substring': query})
+                    force_authenticate(request, user=searcher)
+                    response = view(request)
+                    response.render()
+
+                stats = benchmarks.measure(suggest, repeat)
+                self.stdout.write(f'{query!r:>12}: p50 {stats["p50_ms"]:.1f} ms, p95 {stats["p95_ms"]:.1f} ms')
+            transaction.set_rollback(True)
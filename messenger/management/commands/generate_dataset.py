@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from messenger import dataset
+
+
+class Command(BaseCommand):
+    help = 'Fills the database with deterministic synthetic users, dialogues, messages and pictures. ' \
+           f'Generated users share the password "{dataset.PASSWORD}".'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--dialogues', type=int, default=2000)
+        parser.add_argument('--messages', type=int, default=50000)
+        parser.add_argument('--pictures', type=int, default=500)
+        parser.add_argument('--members', default='2:80,3-8:15,9-50:5',
+                            help='Dialogue sizes as comma separated "size-range:weight" pairs')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, users, dialogues, messages, pictures, members, seed, **options):
+        try:
+            dataset.parse_members_distribution(members)
+        except ValueError as e:
+            raise CommandError(f'Invalid --members: {e}')
+
+        with transaction.atomic():
+            created = dataset.generate(users, dialogues, messages, pictures, members, seed)
+        self.stdout.write(self.style.SUCCESS(
+            'Created ' + ', '.join(f'{count} {name}' for name, count in created.items())
+        ))
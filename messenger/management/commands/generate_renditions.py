@@ -0,0 +1,38 @@
+import io
+
+import PIL.Image
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from messenger import imaging, models, serializers, storage
+
+
+class Command(BaseCommand):
+    help = 'Generates missing renditions for pictures used as message pictures or avatars. ' \
+           'Safe to interrupt and run again.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def handle(self, *args, batch_size, **options):
+        sizes = settings.PICTURE_RENDITION_SIZES
+        uuids = set(models.Message.objects.exclude(picture=None).values_list('picture', flat=True))
+        uuids.update(models.UserInfo.objects.exclude(avatar=None).values_list('avatar', flat=True))
+        uuids = sorted(uuids)
+
+        generated = 0
+        for start in range(0, len(uuids), batch_size):
+            batch = models.PictureV2.objects.filter(uuid__in=uuids[start:start + batch_size]).defer('data')
+            for picture in batch:
+                existing_sizes = set(picture.renditions.values_list('size', flat=True))
+                if existing_sizes.issuperset(sizes):
+                    continue
+
+                image = PIL.Image.open(io.BytesIO(storage.read_picture(picture))).convert('RGB')
+                renditions = imaging.create_renditions(image, sizes)
+                renditions = {size: data for size, data in renditions.items() if size not in existing_sizes}
+                serializers.save_renditions(picture, renditions)
+                generated += len(renditions)
+            self.stdout.write(f'Processed {min(start + batch_size, len(uuids))} of {len(uuids)} pictures')
+
+        self.stdout.write(self.style.SUCCESS(f'Generated {generated} renditions'))
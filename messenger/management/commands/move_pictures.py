@@ -0,0 +1,50 @@
+import hashlib
+
+from django.core.management.base import BaseCommand, CommandError
+
+from messenger import models, storage
+
+
+class Command(BaseCommand):
+    help = 'Moves picture bytes between storages. Safe to interrupt and run again: ' \
+           'already moved pictures are skipped and writes are idempotent.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='source', default=storage.DatabaseStorage.name,
+                            choices=storage.STORAGES.keys())
+        parser.add_argument('--to', dest='target', default=storage.FileSystemStorage.name,
+                            choices=storage.STORAGES.keys())
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def handle(self, *args, source, target, batch_size, **options):
+        if source == target:
+            raise CommandError('Source and target storages must differ')
+
+        source_storage = storage.get_storage(source)
+        target_storage = storage.get_storage(target)
+        pictures = models.PictureV2.objects.filter(storage=source).defer('data').order_by('uuid')
+
+        moved = skipped = 0
+        last_uuid = None
+        while True:
+            batch = pictures if last_uuid is None else pictures.filter(uuid__gt=last_uuid)
+            batch = list(batch[:batch_size])
+            if not batch:
+                break
+
+            for picture in batch:
+                data = source_storage.read(picture)
+                if hashlib.sha256(data).hexdigest() != picture.sha256:
+                    self.stderr.write(f'Skipping {picture.uuid}: stored bytes do not match sha256')
+                    skipped += 1
+                    continue
+
+                fields = target_storage.save(picture.sha256, data)
+                moved += models.PictureV2.objects \
+                    .filter(uuid=picture.uuid, storage=source) \
+                    .update(storage=target, **fields)
+
+            last_uuid = batch[-1].uuid
+            self.stdout.write(f'Moved {moved} pictures so far')
+
+        self.stdout.write(self.style.SUCCESS(f'Moved {moved} pictures from {source} to {target}, skipped {skipped}'))
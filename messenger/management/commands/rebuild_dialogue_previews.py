@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from django.db.models import OuterRef, Subquery
+
+from messenger import models
+
+
+class Command(BaseCommand):
+    help = 'Points Dialogue.last_message of every dialogue at its latest message.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, batch_size, **options):
+        latest_message = models.Message.objects \
+            .filter(dialogue=OuterRef('pk')) \
+            .order_by('-created_at', '-id') \
+            .values('id')[:1]
+
+        dialogue_ids = models.Dialogue.objects.order_by('id').values_list('id', flat=True)
+        last_id = 0
+        updated = 0
+        while True:
+            batch = list(dialogue_ids.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            updated += models.Dialogue.objects \
+                .filter(id__in=batch) \
+                .update(last_message=Subquery(latest_message))
+            last_id = batch[-1]
+
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt previews of {updated} dialogues'))
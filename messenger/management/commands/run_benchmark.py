@@ -0,0 +1,285 @@
+import datetime
+import io
+import json
+import time
+
+import PIL.Image
+import django
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from messenger import benchmarks, dataset, models
+
+# Metrics are only served to staff or with a token
+BENCH_METRICS_TOKEN = 'bench-metrics-token'
+
+
+def create_upload(name):
+    file = io.BytesIO()
+    PIL.Image.new('RGB', (512, 384), color=(30, 120, 200)).save(file, format='PNG')
+    return SimpleUploadedFile(name, file.getvalue(), content_type='image/png')
+
+
+def route(path):
+    def decorator(method):
+        method.route = path
+        return method
+    return decorator
+
+
+class Benchmark:
+    """
+    Every ``bench_*`` method covers one route of ``messenger/urls.py`` (``route`` attribute)
+    and returns a callable making a single request. Only the call is measured,
+    so per-iteration setup such as logging in before a logout stays out of the numbers.
+    """
+
+    def __init__(self, user, password):
+        self.user = user
+        self.password = password
+        self.api = APIClient(HTTP_HOST='localhost')
+        self.api.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(user).access_token}')
+
+        self.dialogue = models.Dialogue.objects.filter(users=user) \
+            .annotate(message_count=Count('messages')).order_by('-message_count').first()
+        self.message = self.dialogue.messages.filter(picture__isnull=False).order_by('-created_at', '-id').first()
+        if self.message is None:
+            raise CommandError('The dataset has no messages with pictures')
+        self.picture = self.message.picture
+        self.partners = list(User.objects.filter(username__startswith=dataset.USERNAME_PREFIX)
+                             .exclude(id=user.id).order_by('id')[:200])
+
+    def get_routes(self):
+        return {name[len('bench_'):]: getattr(self, name) for name in dir(self) if name.startswith('bench_')}
+
+    @route('hello/')
+    def bench_hello(self, i):
+        return lambda: self.api.get('/api/v1/hello/')
+
+    @route('metrics/')
+    def bench_metrics(self, i):
+        client = Client(HTTP_HOST='localhost', HTTP_AUTHORIZATION=f'Bearer {BENCH_METRICS_TOKEN}')
+        return lambda: client.get('/api/v1/metrics/')
+
+    @route('auth/session/login/')
+    def bench_session_login(self, i):
+        client = Client(HTTP_HOST='localhost')
+        return lambda: client.post('/api/v1/auth/session/login/',
+                                   {'username': self.user.username, 'password': self.password})
+
+    @route('auth/session/logout/')
+    def bench_session_logout(self, i):
+        client = Client(HTTP_HOST='localhost')
+        client.force_login(self.user)
+        return lambda: client.post('/api/v1/auth/session/logout/')
+
+    @route('auth/token/login/')
+    def bench_token_login(self, i):
+        return lambda: self.api.post('/api/v1/auth/token/login/',
+                                     {'username': self.user.username, 'password': self.password})
+
+    @route('auth/token/refresh/')
+    def bench_token_refresh(self, i):
+        refresh = str(RefreshToken.for_user(self.user))
+        return lambda: self.api.post('/api/v1/auth/token/refresh/', {'refresh': refresh})
+
+    @route('auth/register/')
+    def bench_register(self, i):
+        client = Client(HTTP_HOST='localhost')
+        return lambda: client.post('/api/v1/auth/register/', {
+            'username': f'bench-register-{i}', 'password': self.password,
+            'first_name': 'Bench', 'last_name': 'Register',
+        })
+
+    @route('dialogue/my/')
+    def bench_my_dialogues(self, i):
+        return lambda: self.api.get('/api/v1/dialogue/my/')
+
+    @route('dialogue/my/')
+    def bench_my_dialogues_sync(self, i):
+        return lambda: self.api.get('/api/v1/dialogue/my/', {'since': ''})
+
+    @route('dialogue/<int:pk>/messages/')
+    def bench_messages(self, i):
+        return lambda: self.api.get(f'/api/v1/dialogue/{self.dialogue.id}/messages/')
+
+    @route('dialogue/<int:pk>/messages/')
+    def bench_messages_cursor(self, i):
+        return lambda: self.api.get(f'/api/v1/dialogue/{self.dialogue.id}/messages/', {'before': ''})
+
+    @route('dialogue/<int:pk>/messages/')
+    def bench_messages_sync(self, i):
+        return lambda: self.api.get(f'/api/v1/dialogue/{self.dialogue.id}/messages/', {'since': ''})
+
+    @route('dialogue/<int:pk>/messages/send/')
+    def bench_send_message(self, i):
+        upload = create_upload(f'bench-{i}.png')
+        return lambda: self.api.post(f'/api/v1/dialogue/{self.dialogue.id}/messages/send/', {'data': upload},
+                                     format='multipart')
+
+    @route('dialogue/<int:pk>/messages/send/batch/')
+    def bench_send_message_batch(self, i):
+        uploads = [create_upload(f'bench-{i}-{index}.png') for index in range(4)]
+        return lambda: self.api.post(f'/api/v1/dialogue/{self.dialogue.id}/messages/send/batch/', {'data': uploads},
+                                     format='multipart')
+
+    @route('dialogue/<int:pk>/read/')
+    def bench_mark_read(self, i):
+        return lambda: self.api.post(f'/api/v1/dialogue/{self.dialogue.id}/read/', {'message': self.message.id})
+
+    @route('dialogue/<int:pk>/export/')
+    def bench_export(self, i):
+        def request():
+            response = self.api.get(f'/api/v1/dialogue/{self.dialogue.id}/export/')
+            for _ in response.streaming_content:
+                pass
+            return response
+        return request
+
+    @route('picture/<uuid:uuid>/')
+    def bench_picture(self, i):
+        return lambda: self.api.get(f'/api/v1/picture/{self.picture.uuid}/')
+
+    @route('picture/<uuid:uuid>/')
+    def bench_picture_not_modified(self, i):
+        return lambda: self.api.get(f'/api/v1/picture/{self.picture.uuid}/',
+                                    HTTP_IF_NONE_MATCH=f'"{self.picture.sha256}"')
+
+    @route('dialogue/create/')
+    def bench_create_dialogue(self, i):
+        partner = User.objects.create(username=f'bench-partner-{i}')
+        return lambda: self.api.post('/api/v1/dialogue/create/', {'with_user': partner.username})
+
+    @route('events/poll/')
+    def bench_events_poll(self, i):
+        return lambda: self.api.get('/api/v1/events/poll/', {'since': 0})
+
+    @route('user/my/')
+    def bench_my_user(self, i):
+        return lambda: self.api.get('/api/v1/user/my/')
+
+    @route('user/find/<username>/')
+    def bench_find_user(self, i):
+        partner = self.partners[i % len(self.partners)]
+        return lambda: self.api.get(f'/api/v1/user/find/{partner.username}/')
+
+    @route('user/lookup/')
+    def bench_lookup_users(self, i):
+        usernames = [partner.username for partner in self.partners[:50]]
+        return lambda: self.api.post('/api/v1/user/lookup/', {'usernames': usernames}, format='json')
+
+    @route('user/suggest/')
+    def bench_suggest_users(self, i):
+        name_substring = self.partners[i % len(self.partners)].first_name[:3]
+        return lambda: self.api.get('/api/v1/user/suggest/', {'name_substring': name_substring})
+
+    @route('user/avatar/')
+    def bench_set_avatar(self, i):
+        upload = create_upload(f'avatar-{i}.png')
+        return lambda: self.api.post('/api/v1/user/avatar/', {'data': upload}, format='multipart')
+
+
+def run_endpoint(prepare, repeat, warmup):
+    for i in range(warmup):
+        prepare(-1 - i)()
+
+    durations = []
+    query_counts = []
+    statuses = {}
+    for i in range(repeat):
+        request = prepare(i)
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            response = request()
+            durations.append(time.perf_counter() - start)
+        query_counts.append(len(queries))
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    stats = benchmarks.summarize(durations)
+    stats.update({
+        'throughput_rps': len(durations) / sum(durations) if durations else 0.0,
+        'queries_mean': sum(query_counts) / len(query_counts) if query_counts else 0.0,
+        'queries_max': max(query_counts, default=0),
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+    })
+    return stats
+
+
+class Command(BaseCommand):
+    help = 'Drives every API endpoint over a synthetic dataset and reports latency percentiles, ' \
+           'throughput and SQL query counts per endpoint. The dataset is generated in a transaction ' \
+           'that is rolled back afterwards, unless --existing-dataset is passed.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--dialogues', type=int, default=2000)
+        parser.add_argument('--messages', type=int, default=50000)
+        parser.add_argument('--pictures', type=int, default=500)
+        parser.add_argument('--members', default='2:80,3-8:15,9-50:5')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--existing-dataset', action='store_true',
+                            help='Use data created by generate_dataset instead of generating it')
+        parser.add_argument('--repeat', type=int, default=50)
+        parser.add_argument('--warmup', type=int, default=3)
+        parser.add_argument('--endpoints', help='Comma separated endpoint names, all by default')
+        parser.add_argument('--output', help='File to write JSON results to')
+
+    def handle(self, *args, existing_dataset, repeat, warmup, endpoints, output, **options):
+        started_at = datetime.datetime.now(datetime.timezone.utc)
+        with transaction.atomic():
+            if existing_dataset:
+                sizes = {
+                    'users': User.objects.count(),
+                    'dialogues': models.Dialogue.objects.count(),
+                    'messages': models.Message.objects.count(),
+                    'pictures': models.PictureV2.objects.count(),
+                }
+            else:
+                sizes = dataset.generate(options['users'], options['dialogues'], options['messages'],
+                                         options['pictures'], options['members'], options['seed'])
+                self.stdout.write('Generated ' + ', '.join(f'{count} {name}' for name, count in sizes.items()))
+
+            # The benchmark user is the busiest one, so that list endpoints return full pages
+            user = User.objects.filter(username__startswith=dataset.USERNAME_PREFIX) \
+                .annotate(dialogue_count=Count('dialogues')).order_by('-dialogue_count', 'id').first()
+            if user is None:
+                raise CommandError('No dataset users, run generate_dataset first')
+            benchmark = Benchmark(user, dataset.PASSWORD)
+
+            routes = benchmark.get_routes()
+            names = endpoints.split(',') if endpoints else sorted(routes)
+            unknown = set(names) - set(routes)
+            if unknown:
+                raise CommandError(f'Unknown endpoints: {", ".join(sorted(unknown))}')
+
+            results = {}
+            # Events are only polled for the backlog, waiting for new ones would measure the timeout
+            with override_settings(EVENTS_LONG_POLL_TIMEOUT_SECONDS=0, EVENTS_SYNC_POLL_TIMEOUT_SECONDS=0,
+                                   METRICS_TOKEN=BENCH_METRICS_TOKEN):
+                for name in names:
+                    results[name] = dict(route=routes[name].route, **run_endpoint(routes[name], repeat, warmup))
+                    self.stdout.write(
+                        f'{name:>24}: p50 {results[name]["p50_ms"]:7.1f} ms, p95 {results[name]["p95_ms"]:7.1f} ms, '
+                        f'p99 {results[name]["p99_ms"]:7.1f} ms, {results[name]["throughput_rps"]:7.0f} req/s, '
+                        f'{results[name]["queries_mean"]:5.1f} queries'
+                    )
+            transaction.set_rollback(True)
+
+        if output:
+            with open(output, 'w') as file:
+                json.dump({
+                    'started_at': started_at.isoformat(),
+                    'database': connection.vendor,
+                    'django': django.get_version(),
+                    'dataset': dict(sizes, seed=options['seed'], existing=existing_dataset),
+                    'repeat': repeat,
+                    'endpoints': results,
+                }, file, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Results written to {output}'))
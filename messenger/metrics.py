@@ -0,0 +1,264 @@
+import asyncio
+import bisect
+import contextlib
+import contextvars
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from messenger import profiles
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+_current = contextvars.ContextVar('messenger_request_metrics', default=None)
+
+
+class RequestMetrics:
+    __slots__ = ('sql_count', 'sql_time', 'stages', 'active')
+
+    def __init__(self):
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.stages = {}
+        self.active = set()
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def __call__(self, execute, sql, params, many, context):
+        # Installed as a database execute wrapper
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_count += 1
+            self.sql_time += time.perf_counter() - start
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Adds the time spent in the block to the ``name`` stage of the current request.
+    Nested blocks of the same stage are counted once. Does nothing outside of a request.
+    """
+    metrics = _current.get()
+    if metrics is None or name in metrics.active:
+        yield
+        return
+
+    metrics.active.add(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.active.discard(name)
+        metrics.add(name, time.perf_counter() - start)
+
+
+@contextlib.contextmanager
+def capture_queries():
+    """
+    Counts queries of this thread's connections into the current request metrics.
+    Async views running database work in other threads wrap it with this as well.
+    """
+    request_metrics = _current.get()
+    if request_metrics is None:
+        yield
+        return
+
+    with contextlib.ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(request_metrics))
+        yield
+
+
+def add_stage_time(name, seconds):
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.add(name, seconds)
+
+
+class Histogram:
+    def __init__(self, name, description, labels, buckets):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        # Label values -> [per bucket counts (not cumulative), sum, count]
+        self.values = {}
+
+    def observe(self, label_values, value):
+        entry = self.values.get(label_values)
+        if entry is None:
+            entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def render(self):
+        yield f'# HELP {self.name} {self.description}'
+        yield f'# TYPE {self.name} histogram'
+        for label_values, (counts, total, count) in sorted(self.values.items()):
+            labels = format_labels(self.labels, label_values)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+            yield f'{self.name}_sum{{{labels}}} {total}'
+            yield f'{self.name}_count{{{labels}}} {count}'
+
+
+class Counter:
+    def __init__(self, name, description, labels):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, label_values, value=1):
+        self.values[label_values] = self.values.get(label_values, 0) + value
+
+    def render(self):
+        yield f'# HELP {self.name} {self.description}'
+        yield f'# TYPE {self.name} counter'
+        for label_values, value in sorted(self.values.items()):
+            yield f'{self.name}{{{format_labels(self.labels, label_values)}}} {value}'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names, values):
+    return ','.join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values))
+
+
+class Registry:
+    """
+    Aggregated metrics of this process. Every worker process of a deployment has its own registry,
+    so Prometheus should scrape workers separately or the numbers have to be summed up.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = Counter('messenger_requests_total', 'Requests by view, method and status.',
+                                ('view', 'method', 'status'))
+        self.duration = Histogram('messenger_request_duration_seconds', 'Request latency by view.',
+                                  ('view', 'method'), LATENCY_BUCKETS)
+        self.sql_queries = Histogram('messenger_request_sql_queries', 'SQL queries per request by view.',
+                                     ('view', 'method'), QUERY_COUNT_BUCKETS)
+        self.sql_duration = Histogram('messenger_request_sql_duration_seconds', 'SQL time per request by view.',
+                                      ('view', 'method'), LATENCY_BUCKETS)
+        self.stages = Histogram('messenger_request_stage_duration_seconds',
+                                'Time per request spent in serialization, rendering and image processing.',
+                                ('view', 'method', 'stage'), LATENCY_BUCKETS)
+
+    def observe(self, view, method, status, duration, request_metrics):
+        labels = (view, method)
+        with self.lock:
+            self.requests.inc((view, method, str(status)))
+            self.duration.observe(labels, duration)
+            self.sql_queries.observe(labels, request_metrics.sql_count)
+            self.sql_duration.observe(labels, request_metrics.sql_time)
+            for name, seconds in request_metrics.stages.items():
+                self.stages.observe((view, method, name), seconds)
+
+    def render(self):
+        with self.lock:
+            lines = []
+            for metric in (self.requests, self.duration, self.sql_queries, self.sql_duration, self.stages):
+                lines.extend(metric.render())
+
+        profile_stats = profiles.get_stats()
+        lines.extend([
+            '# HELP messenger_profile_cache_hits_total Rendered profiles served from the cache.',
+            '# TYPE messenger_profile_cache_hits_total counter',
+            f'messenger_profile_cache_hits_total {profile_stats["hits"]}',
+            '# HELP messenger_profile_cache_misses_total Rendered profiles missing in the cache.',
+            '# TYPE messenger_profile_cache_misses_total counter',
+            f'messenger_profile_cache_misses_total {profile_stats["misses"]}',
+        ])
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def get_view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    view_class = getattr(match.func, 'view_class', None)
+    return view_class.__name__ if view_class is not None else match.func.__name__
+
+
+def format_server_timing(duration, request_metrics):
+    entries = [f'total;dur={duration * 1000:.1f}',
+               f'sql;dur={request_metrics.sql_time * 1000:.1f};desc="{request_metrics.sql_count} queries"']
+    entries.extend(f'{name};dur={seconds * 1000:.1f}' for name, seconds in request_metrics.stages.items())
+    return ', '.join(entries)
+
+
+class MetricsMiddleware:
+    """
+    Records latency, SQL query count and time, and stage timings of every request into ``registry``.
+    Should be the first middleware, so that the time of the other ones is included.
+    With ``METRICS_SERVER_TIMING`` the timings of a request are also sent in the ``Server-Timing`` header.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Same switch as MiddlewareMixin does, so that async requests don't take a thread
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+
+        request_metrics = RequestMetrics()
+        token = _current.set(request_metrics)
+        start = time.perf_counter()
+        try:
+            with capture_queries():
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, time.perf_counter() - start, request_metrics)
+
+    async def __acall__(self, request):
+        request_metrics = RequestMetrics()
+        token = _current.set(request_metrics)
+        start = time.perf_counter()
+        # Sync views and middleware of the request run in its thread, their queries are counted there
+        queries = contextlib.ExitStack()
+        try:
+            await sync_to_async(queries.enter_context, thread_sensitive=True)(capture_queries())
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(queries.close, thread_sensitive=True)()
+            _current.reset(token)
+        return self.finish(request, response, time.perf_counter() - start, request_metrics)
+
+    def finish(self, request, response, duration, request_metrics):
+        registry.observe(get_view_name(request), request.method, response.status_code, duration, request_metrics)
+        if settings.METRICS_SERVER_TIMING:
+            response['Server-Timing'] = format_server_timing(duration, request_metrics)
+        return response
+
+    def process_template_response(self, request, response):
+        # Called right before a DRF response is rendered, the callback runs right after it
+        request_metrics = _current.get()
+        if request_metrics is not None:
+            start = time.perf_counter()
+            response.add_post_render_callback(lambda _: request_metrics.add('render', time.perf_counter() - start))
+        return response
@@ -0,0 +1,17 @@
+# Generated by Django 4.0.2 on 2026-10-18 07:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0010_userinfo'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['dialogue', 'created_at', 'id'], name='message_dialogue_created_idx'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 4.0.2 on 2026-10-18 07:20
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0011_message_dialogue_created_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='picturev2',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
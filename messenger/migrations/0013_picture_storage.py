@@ -0,0 +1,23 @@
+# Generated by Django 4.0.2 on 2026-10-18 07:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0012_picturev2_created_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='picturev2',
+            name='storage',
+            field=models.CharField(default='database', max_length=32),
+        ),
+        migrations.AlterField(
+            model_name='picturev2',
+            name='data',
+            field=models.BinaryField(blank=True, default=b'', max_length=1048576),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.0.2 on 2026-10-18 07:30
+
+from django.db import migrations
+from django.db.models import Count
+
+
+def merge_duplicate_pictures(apps, schema_editor):
+    PictureV2 = apps.get_model('messenger', 'PictureV2')
+    Message = apps.get_model('messenger', 'Message')
+    UserInfo = apps.get_model('messenger', 'UserInfo')
+
+    duplicated = PictureV2.objects.values('sha256').annotate(copies=Count('uuid')).filter(copies__gt=1)
+    for sha256 in duplicated.values_list('sha256', flat=True):
+        uuids = list(PictureV2.objects.filter(sha256=sha256).order_by('created_at', 'uuid').values_list('uuid', flat=True))
+        kept, duplicates = uuids[0], uuids[1:]
+        Message.objects.filter(picture__in=duplicates).update(picture=kept)
+        UserInfo.objects.filter(avatar__in=duplicates).update(avatar=kept)
+        PictureV2.objects.filter(uuid__in=duplicates).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0013_picture_storage'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_pictures, migrations.RunPython.noop),
+    ]
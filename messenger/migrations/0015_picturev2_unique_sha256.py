@@ -0,0 +1,18 @@
+# Generated by Django 4.0.2 on 2026-10-18 07:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0014_merge_duplicate_pictures'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='picturev2',
+            name='sha256',
+            field=models.CharField(max_length=64, unique=True),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.0.2 on 2026-10-18 07:08
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0015_picturev2_unique_sha256'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PictureRendition',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('size', models.PositiveIntegerField()),
+                ('original', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='renditions', to='messenger.picturev2')),
+                ('picture', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='messenger.picturev2')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='picturerendition',
+            constraint=models.UniqueConstraint(fields=('original', 'size'), name='unique_picture_rendition'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.0.2 on 2026-10-18 07:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0016_picturerendition'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='dialogue',
+            index=models.Index(fields=['updated_at', 'id'], name='dialogue_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['dialogue', 'edited_at', 'id'], name='message_dialogue_edited_idx'),
+        ),
+    ]
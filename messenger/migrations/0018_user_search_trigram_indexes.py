@@ -0,0 +1,40 @@
+# Generated by Django 4.0.2 on 2026-10-18 08:10
+
+from django.conf import settings
+from django.db import migrations
+
+SEARCH_COLUMNS = ('username', 'first_name', 'last_name')
+
+
+def index_name(column):
+    return f'messenger_user_{column}_trgm'
+
+
+def create_trigram_indexes(apps, schema_editor):
+    # icontains compiles to UPPER("column"::text) LIKE ... on PostgreSQL, the indexes match that expression
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    table = schema_editor.quote_name(apps.get_model(settings.AUTH_USER_MODEL)._meta.db_table)
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for column in SEARCH_COLUMNS:
+        schema_editor.execute(f'CREATE INDEX IF NOT EXISTS {index_name(column)} ON {table} '
+                              f'USING gin ((UPPER({schema_editor.quote_name(column)}::text)) gin_trgm_ops)')
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for column in SEARCH_COLUMNS:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {index_name(column)}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('messenger', '0017_sync_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.0.2 on 2026-10-18 08:30
+
+from django.db import migrations
+
+
+def backfill_read_states(apps, schema_editor):
+    # There was no read state before, so everything that exists is considered read
+    Dialogue = apps.get_model('messenger', 'Dialogue')
+    DialogueReadState = apps.get_model('messenger', 'DialogueReadState')
+
+    for dialogue in Dialogue.objects.iterator(chunk_size=500):
+        last_message = dialogue.messages.order_by('-created_at', '-id').first()
+        DialogueReadState.objects.bulk_create([
+            DialogueReadState(user=user, dialogue=dialogue, last_read_message=last_message)
+            for user in dialogue.users.all()
+        ], ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0019_dialoguereadstate'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_read_states, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.0.2 on 2026-10-18 07:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0020_backfill_dialogue_read_states'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dialogue',
+            name='last_message',
+            field=models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='messenger.message'),
+        ),
+    ]
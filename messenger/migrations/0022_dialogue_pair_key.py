@@ -0,0 +1,30 @@
+# Generated by Django 4.0.2 on 2026-10-18 07:15
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('messenger', '0021_dialogue_last_message'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dialogue',
+            name='pair_high_user',
+            field=models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='dialogue',
+            name='pair_low_user',
+            field=models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='dialogue',
+            constraint=models.UniqueConstraint(fields=('pair_low_user', 'pair_high_user'), name='unique_tetatet_pair'),
+        ),
+    ]
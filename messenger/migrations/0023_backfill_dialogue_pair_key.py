@@ -0,0 +1,39 @@
+# Generated by Django 4.0.2 on 2026-10-18 07:16
+
+import collections
+
+from django.db import migrations
+
+
+def backfill_pair_keys(apps, schema_editor):
+    Dialogue = apps.get_model('messenger', 'Dialogue')
+
+    members = collections.defaultdict(list)
+    memberships = Dialogue.users.through.objects \
+        .filter(dialogue__is_tetatet=True) \
+        .order_by('dialogue_id') \
+        .values_list('dialogue_id', 'user_id')
+    for dialogue_id, user_id in memberships.iterator(chunk_size=2000):
+        members[dialogue_id].append(user_id)
+
+    # Duplicated pairs created before the constraint keep the oldest dialogue keyed
+    seen = set()
+    for dialogue_id, user_ids in sorted(members.items()):
+        if len(user_ids) != 2:
+            continue
+        key = tuple(sorted(user_ids))
+        if key in seen:
+            continue
+        seen.add(key)
+        Dialogue.objects.filter(id=dialogue_id).update(pair_low_user_id=key[0], pair_high_user_id=key[1])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0022_dialogue_pair_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_pair_keys, migrations.RunPython.noop),
+    ]
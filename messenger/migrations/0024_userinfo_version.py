@@ -0,0 +1,18 @@
+# Generated by Django 4.0.2 on 2026-10-18 07:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0023_backfill_dialogue_pair_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userinfo',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
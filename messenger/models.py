@@ -6,6 +6,26 @@ class Dialogue(models.Model):
     users = models.ManyToManyField(User, related_name='dialogues')
     updated_at = models.DateTimeField(auto_now_add=True)
     is_tetatet = models.BooleanField(default=False)
+    last_message = models.ForeignKey('Message', on_delete=models.SET_NULL, related_name='+',
+                                     blank=True, null=True, default=None)
+    # Canonical (lower id, higher id) key of a tete-a-tete dialogue
+    pair_low_user = models.ForeignKey(User, on_delete=models.SET_NULL, related_name='+',
+                                      blank=True, null=True, default=None)
+    pair_high_user = models.ForeignKey(User, on_delete=models.SET_NULL, related_name='+',
+                                       blank=True, null=True, default=None)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['updated_at', 'id'], name='dialogue_updated_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['pair_low_user', 'pair_high_user'], name='unique_tetatet_pair'),
+        ]
+
+    @staticmethod
+    def pair_key(first_user, second_user):
+        low, high = sorted((first_user.id, second_user.id))
+        return {'pair_low_user_id': low, 'pair_high_user_id': high}
 
     def __str__(self):
         return 'Dialogue ' + str([user.username for user in self.users.all()])
@@ -13,13 +33,29 @@ class Dialogue(models.Model):
 
 class PictureV2(models.Model):
     uuid = models.UUIDField(primary_key=True)
-    data = models.BinaryField(max_length=1024 * 1024)
-    sha256 = models.CharField(max_length=64)
+    data = models.BinaryField(max_length=1024 * 1024, blank=True, default=b'')
+    sha256 = models.CharField(max_length=64, unique=True)
+    storage = models.CharField(max_length=32, default='database')
+    created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
         return f'Picture with id {self.pk}'
 
 
+class PictureRendition(models.Model):
+    original = models.ForeignKey(PictureV2, on_delete=models.CASCADE, related_name='renditions')
+    size = models.PositiveIntegerField()
+    picture = models.ForeignKey(PictureV2, on_delete=models.CASCADE, related_name='+')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['original', 'size'], name='unique_picture_rendition'),
+        ]
+
+    def __str__(self):
+        return f'Rendition {self.size}px of picture with id {self.original_id}'
+
+
 class Message(models.Model):
     dialogue = models.ForeignKey(Dialogue, on_delete=models.CASCADE, related_name='messages')
     from_user = models.ForeignKey(User, on_delete=models.SET_NULL, related_name='messages', blank=True, null=True)
@@ -28,13 +64,59 @@ class Message(models.Model):
     edited_at = models.DateTimeField(auto_now=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['dialogue', 'created_at', 'id'], name='message_dialogue_created_idx'),
+            models.Index(fields=['dialogue', 'edited_at', 'id'], name='message_dialogue_edited_idx'),
+        ]
+
     def __str__(self):
         return f'Message with id {self.pk} from {self.from_user.username} to dialogue {self.dialogue}'
 
 
+class ArchivedMessage(models.Model):
+    """
+    Message moved out of ``Message`` by the ``archive_messages`` command, keeping its id and timestamps.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    dialogue = models.ForeignKey(Dialogue, on_delete=models.CASCADE, related_name='archived_messages')
+    from_user = models.ForeignKey(User, on_delete=models.SET_NULL, related_name='+', blank=True, null=True)
+    picture = models.ForeignKey(PictureV2, on_delete=models.SET_NULL, related_name='+', blank=True, null=True)
+    is_edited = models.BooleanField(default=False)
+    edited_at = models.DateTimeField()
+    created_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['dialogue', 'created_at', 'id'], name='archived_dialogue_created_idx'),
+            models.Index(fields=['dialogue', 'edited_at', 'id'], name='archived_dialogue_edited_idx'),
+        ]
+
+    def __str__(self):
+        return f'Archived message with id {self.pk} in dialogue {self.dialogue_id}'
+
+
+class DialogueReadState(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='read_states')
+    dialogue = models.ForeignKey(Dialogue, on_delete=models.CASCADE, related_name='read_states')
+    last_read_message = models.ForeignKey(Message, on_delete=models.SET_NULL, related_name='+',
+                                          blank=True, null=True, default=None)
+    unread_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'dialogue'], name='unique_dialogue_read_state'),
+        ]
+
+    def __str__(self):
+        return f'Read state of user {self.user_id} in dialogue {self.dialogue_id}'
+
+
 class UserInfo(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='info')
     avatar = models.ForeignKey(PictureV2, on_delete=models.SET_NULL, blank=True, null=True, default=None)
+    # Bumped on every profile change, cached profiles are keyed by it
+    version = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return f'User info for user {self.user.username}'
@@ -1,4 +1,46 @@
+import base64
+import datetime
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+def encode_cursor(timestamp, pk):
+    value = f'{timestamp.isoformat()}|{pk}'
+    return base64.urlsafe_b64encode(value.encode('ascii')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        timestamp, pk = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('ascii').split('|')
+        timestamp = datetime.datetime.fromisoformat(timestamp)
+        if timezone.is_naive(timestamp):
+            timestamp = timezone.make_aware(timestamp, datetime.timezone.utc)
+        return timestamp, int(pk)
+    except (ValueError, UnicodeError):
+        raise NotFound('Invalid cursor')
+
+
+def get_value(instance, field):
+    """
+    Pages hold either model instances or ``values()`` rows.
+    """
+    if isinstance(instance, dict):
+        return instance['id' if field == 'pk' else field]
+    return getattr(instance, field)
+
+
+def filter_after(queryset, field, timestamp, pk):
+    return queryset.filter(Q(**{f'{field}__gt': timestamp}) | Q(**{field: timestamp, 'pk__gt': pk}))
+
+
+def filter_before(queryset, field, timestamp, pk):
+    return queryset.filter(Q(**{f'{field}__lt': timestamp}) | Q(**{field: timestamp, 'pk__lt': pk}))
 
 
 class DefaultPagination(PageNumberPagination):
@@ -6,3 +48,169 @@ class DefaultPagination(PageNumberPagination):
     page_query_param = 'page'
     page_size_query_param = 'page_size'
     max_page_size = 100
+
+
+def encode_sync_token(timestamp, pk, horizon, more):
+    value = f'{timestamp.isoformat()}|{pk}|{horizon.isoformat()}|{int(more)}'
+    return base64.urlsafe_b64encode(value.encode('ascii')).decode('ascii')
+
+
+def decode_sync_token(token):
+    try:
+        timestamp, pk, horizon, more = base64.urlsafe_b64decode(token.encode('ascii')).decode('ascii').split('|')
+        timestamp, horizon = (datetime.datetime.fromisoformat(value) for value in (timestamp, horizon))
+        return timestamp, int(pk), horizon, more == '1'
+    except (ValueError, UnicodeError):
+        # Tokens issued before the horizon was added
+        timestamp, pk = decode_cursor(token)
+        return timestamp, pk, timestamp - datetime.timedelta(seconds=settings.SYNC_OVERLAP_SECONDS), False
+
+
+class SyncPaginationMixin:
+    """
+    Passing ``since`` switches to delta sync: only objects whose ``sync_field`` moved after the sync token
+    are returned, oldest change first, together with the token to pass next time.
+    An empty ``since`` starts a full sync.
+
+    ``sync_field`` is set from the clock before the transaction commits, so a row may become visible
+    after a client synced past its timestamp. A new sync therefore scans again from the start of the
+    previous one less ``SYNC_OVERLAP_SECONDS`` (the horizon), if that is earlier than the last row.
+    Rows changed within the window can be returned twice, clients replace them by id.
+    Pages after the first one (``has_more``) continue right after the last row.
+    """
+    since_query_param = 'since'
+    sync_field = None
+
+    def is_sync_request(self, request):
+        return self.since_query_param in request.query_params
+
+    def paginate_sync_queryset(self, queryset, request):
+        self.request = request
+        page_size = self.get_page_size(request)
+        since = request.query_params.get(self.since_query_param)
+        # Everything before the horizon was committed when this sync started
+        horizon = timezone.now() - datetime.timedelta(seconds=settings.SYNC_OVERLAP_SECONDS)
+        if since:
+            timestamp, pk, previous_horizon, more = decode_sync_token(since)
+            if more:
+                horizon = previous_horizon
+            elif previous_horizon < timestamp:
+                timestamp, pk = previous_horizon, 0
+            queryset = filter_after(queryset, self.sync_field, timestamp, pk)
+
+        page = list(queryset.order_by(self.sync_field, 'pk')[:page_size + 1])
+        self.has_more = len(page) > page_size
+        self.page = page[:page_size]
+        if self.page:
+            self.sync_token = encode_sync_token(get_value(self.page[-1], self.sync_field),
+                                                get_value(self.page[-1], 'pk'), horizon, self.has_more)
+        elif since:
+            self.sync_token = since
+        else:
+            self.sync_token = encode_sync_token(horizon, 0, horizon, False)
+        return self.page
+
+    def get_sync_response(self, data):
+        return Response({
+            'results': data,
+            'since': self.sync_token,
+            'has_more': self.has_more,
+        })
+
+
+class DialoguePagination(SyncPaginationMixin, DefaultPagination):
+    sync_field = 'updated_at'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.sync_mode = self.is_sync_request(request)
+        if self.sync_mode:
+            return self.paginate_sync_queryset(queryset, request)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.sync_mode:
+            return self.get_sync_response(data)
+        return super().get_paginated_response(data)
+
+
+class MessagePagination(SyncPaginationMixin, DefaultPagination):
+    """
+    Page number pagination by default. Passing ``before`` or ``after`` switches to keyset
+    pagination over ``(created_at, id)``, which needs neither COUNT nor OFFSET.
+    An empty ``before`` starts from the newest message.
+    Pages are always ordered from newest to oldest.
+    Passing ``since`` switches to delta sync over ``edited_at``, see ``SyncPaginationMixin``.
+    """
+    before_query_param = 'before'
+    after_query_param = 'after'
+    timestamp_field = 'created_at'
+    sync_field = 'edited_at'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.sync_mode = self.is_sync_request(request)
+        if self.sync_mode:
+            self.cursor_mode = False
+            return self.paginate_sync_queryset(queryset, request)
+
+        self.cursor_mode = (self.before_query_param in request.query_params or
+                            self.after_query_param in request.query_params)
+        if not self.cursor_mode:
+            return super().paginate_queryset(queryset, request, view)
+
+        self.request = request
+        page_size = self.get_page_size(request)
+        before = request.query_params.get(self.before_query_param)
+        after = request.query_params.get(self.after_query_param)
+        field = self.timestamp_field
+
+        if after:
+            queryset = filter_after(queryset, field, *decode_cursor(after)).order_by(field, 'pk')
+        else:
+            if before:
+                queryset = filter_before(queryset, field, *decode_cursor(before))
+            queryset = queryset.order_by(f'-{field}', '-pk')
+
+        page = list(queryset[:page_size + 1])
+        has_more = len(page) > page_size
+        page = page[:page_size]
+        if after:
+            page.reverse()
+            self.has_newer, self.has_older = has_more, True
+        else:
+            self.has_newer, self.has_older = bool(before), has_more
+
+        self.page = page
+        return page
+
+    def get_cursor_link(self, query_param, instance):
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.page_query_param)
+        url = remove_query_param(url, self.before_query_param)
+        url = remove_query_param(url, self.after_query_param)
+        cursor = encode_cursor(get_value(instance, self.timestamp_field), get_value(instance, 'pk'))
+        return replace_query_param(url, query_param, cursor)
+
+    def get_next_link(self):
+        if not self.cursor_mode:
+            return super().get_next_link()
+        if not self.has_older or not self.page:
+            return None
+        return self.get_cursor_link(self.before_query_param, self.page[-1])
+
+    def get_previous_link(self):
+        if not self.cursor_mode:
+            return super().get_previous_link()
+        if not self.has_newer or not self.page:
+            return None
+        return self.get_cursor_link(self.after_query_param, self.page[0])
+
+    def get_paginated_response(self, data):
+        if self.sync_mode:
+            return self.get_sync_response(data)
+        if not self.cursor_mode:
+            return super().get_paginated_response(data)
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
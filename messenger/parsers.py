@@ -0,0 +1,64 @@
+"""
+Picture uploads are limited while the body is streamed in: a request whose ``Content-Length`` can't fit
+its pictures is rejected before anything is read, and a file is rejected as soon as it grows past
+``PICTURE_UPLOAD_MAX_BYTES``, so an oversized upload is never spooled in full.
+"""
+from django.conf import settings
+from django.core.files.uploadhandler import FileUploadHandler
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.parsers import MultiPartParser
+
+# Boundaries, part headers and form fields besides the pictures
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+
+class UploadTooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = 'Upload is too large.'
+    default_code = 'upload_too_large'
+
+
+class LimitedUploadHandler(FileUploadHandler):
+    """
+    Passes chunks on to the next handlers, counting the bytes of every file.
+    """
+
+    def __init__(self, request, max_file_bytes, max_files):
+        super().__init__(request)
+        self.max_file_bytes = max_file_bytes
+        self.max_files = max_files
+        self.file_bytes = 0
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        if content_length > self.max_file_bytes * self.max_files + MULTIPART_OVERHEAD_BYTES:
+            raise UploadTooLarge()
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.file_bytes = 0
+
+    def receive_data_chunk(self, raw_data, start):
+        self.file_bytes += len(raw_data)
+        if self.file_bytes > self.max_file_bytes:
+            raise UploadTooLarge()
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
+
+
+class PictureUploadParser(MultiPartParser):
+    def get_max_files(self):
+        return 1
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        request = parser_context['request']
+        request.upload_handlers.insert(0, LimitedUploadHandler(
+            request, settings.PICTURE_UPLOAD_MAX_BYTES, self.get_max_files()))
+        return super().parse(stream, media_type, parser_context)
+
+
+class PictureBatchUploadParser(PictureUploadParser):
+    def get_max_files(self):
+        return settings.MESSAGE_BATCH_MAX_PICTURES
@@ -0,0 +1,65 @@
+import hashlib
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
+
+_stats_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0}
+
+
+def get_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _count(hits, misses):
+    with _stats_lock:
+        _stats['hits'] += hits
+        _stats['misses'] += misses
+
+
+def get_cache_key(user, request):
+    """
+    Returns None for users without ``UserInfo``, their profiles are not cached.
+    Links in profiles are absolute, so the key depends on the scheme and host of the request.
+    """
+    try:
+        version = user.info.version
+    except ObjectDoesNotExist:
+        return None
+    origin = hashlib.md5(request.build_absolute_uri('/').encode()).hexdigest()[:8]
+    return f'messenger:profile:{user.pk}:{version}:{origin}'
+
+
+def get_profiles(users, request, render):
+    """
+    Read-through cache of rendered user profiles. Keys contain ``UserInfo.version``,
+    which is bumped on every profile change (see ``messenger.signals``), so stale entries are never read.
+    Profiles are also memoized per request, so a user repeated on a page is looked up once.
+    """
+    memo = getattr(request, '_profiles', None)
+    if memo is None:
+        memo = request._profiles = {}
+
+    keys = [get_cache_key(user, request) for user in users]
+    missing = {key for key in keys if key is not None and key not in memo}
+    if missing:
+        cached = cache.get_many(missing)
+        memo.update(cached)
+        _count(len(cached), len(missing) - len(cached))
+
+    rendered = {}
+    profiles = []
+    for user, key in zip(users, keys):
+        if key is None:
+            profiles.append(render(user))
+            continue
+        if key not in memo:
+            memo[key] = rendered[key] = render(user)
+        profiles.append(memo[key])
+
+    if rendered:
+        cache.set_many(rendered, settings.PROFILE_CACHE_TIMEOUT_SECONDS)
+    return profiles
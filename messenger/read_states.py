@@ -0,0 +1,75 @@
+from django.db.models import F
+
+from messenger import archive, models, pagination
+
+
+def create_read_states(dialogue, users):
+    models.DialogueReadState.objects.bulk_create([
+        models.DialogueReadState(user=user, dialogue=dialogue) for user in users
+    ], ignore_conflicts=True)
+
+
+def record_new_messages(dialogue, sender, last_message, user_ids, count=1):
+    """
+    Bumps unread counters of all members except the sender, who has read everything up to ``last_message``.
+    Has to be called in the transaction that created the messages.
+    """
+    recipient_ids = [user_id for user_id in user_ids if user_id != sender.id]
+    updated = models.DialogueReadState.objects \
+        .filter(dialogue=dialogue, user_id__in=recipient_ids) \
+        .update(unread_count=F('unread_count') + count)
+    if updated != len(recipient_ids):
+        models.DialogueReadState.objects.bulk_create([
+            models.DialogueReadState(user_id=user_id, dialogue=dialogue, unread_count=count)
+            for user_id in recipient_ids
+        ], ignore_conflicts=True)
+
+    models.DialogueReadState.objects.update_or_create(
+        user=sender, dialogue=dialogue,
+        defaults={'last_read_message': last_message, 'unread_count': 0},
+    )
+
+
+def get_read_marker(dialogue, message_id):
+    """
+    Returns the message of ``dialogue`` to move a read marker to for ``message_id``, None if there is none.
+    Read markers reference hot messages, so an archived message is resolved to the first hot one after it,
+    which exists as the last message of a dialogue is never archived.
+    """
+    message = dialogue.messages.filter(pk=message_id).first()
+    if message is not None:
+        return message
+    archived = models.ArchivedMessage.objects.filter(dialogue=dialogue, pk=message_id).first()
+    if archived is None:
+        return None
+    return pagination.filter_after(dialogue.messages, 'created_at', archived.created_at, archived.id) \
+        .order_by('created_at', 'id').first()
+
+
+def mark_read(user, dialogue, message):
+    """
+    Moves the read marker of ``user`` forward to ``message`` and recounts messages after it.
+    Returns the read state.
+    """
+    # PostgreSQL can't lock the nullable side of the outer join to the marker, only the read state is locked
+    read_state, _ = models.DialogueReadState.objects.select_for_update(of=('self',)) \
+        .select_related('last_read_message').get_or_create(user=user, dialogue=dialogue)
+
+    # Locked so that ``archive.archive_batch`` doesn't move the new marker away, which would clear it
+    while not models.Message.objects.select_for_update().filter(id=message.id).exists():
+        message = get_read_marker(dialogue, message.id)
+        if message is None:
+            return read_state
+
+    current = read_state.last_read_message
+    if current is not None and (current.created_at, current.id) >= (message.created_at, message.id):
+        return read_state
+
+    read_state.last_read_message = message
+    # Messages kept hot as read markers may be followed by archived ones
+    newer_messages = archive.MessageHistory(models.Message.objects.filter(dialogue=dialogue),
+                                            models.ArchivedMessage.objects.filter(dialogue=dialogue), ['id'])
+    newer_messages = pagination.filter_after(newer_messages, 'created_at', message.created_at, message.id)
+    read_state.unread_count = newer_messages.exclude(from_user=user).count()
+    read_state.save(update_fields=['last_read_message', 'unread_count'])
+    return read_state
@@ -0,0 +1,127 @@
+"""
+Read replica routing. Views with ``ReplicaReadsMixin`` read from a random alias of ``DATABASE_REPLICAS``
+on safe requests, everything else reads from and writes to ``default``. A user who wrote to the database
+reads from ``default`` for ``REPLICA_STICKY_SECONDS`` afterwards, so they see their own writes
+however far the replicas lag behind. The sticky window is kept in the cache, which has to be shared
+by all worker processes, like Redis with ``REDIS_URL``.
+"""
+import asyncio
+import contextvars
+import random
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework.permissions import SAFE_METHODS
+
+_state = contextvars.ContextVar('messenger_replica_state', default=None)
+
+
+class RequestState:
+    """
+    Shared by reference with the copies of the request context that async views run their database work in.
+    """
+    __slots__ = ('read_alias', 'wrote')
+
+    def __init__(self):
+        self.read_alias = None
+        self.wrote = False
+
+
+def get_sticky_key(user_id):
+    return f'messenger:replica-sticky:{user_id}'
+
+
+def is_sticky(user_id):
+    return cache.get(get_sticky_key(user_id)) is not None
+
+
+def make_sticky(user_id):
+    cache.set(get_sticky_key(user_id), True, settings.REPLICA_STICKY_SECONDS)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is None or state.wrote:
+            return None
+        return state.read_alias
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get the schema through replication
+        return db == DEFAULT_DB_ALIAS
+
+
+class ReplicaMiddleware:
+    """
+    Tracks database writes of a request and makes its user sticky to the primary after one.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.DATABASE_REPLICAS:
+            raise MiddlewareNotUsed()
+        # With a cache per process, the next request of a user who wrote may go to a worker that reads from a replica
+        if isinstance(caches['default'], (LocMemCache, DummyCache)):
+            raise ImproperlyConfigured('DATABASE_REPLICAS needs a cache shared by all workers, set REDIS_URL')
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+
+        state = RequestState()
+        token = _state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+        self.finish(request, state)
+        return response
+
+    async def __acall__(self, request):
+        state = RequestState()
+        token = _state.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _state.reset(token)
+        self.finish(request, state)
+        return response
+
+    def finish(self, request, state):
+        # DRF puts the user it authenticated on the Django request
+        user = getattr(request, 'user', None)
+        if state.wrote and user is not None and user.is_authenticated:
+            make_sticky(user.id)
+
+
+class ReplicaReadsMixin:
+    """
+    Reads of safe requests go to a replica unless the user wrote recently.
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        state = _state.get()
+        if state is None or request.method not in SAFE_METHODS:
+            return
+        if request.user.is_authenticated and is_sticky(request.user.id):
+            return
+        state.read_alias = random.choice(settings.DATABASE_REPLICAS)
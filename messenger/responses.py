@@ -0,0 +1,73 @@
+import re
+
+from django.http import HttpResponse
+from django.utils.http import http_date
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+_range_re = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class UnsatisfiableRange(Exception):
+    pass
+
+
+def parse_range_header(header, size):
+    """
+    Returns inclusive ``(start, end)`` for a single byte range or None if the header should be ignored.
+    Multiple ranges are not supported and are answered with the full content.
+    """
+    match = _range_re.match(header.strip()) if header else None
+    if match is None:
+        return None
+
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        suffix_length = int(end)
+        if suffix_length == 0:
+            raise UnsatisfiableRange()
+        return max(size - suffix_length, 0), size - 1
+
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start > end:
+        raise UnsatisfiableRange()
+    return start, end
+
+
+def get_requested_range(request, size, etag):
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range is not None and if_range.strip() != etag:
+        return None
+    return parse_range_header(request.META.get('HTTP_RANGE'), size)
+
+
+def create_unsatisfiable_range_response(size):
+    response = HttpResponse(status=416)
+    response['Content-Range'] = f'bytes */{size}'
+    return response
+
+
+def create_byte_range_response(request, data, content_type, etag):
+    try:
+        byte_range = get_requested_range(request, len(data), etag)
+    except UnsatisfiableRange:
+        return create_unsatisfiable_range_response(len(data))
+
+    if byte_range is None:
+        response = HttpResponse(data, content_type=content_type)
+    else:
+        start, end = byte_range
+        response = HttpResponse(data[start:end + 1], content_type=content_type, status=206)
+        response['Content-Range'] = f'bytes {start}-{end}/{len(data)}'
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def set_immutable_cache_headers(response, etag, last_modified):
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified.timestamp())
+    response['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
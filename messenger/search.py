@@ -0,0 +1,44 @@
+from django.contrib.auth.models import User
+from django.db.models import Value, Q, When, Case
+from django.db.models.functions import StrIndex, Least
+
+
+def suggest_users(name_substring):
+    """
+    Users whose username, first or last name contain ``name_substring``, best match first.
+    A substring with a space also matches first name and last name separately.
+    Matches are ranked by the earliest match position, then by username.
+
+    On PostgreSQL the ``icontains`` filters are served by trigram indexes (see migration
+    ``0018_user_search_trigram_indexes``), so ranking only runs over matched rows.
+    """
+    fields = [
+        ('username', name_substring, 'default'),
+        ('first_name', name_substring, 'default'),
+        ('last_name', name_substring, 'default'),
+    ]
+    if ' ' in name_substring:
+        fields.append(('first_name', name_substring[:name_substring.index(' ')].strip(), 'space'))
+        fields.append(('last_name', name_substring[name_substring.index(' '):].strip(), 'space'))
+
+    str_index_expressions = {}
+    search_index_expressions = []
+    for field_name, substring, meta_description in fields:
+        index_expression = StrIndex(field_name, Value(substring))
+        str_index_expression_name = f'{field_name}_{meta_description}'
+        str_index_expressions[str_index_expression_name] = index_expression
+        expression = Case(When(**{str_index_expression_name: 0}, then=10 ** 9), default=str_index_expression_name)
+        search_index_expressions.append(expression)
+
+    query_condition = (Q(username__icontains=name_substring) |
+                       Q(first_name__icontains=name_substring) |
+                       Q(last_name__icontains=name_substring))
+    if ' ' in name_substring:
+        query_condition = (query_condition |
+                           Q(first_name__icontains=name_substring[:name_substring.index(' ')].strip()) &
+                           Q(last_name__icontains=name_substring[name_substring.index(' '):].strip()))
+
+    return User.objects.filter(query_condition) \
+        .annotate(**str_index_expressions) \
+        .annotate(search_index=Least(*search_index_expressions)) \
+        .order_by('search_index', 'username')
@@ -1,16 +1,16 @@
 import hashlib
-import io
 import uuid
 
-import PIL.Image
+from django.conf import settings
 from django.contrib.auth import password_validation
 from django.contrib.auth.models import User
 from django.contrib.auth.validators import UnicodeUsernameValidator
-from django.urls import reverse
+from django.db import IntegrityError, transaction
+from django.db.models import Manager
 from django.utils.translation import gettext_lazy as _
 from rest_framework import serializers
 
-from messenger import models
+from messenger import imaging, metrics, models, storage, read_states, profiles, representations
 
 
 class RegisterCredentialsSerializer(serializers.ModelSerializer):
@@ -37,13 +37,33 @@ class AuthCredentialsSerializer(serializers.ModelSerializer):
 
 class PictureLinkSerializer(serializers.ModelSerializer):
     link = serializers.SerializerMethodField('serialize_link')
+    renditions = serializers.SerializerMethodField('serialize_renditions')
 
     def serialize_link(self, picture):
-        return self.context['request'].build_absolute_uri(reverse('picture', args=[picture.uuid]))
+        return representations.get_picture_link(self.context['request'], picture.uuid)
+
+    def serialize_renditions(self, picture):
+        link = self.serialize_link(picture)
+        return {str(size): f'{link}?size={size}' for size in settings.PICTURE_RENDITION_SIZES}
 
     class Meta:
         model = models.PictureV2
-        fields = ('link',)
+        fields = ('link', 'renditions')
+
+
+class TimedDataMixin:
+    """
+    Records building ``data`` as the ``serialize`` stage of the request metrics.
+    """
+
+    @property
+    def data(self):
+        with metrics.stage('serialize'):
+            return super().data
+
+
+class TimedListSerializer(TimedDataMixin, serializers.ListSerializer):
+    pass
 
 
 class UserInfoResponseSerializer(serializers.ModelSerializer):
@@ -54,16 +74,42 @@ class UserInfoResponseSerializer(serializers.ModelSerializer):
         fields = ('avatar',)
 
 
-class UserResponseSerializer(serializers.ModelSerializer):
+class UserListResponseSerializer(TimedDataMixin, serializers.ListSerializer):
+    def to_representation(self, data):
+        users = data.all() if isinstance(data, Manager) else data
+        return profiles.get_profiles(list(users), self.context['request'], self.child.render)
+
+
+class UserResponseSerializer(TimedDataMixin, serializers.ModelSerializer):
     info = UserInfoResponseSerializer()
 
+    def render(self, instance):
+        return super().to_representation(instance)
+
+    def to_representation(self, instance):
+        return profiles.get_profiles([instance], self.context['request'], self.render)[0]
+
     class Meta:
         model = User
         fields = ('username', 'first_name', 'last_name', 'info')
+        list_serializer_class = UserListResponseSerializer
 
 
-class DialogueResponseSerializer(serializers.ModelSerializer):
+class MessageResponseSerializer(TimedDataMixin, serializers.ModelSerializer):
+    from_user = UserResponseSerializer()
+    picture = PictureLinkSerializer()
+
+    class Meta:
+        model = models.Message
+        fields = ('id', 'from_user', 'picture', 'is_edited', 'edited_at', 'created_at')
+        list_serializer_class = TimedListSerializer
+
+
+class DialogueResponseSerializer(TimedDataMixin, serializers.ModelSerializer):
     users = UserResponseSerializer(many=True)
+    unread_count = serializers.IntegerField(read_only=True)
+    last_read_message = serializers.IntegerField(read_only=True, allow_null=True)
+    last_message = MessageResponseSerializer(read_only=True, allow_null=True)
 
     def to_representation(self, instance):
         response = super().to_representation(instance)
@@ -82,16 +128,16 @@ class DialogueResponseSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = models.Dialogue
-        fields = ('users', 'id', 'is_tetatet', 'updated_at')
+        fields = ('users', 'id', 'is_tetatet', 'updated_at', 'unread_count', 'last_read_message', 'last_message')
+        list_serializer_class = TimedListSerializer
 
 
-class MessageResponseSerializer(serializers.ModelSerializer):
-    from_user = UserResponseSerializer()
-    picture = PictureLinkSerializer()
+def get_upload_options():
+    return settings.PICTURE_RENDITION_SIZES, settings.PICTURE_MAX_DIMENSION, settings.PICTURE_MAX_PIXELS
 
-    class Meta:
-        model = models.Message
-        fields = ('id', 'from_user', 'picture', 'is_edited', 'edited_at', 'created_at')
+
+def get_too_large_error():
+    return f'At most {settings.PICTURE_MAX_PIXELS} pixels are allowed'
 
 
 class PictureSerializer:
@@ -99,6 +145,7 @@ class PictureSerializer:
         self.data = data
         self.cleaned_data = None
         self.errors = None
+        self.timings = {}
 
     def is_valid(self):
         self.cleaned_data = {}
@@ -107,27 +154,117 @@ class PictureSerializer:
             return False
 
         try:
-            image = PIL.Image.open(self.data['data'].file)
+            result = imaging.run_in_pool(imaging.process_upload, imaging.get_upload_source(self.data['data']),
+                                         *get_upload_options())
+        except imaging.ImageTooLarge:
+            self.errors = {'data': get_too_large_error()}
+            return False
         except IOError:
             self.errors = {'data': 'Not an image'}
             return False
 
-        img_byte_arr = io.BytesIO()
-        image.convert('RGB').save(img_byte_arr, format='JPEG')
-        self.cleaned_data['data'] = img_byte_arr.getvalue()
+        self.set_result(result)
         return True
 
+    def set_result(self, result):
+        self.cleaned_data = {
+            'data': result['data'],
+            'sha256': result['sha256'],
+            'renditions': result['renditions'],
+        }
+        self.timings = result['timings']
+
     def save(self):
         assert self.cleaned_data is not None, 'Not validated'
 
-        data = self.cleaned_data['data']
+        picture, created = save_picture_data(self.cleaned_data['data'], self.cleaned_data.get('sha256'))
+        if created:
+            save_renditions(picture, self.cleaned_data.get('renditions', {}))
+        return picture
+
+
+class PictureBatchSerializer:
+    """
+    Validates every picture of the ``data`` list separately, processing them in parallel.
+    ``items`` holds a validated ``PictureSerializer`` for each picture, ``errors`` is set
+    only when the batch as a whole is invalid.
+    """
+
+    def __init__(self, data):
+        self.files = data.getlist('data') if hasattr(data, 'getlist') else data.get('data', [])
+        self.items = None
+        self.errors = None
+
+    def is_valid(self):
+        if not self.files:
+            self.errors = {'data': 'Required'}
+            return False
+        if len(self.files) > settings.MESSAGE_BATCH_MAX_PICTURES:
+            self.errors = {'data': f'At most {settings.MESSAGE_BATCH_MAX_PICTURES} pictures are allowed'}
+            return False
+
+        outcomes = imaging.run_many_in_pool(imaging.process_upload, [
+            (imaging.get_upload_source(file), *get_upload_options()) for file in self.files
+        ])
+
+        self.items = []
+        for file, (result, error) in zip(self.files, outcomes):
+            item = PictureSerializer(data={'data': file})
+            if isinstance(error, imaging.ImageTooLarge):
+                item.errors = {'data': get_too_large_error()}
+            elif isinstance(error, IOError):
+                item.errors = {'data': 'Not an image'}
+            elif error is not None:
+                raise error
+            else:
+                item.set_result(result)
+            self.items.append(item)
+        return True
+
+
+def save_picture_data(data, sha256=None):
+    if sha256 is None:
         sha256 = hashlib.sha256(data).hexdigest()
-        existing = models.PictureV2.objects.filter(sha256=sha256)
+    existing = models.PictureV2.objects.defer('data').filter(sha256=sha256).first()
+    if existing is not None:
+        return existing, False
+
+    picture_storage = storage.get_storage()
+    fields = picture_storage.save(sha256, data)
+    try:
+        with transaction.atomic():
+            return models.PictureV2.objects.create(uuid=uuid.uuid4(), sha256=sha256,
+                                                   storage=picture_storage.name, **fields), True
+    except IntegrityError:
+        # Concurrent upload of the same picture won the race
+        return models.PictureV2.objects.defer('data').get(sha256=sha256), False
+
+
+def save_renditions(picture, renditions):
+    models.PictureRendition.objects.bulk_create([
+        models.PictureRendition(original=picture, size=size, picture=save_picture_data(data)[0])
+        for size, data in renditions.items()
+    ], ignore_conflicts=True)
+
+
+class BulkUserLookupSerializer(serializers.Serializer):
+    usernames = serializers.ListField(
+        child=serializers.CharField(max_length=150, validators=[UnicodeUsernameValidator()]),
+        required=False, default=list,
+    )
+    ids = serializers.ListField(child=serializers.IntegerField(), required=False, default=list)
+
+    def validate(self, attrs):
+        requested = len(attrs['usernames']) + len(attrs['ids'])
+        if requested == 0:
+            raise serializers.ValidationError(detail="Nothing to look up")
+        if requested > settings.USER_BULK_LOOKUP_MAX:
+            raise serializers.ValidationError(detail=f"At most {settings.USER_BULK_LOOKUP_MAX} users can be looked up")
+        return attrs
 
-        for picture in existing:
-            if bytes(picture.data) == data:
-                return picture
-        return models.PictureV2.objects.create(uuid=uuid.uuid4(), data=self.cleaned_data['data'], sha256=sha256)
+
+class MarkReadSerializer(serializers.Serializer):
+    message = serializers.IntegerField(required=False, help_text=_('Last read message id, the latest by default.'))
 
 
 class PairDialogueCreateSerializer(serializers.Serializer):
@@ -147,7 +284,7 @@ class PairDialogueCreateSerializer(serializers.Serializer):
         if originator == user_matched:
             raise serializers.ValidationError(detail=f"Self dialogues are prohibited")
 
-        if models.Dialogue.objects.filter(users=user_matched, is_tetatet=True).filter(users=originator).exists():
+        if models.Dialogue.objects.filter(**models.Dialogue.pair_key(originator, user_matched)).exists():
             raise serializers.ValidationError(detail="Dialogue already exists")
 
         return attrs
@@ -155,10 +292,17 @@ class PairDialogueCreateSerializer(serializers.Serializer):
     def create(self, validated_data):
         with_user = User.objects.filter(username=validated_data['with_user']).first()
         originator = self.context['request'].user
-        dialogue = models.Dialogue.objects.create(
-            is_tetatet=True,
-        )
+        try:
+            with transaction.atomic():
+                dialogue = models.Dialogue.objects.create(
+                    is_tetatet=True,
+                    **models.Dialogue.pair_key(originator, with_user),
+                )
+        except IntegrityError:
+            # Concurrent request created the same dialogue
+            raise serializers.ValidationError(detail="Dialogue already exists")
         dialogue.users.set((originator, with_user))
+        read_states.create_read_states(dialogue, (originator, with_user))
 
         return {
             'with_user': with_user,
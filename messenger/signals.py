@@ -0,0 +1,42 @@
+from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_out
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from messenger import models, authentication
+
+
+def bump_profile_version(user_id):
+    models.UserInfo.objects.filter(user_id=user_id).update(version=F('version') + 1)
+
+
+@receiver(post_save, sender=User)
+def invalidate_user_profile(sender, instance, created, update_fields, raw, **kwargs):
+    # Logins only touch last_login, which is not part of the profile
+    if created or raw or (update_fields is not None and set(update_fields) <= {'last_login'}):
+        return
+    bump_profile_version(instance.pk)
+
+
+@receiver(post_save, sender=models.UserInfo)
+def invalidate_user_info_profile(sender, instance, created, update_fields, raw, **kwargs):
+    if created or raw or (update_fields is not None and 'version' in update_fields):
+        return
+    bump_profile_version(instance.user_id)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    # Covers password changes and deactivation. A concurrent request could cache the old row again
+    # until the transaction commits, so the entry is deleted after that.
+    user_id = instance.pk
+    transaction.on_commit(lambda: authentication.invalidate_cached_user(user_id))
+
+
+@receiver(user_logged_out)
+def invalidate_cached_user_on_logout(sender, request, user, **kwargs):
+    if user is not None:
+        authentication.invalidate_cached_user(user.pk)
@@ -0,0 +1,99 @@
+import mmap
+import os
+import tempfile
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse
+
+from messenger import models, responses
+
+
+class PictureStorage:
+    """
+    Keeps picture bytes addressed by their sha256. ``save`` returns the fields that
+    should be stored on the ``PictureV2`` row alongside ``storage=<name>``.
+    """
+    name = None
+
+    def save(self, sha256, data):
+        raise NotImplementedError()
+
+    def read(self, picture):
+        raise NotImplementedError()
+
+    def create_response(self, request, picture, content_type, etag):
+        return responses.create_byte_range_response(request, self.read(picture), content_type, etag)
+
+
+class DatabaseStorage(PictureStorage):
+    name = 'database'
+
+    def save(self, sha256, data):
+        return {'data': data}
+
+    def read(self, picture):
+        if 'data' not in picture.get_deferred_fields():
+            return bytes(picture.data)
+        return bytes(models.PictureV2.objects.filter(uuid=picture.uuid).values_list('data', flat=True).get())
+
+
+class FileSystemStorage(PictureStorage):
+    name = 'filesystem'
+
+    def __init__(self, root=None):
+        self.root = root or settings.PICTURE_STORAGE_ROOT
+
+    def path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256)
+
+    def save(self, sha256, data):
+        path = self.path(sha256)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(file.name, path)
+        return {'data': b''}
+
+    def read(self, picture):
+        with open(self.path(picture.sha256), 'rb') as file:
+            return file.read()
+
+    def create_response(self, request, picture, content_type, etag):
+        file = open(self.path(picture.sha256), 'rb')
+        size = os.fstat(file.fileno()).st_size
+        try:
+            byte_range = responses.get_requested_range(request, size, etag)
+        except responses.UnsatisfiableRange:
+            file.close()
+            return responses.create_unsatisfiable_range_response(size)
+
+        if byte_range is None:
+            # FileResponse is streamed through wsgi.file_wrapper, which lets the server use sendfile
+            response = FileResponse(file, content_type=content_type)
+        else:
+            start, end = byte_range
+            with file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                response = HttpResponse(mapped[start:end + 1], content_type=content_type, status=206)
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Accept-Ranges'] = 'bytes'
+        return response
+
+
+STORAGES = {
+    DatabaseStorage.name: DatabaseStorage,
+    FileSystemStorage.name: FileSystemStorage,
+}
+
+
+def get_storage(name=None):
+    name = name or settings.PICTURE_STORAGE
+    if name not in STORAGES:
+        raise ValueError(f'Unknown picture storage: {name}')
+    return STORAGES[name]()
+
+
+def read_picture(picture):
+    return get_storage(picture.storage).read(picture)
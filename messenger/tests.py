@@ -1,3 +1,1423 @@
-from django.test import TestCase
+import asyncio
+import concurrent.futures
+import contextlib
+import datetime
+import hashlib
+import json
+import io
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from unittest import mock
 
-# Create your tests here.
+import PIL.Image
+import PIL.JpegImagePlugin
+from asgiref.testing import ApplicationCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.test import override_settings
+from django.urls import include, path
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory, APITestCase, APITransactionTestCase
+from rest_framework_simplejwt.tokens import AccessToken
+
+from DreaMessenger.asgi import application
+from messenger import archive, async_views, authentication, dataset, events, export, imaging, models, parsers, \
+    profiles, read_states, renderers, replicas, serializers, views
+from messenger.urls import urlpatterns
+
+
+def create_picture(data=b'picture'):
+    return models.PictureV2.objects.create(uuid=uuid.uuid4(), data=data, sha256=str(uuid.uuid4()))
+
+
+class MessengerTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+
+
+def create_image_upload(width, height, name='picture.png'):
+    file = io.BytesIO()
+    PIL.Image.new('RGB', (width, height), color=(200, 10, 10)).save(file, format='PNG')
+    file.name = name
+    file.seek(0)
+    return file
+
+
+def create_user(username):
+    user = User.objects.create_user(username=username,
+                                    first_name=username.capitalize(), last_name='Tester')
+    models.UserInfo.objects.create(user=user, avatar=create_picture())
+    return user
+
+
+def use_shared_cache(test_case):
+    # A cache that worker processes share, unlike the local memory one
+    directory = tempfile.TemporaryDirectory()
+    test_case.addCleanup(directory.cleanup)
+    shared_cache = override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(directory.name, 'cache'),
+    }})
+    shared_cache.enable()
+    test_case.addCleanup(shared_cache.disable)
+
+
+class QueryCountTest(MessengerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = create_user('owner')
+        self.client.force_authenticate(self.user)
+
+    def create_dialogues(self, count):
+        for i in range(count):
+            dialogue = models.Dialogue.objects.create()
+            dialogue.users.set((self.user, create_user(f'partner{i}-{uuid.uuid4().hex[:8]}')))
+
+    def create_messages(self, dialogue, count):
+        for i in range(count):
+            models.Message.objects.create(dialogue=dialogue, from_user=create_user(f'sender{i}-{uuid.uuid4().hex[:8]}'),
+                                          picture=create_picture())
+
+    def test_my_dialogues_query_count_does_not_depend_on_page_size(self):
+        self.create_dialogues(2)
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/v1/dialogue/my/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 2)
+
+        self.create_dialogues(10)
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/v1/dialogue/my/')
+        self.assertEqual(len(response.data['results']), 12)
+        self.assertIsNotNone(response.data['results'][0]['users'][0]['info']['avatar']['link'])
+
+    def test_messages_by_dialogue_query_count_does_not_depend_on_page_size(self):
+        dialogue = models.Dialogue.objects.create()
+        dialogue.users.set((self.user,))
+
+        self.create_messages(dialogue, 2)
+        with self.assertNumQueries(2):
+            response = self.client.get(f'/api/v1/dialogue/{dialogue.pk}/messages/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 2)
+
+        self.create_messages(dialogue, 10)
+        with self.assertNumQueries(2):
+            response = self.client.get(f'/api/v1/dialogue/{dialogue.pk}/messages/')
+        self.assertEqual(len(response.data['results']), 12)
+        self.assertIsNotNone(response.data['results'][0]['picture']['link'])
+
+    def test_user_suggest_query_count_does_not_depend_on_page_size(self):
+        for i in range(2):
+            create_user(f'suggested{i}')
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/v1/user/suggest/', {'name_substring': 'suggested'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 2)
+
+        for i in range(2, 12):
+            create_user(f'suggested{i}')
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/v1/user/suggest/', {'name_substring': 'suggested'})
+        self.assertEqual(len(response.data['results']), 12)
+
+
+class MessageCursorPaginationTest(MessengerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = create_user('owner')
+        self.client.force_authenticate(self.user)
+        self.dialogue = models.Dialogue.objects.create()
+        self.dialogue.users.set((self.user,))
+        self.messages = [models.Message.objects.create(dialogue=self.dialogue, from_user=self.user)
+                         for _ in range(5)]
+        self.url = f'/api/v1/dialogue/{self.dialogue.pk}/messages/'
+
+    def ids(self, response):
+        return [message['id'] for message in response.data['results']]
+
+    def test_page_number_mode_is_default(self):
+        response = self.client.get(self.url, {'page_size': 2, 'page': 2})
+        self.assertEqual(response.data['count'], 5)
+        self.assertEqual(self.ids(response), [self.messages[2].pk, self.messages[1].pk])
+
+    def test_walk_history_backwards_and_forwards(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, {'page_size': 2, 'before': ''})
+        self.assertNotIn('count', response.data)
+        self.assertEqual(self.ids(response), [self.messages[4].pk, self.messages[3].pk])
+        self.assertIsNone(response.data['previous'])
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual(self.ids(response), [self.messages[2].pk, self.messages[1].pk])
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual(self.ids(response), [self.messages[0].pk])
+        self.assertIsNone(response.data['next'])
+
+        response = self.client.get(response.data['previous'])
+        self.assertEqual(self.ids(response), [self.messages[2].pk, self.messages[1].pk])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.url, {'before': 'garbage'})
+        self.assertEqual(response.status_code, 404)
+
+
+class PictureViewTest(MessengerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.picture = models.PictureV2.objects.create(uuid=uuid.uuid4(), data=b'0123456789', sha256='abc')
+        self.url = f'/api/v1/picture/{self.picture.uuid}/'
+
+    def test_full_response_has_cache_headers(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'0123456789')
+        self.assertEqual(response['ETag'], '"abc"')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('Last-Modified', response)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+    def test_if_none_match_does_not_load_data(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH='"abc"')
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], '"abc"')
+
+    def test_byte_ranges(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=2-4')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, b'234')
+        self.assertEqual(response['Content-Range'], 'bytes 2-4/10')
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-3')
+        self.assertEqual(response.content, b'789')
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=20-')
+        self.assertEqual(response.status_code, 416)
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=2-4', HTTP_IF_RANGE='"other"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'0123456789')
+
+
+class FileSystemStorageTest(MessengerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+        data = b'0123456789'
+        self.sha256 = hashlib.sha256(data).hexdigest()
+        self.picture = models.PictureV2.objects.create(uuid=uuid.uuid4(), data=data, sha256=self.sha256)
+        self.url = f'/api/v1/picture/{self.picture.uuid}/'
+
+    def move_pictures(self):
+        with override_settings(PICTURE_STORAGE_ROOT=self.root.name):
+            call_command('move_pictures', stdout=io.StringIO())
+
+    def test_move_pictures_is_resumable(self):
+        self.move_pictures()
+        self.move_pictures()
+
+        self.picture.refresh_from_db()
+        self.assertEqual(self.picture.storage, 'filesystem')
+        self.assertEqual(bytes(self.picture.data), b'')
+        path = os.path.join(self.root.name, self.sha256[:2], self.sha256[2:4], self.sha256)
+        with open(path, 'rb') as file:
+            self.assertEqual(file.read(), b'0123456789')
+
+    def test_serve_from_filesystem(self):
+        self.move_pictures()
+
+        with override_settings(PICTURE_STORAGE_ROOT=self.root.name):
+            response = self.client.get(self.url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+            response.close()
+
+            response = self.client.get(self.url, HTTP_RANGE='bytes=3-5')
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response.content, b'345')
+
+
+class PictureDeduplicationTest(MessengerTestCase):
+    def save_picture(self, data):
+        serializer = serializers.PictureSerializer(data={})
+        serializer.cleaned_data = {'data': data}
+        return serializer.save()
+
+    def test_duplicate_is_found_without_loading_data(self):
+        picture = self.save_picture(b'picture')
+        with self.assertNumQueries(1):
+            duplicate = self.save_picture(b'picture')
+        self.assertEqual(duplicate.uuid, picture.uuid)
+        self.assertIn('data', duplicate.get_deferred_fields())
+        self.assertNotEqual(self.save_picture(b'other').uuid, picture.uuid)
+
+    def test_concurrent_insert_returns_existing_picture(self):
+        picture = self.save_picture(b'picture')
+        with mock.patch('django.db.models.QuerySet.first', return_value=None):
+            duplicate = self.save_picture(b'picture')
+        self.assertEqual(duplicate.uuid, picture.uuid)
+        self.assertEqual(models.PictureV2.objects.count(), 1)
+
+
+class PictureRenditionTest(MessengerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = create_user('owner')
+        self.client.force_authenticate(self.user)
+
+    def upload_avatar(self, width, height):
+        response = self.client.post('/api/v1/user/avatar/', {'data': create_image_upload(width, height)})
+        self.assertEqual(response.status_code, 200)
+        self.user.info.refresh_from_db()
+        return self.user.info.avatar
+
+    def test_renditions_are_generated_once(self):
+        picture = self.upload_avatar(300, 150)
+        self.assertEqual(sorted(picture.renditions.values_list('size', flat=True)), [64, 256])
+
+        rendition = picture.renditions.get(size=64).picture
+        image = PIL.Image.open(io.BytesIO(bytes(rendition.data)))
+        self.assertEqual(image.size, (64, 32))
+
+        self.upload_avatar(300, 150)
+        self.assertEqual(models.PictureRendition.objects.count(), 2)
+
+    def test_size_parameter(self):
+        picture = self.upload_avatar(300, 150)
+        url = f'/api/v1/picture/{picture.uuid}/'
+
+        response = self.client.get(url, {'size': 64})
+        self.assertEqual(response['ETag'], f'"{picture.renditions.get(size=64).picture.sha256}"')
+        self.assertEqual(PIL.Image.open(io.BytesIO(response.content)).size, (64, 32))
+
+        response = self.client.get(url, {'size': 1024})
+        self.assertEqual(response['ETag'], f'"{picture.sha256}"')
+
+        response = self.client.get(url, {'size': 100})
+        self.assertEqual(response.status_code, 400)
+
+    def test_links(self):
+        picture = self.upload_avatar(300, 150)
+        response = self.client.get('/api/v1/user/my/')
+        avatar = response.data['info']['avatar']
+        self.assertEqual(avatar['link'], f'http://testserver/api/v1/picture/{picture.uuid}/')
+        self.assertEqual(avatar['renditions']['64'], f'http://testserver/api/v1/picture/{picture.uuid}/?size=64')
+
+    def test_generate_renditions_for_existing_pictures(self):
+        data = create_image_upload(300, 150).getvalue()
+        picture = models.PictureV2.objects.create(uuid=uuid.uuid4(), data=data, sha256=hashlib.sha256(data).hexdigest())
+        self.user.info.avatar = picture
+        self.user.info.save()
+
+        call_command('generate_renditions', stdout=io.StringIO())
+        call_command('generate_renditions', stdout=io.StringIO())
+        self.assertEqual(sorted(picture.renditions.values_list('size', flat=True)), [64, 256])
+
+
+class ImagePoolTest(MessengerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = create_user('owner')
+        self.client.force_authenticate(self.user)
+        self.dialogue = models.Dialogue.objects.create()
+        self.dialogue.users.set((self.user,))
+        self.url = f'/api/v1/dialogue/{self.dialogue.pk}/messages/send/'
+
+    def test_send_message(self):
+        response = self.client.post(self.url, {'data': create_image_upload(40, 20)})
+        self.assertEqual(response.status_code, 200)
+        message = self.dialogue.messages.get()
+        self.assertEqual(PIL.Image.open(io.BytesIO(bytes(message.picture.data))).format, 'JPEG')
+
+    def test_not_an_image(self):
+        file = io.BytesIO(b'not an image')
+        file.name = 'picture.png'
+        response = self.client.post(self.url, {'data': file})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, {'data': 'Not an image'})
+
+    def test_saturated_pool_sheds_load(self):
+        with mock.patch.object(imaging, '_get_executor', return_value=(None, threading.BoundedSemaphore(1))) as get:
+            get.return_value[1].acquire()
+            response = self.client.post(self.url, {'data': create_image_upload(40, 20)})
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(self.dialogue.messages.exists())
+
+    @override_settings(IMAGE_POOL_WORKERS=1, IMAGE_POOL_TIMEOUT_SECONDS=0)
+    def test_timed_out_task_keeps_its_slot(self):
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+        slots = threading.BoundedSemaphore(1)
+        with mock.patch.object(imaging, '_get_executor', return_value=(executor, slots)):
+            with self.assertRaises(imaging.ImagePoolSaturated):
+                imaging.run_in_pool(time.sleep, 0.2)
+        # The worker is still sleeping
+        self.assertFalse(slots.acquire(blocking=False))
+
+        executor.shutdown(wait=True)
+        self.assertTrue(slots.acquire(blocking=False))
+
+
+class UploadLimitTest(MessengerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = create_user('owner')
+        self.client.force_authenticate(self.user)
+        self.url = '/api/v1/user/avatar/'
+
+    def upload_jpeg(self, width, height):
+        file = io.BytesIO()
+        PIL.Image.new('RGB', (width, height), color=(200, 10, 10)).save(file, format='JPEG')
+        file.name = 'picture.jpg'
+        file.seek(0)
+        return self.client.post(self.url, {'data': file})
+
+    def test_oversized_upload_is_rejected_while_streaming(self):
+        file = io.BytesIO(os.urandom(8192))
+        file.name = 'picture.png'
+        with override_settings(PICTURE_UPLOAD_MAX_BYTES=4096):
+            response = self.client.post(self.url, {'data': file})
+        self.assertEqual(response.status_code, 413)
+
+        file = io.BytesIO(os.urandom(parsers.MULTIPART_OVERHEAD_BYTES + 8192))
+        file.name = 'picture.png'
+        with override_settings(PICTURE_UPLOAD_MAX_BYTES=4096), \
+                mock.patch.object(parsers.LimitedUploadHandler, 'receive_data_chunk') as receive:
+            response = self.client.post(self.url, {'data': file})
+        self.assertEqual(response.status_code, 413)
+        receive.assert_not_called()
+
+    @override_settings(PICTURE_MAX_PIXELS=1000)
+    def test_too_many_pixels(self):
+        response = self.upload_jpeg(50, 30)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, {'data': 'At most 1000 pixels are allowed'})
+        self.assertEqual(self.upload_jpeg(40, 20).status_code, 200)
+
+    @override_settings(PICTURE_MAX_DIMENSION=100)
+    def test_original_is_downscaled_and_hashed(self):
+        self.assertEqual(self.upload_jpeg(800, 400).status_code, 200)
+        self.user.info.refresh_from_db()
+        picture = self.user.info.avatar
+        data = bytes(picture.data)
+        self.assertEqual(PIL.Image.open(io.BytesIO(data)).size, (100, 50))
+        self.assertEqual(picture.sha256, hashlib.sha256(data).hexdigest())
+        self.assertEqual(sorted(picture.renditions.values_list('size', flat=True)), [64])
+
+    def test_jpeg_is_decoded_at_reduced_scale(self):
+        file = io.BytesIO()
+        PIL.Image.new('RGB', (800, 400)).save(file, format='JPEG')
+        with mock.patch.object(PIL.JpegImagePlugin.JpegImageFile, 'draft', autospec=True,
+                               side_effect=PIL.JpegImagePlugin.JpegImageFile.draft) as draft:
+            image = imaging.open_image(file.getvalue(), 100, 0)
+        draft.assert_called_once_with(mock.ANY, 'RGB', (100, 50))
+        self.assertEqual(image.size, (100, 50))
+
+
+@override_settings(EVENTS_LONG_POLL_TIMEOUT_SECONDS=1, EVENTS_SYNC_POLL_TIMEOUT_SECONDS=1)
+class EventsTest(MessengerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = create_user('owner')
+        self.partner = create_user('partner')
+        self.client.force_authenticate(self.user)
+        self.dialogue = models.Dialogue.objects.create()
+        self.dialogue.users.set((self.user, self.partner))
+        events._broker = None
+
+    def send_message(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f'/api/v1/dialogue/{self.dialogue.pk}/messages/send/',
+                                        {'data': create_image_upload(40, 20)})
+        self.assertEqual(response.status_code, 200)
+
+    def test_long_poll(self):
+        response = self.client.get('/api/v1/events/poll/', {'since': 0})
+        self.assertEqual(response.data, {'events': [], 'cursor': 0})
+
+        self.send_message()
+        response = self.client.get('/api/v1/events/poll/', {'since': 0})
+        message = self.dialogue.messages.get()
+        self.assertEqual([event['type'] for event in response.data['events']],
+                         [events.MESSAGE_NEW, events.DIALOGUE_UPDATED])
+        self.assertEqual(response.data['events'][0]['message'], message.pk)
+        self.assertEqual(response.data['events'][0]['from_user'], 'owner')
+
+        response = self.client.get('/api/v1/events/poll/', {'since': response.data['cursor']})
+        self.assertEqual(response.data['events'], [])
+
+        response = self.client.get('/api/v1/events/poll/', {'since': 'x'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, {'detail': 'Invalid cursor x'})
+
+    @override_settings(EVENTS_LONG_POLL_TIMEOUT_SECONDS=60, EVENTS_SYNC_POLL_TIMEOUT_SECONDS=0)
+    def test_sync_poll_does_not_hold_worker(self):
+        start = time.perf_counter()
+        response = self.client.get('/api/v1/events/poll/', {'since': 0})
+        self.assertEqual(response.data, {'events': [], 'cursor': 0})
+        self.assertLess(time.perf_counter() - start, 5)
+
+    def test_broker_wakes_up_waiting_client(self):
+        broker = events.get_broker()
+        threading.Timer(0.05, broker.publish, args=([self.user.id], {'type': 'test'})).start()
+        pending, cursor = broker.wait(self.user.id, None, 5)
+        self.assertEqual(pending, [{'type': 'test', 'cursor': cursor}])
+
+    async def test_websocket(self):
+        token = str(AccessToken.for_user(self.partner))
+        communicator = ApplicationCommunicator(application, {
+            'type': 'websocket',
+            'path': '/api/v1/events/ws/',
+            'query_string': f'token={token}'.encode(),
+            'headers': [],
+        })
+        await communicator.send_input({'type': 'websocket.connect'})
+        self.assertEqual(await communicator.receive_output(), {'type': 'websocket.accept'})
+
+        events.get_broker().publish([self.partner.id], {'type': events.DIALOGUE_UPDATED, 'dialogue': 1})
+        message = await communicator.receive_output()
+        self.assertEqual(json.loads(message['text'])['type'], events.DIALOGUE_UPDATED)
+
+        await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await communicator.wait()
+
+    async def test_websocket_requires_authentication(self):
+        communicator = ApplicationCommunicator(application, {
+            'type': 'websocket',
+            'path': '/api/v1/events/ws/',
+            'query_string': b'token=invalid',
+            'headers': [],
+        })
+        await communicator.send_input({'type': 'websocket.connect'})
+        self.assertEqual(await communicator.receive_output(), {'type': 'websocket.close', 'code': 4401})
+
+    def create_cache_brokers(self):
+        use_shared_cache(self)
+        # One broker per worker process
+        brokers = events.CacheBroker(), events.CacheBroker()
+        for broker in brokers:
+            self.addCleanup(broker.close)
+        return brokers
+
+    def test_cache_broker_shares_events_between_processes(self):
+        publisher, subscriber = self.create_cache_brokers()
+        threading.Timer(0.05, publisher.publish, args=([self.user.id], {'type': 'test'})).start()
+        self.assertEqual(subscriber.wait(self.user.id, None, 5), ([{'type': 'test', 'cursor': 1}], 1))
+        self.assertEqual(publisher.wait(self.partner.id, 0, 0), ([], 1))
+
+    @mock.patch.object(events, 'PUBLISH_GRACE_SECONDS', 0)
+    def test_cache_broker_skips_lost_events(self):
+        publisher, subscriber = self.create_cache_brokers()
+        # A publisher that took a cursor and failed before storing its event
+        cache.add(events.CURSOR_KEY, 0, timeout=None)
+        cache.incr(events.CURSOR_KEY)
+        publisher.publish([self.user.id], {'type': 'test'})
+        self.assertEqual(subscriber.wait(self.user.id, 0, 5), ([{'type': 'test', 'cursor': 2}], 2))
+
+    def test_cache_broker_needs_shared_cache(self):
+        with self.assertRaises(ImproperlyConfigured):
+            events.CacheBroker()
+
+    def test_in_memory_broker_with_several_workers_is_reported(self):
+        with mock.patch.dict(os.environ, {'WEB_CONCURRENCY': '4'}), self.assertLogs(events.logger, 'WARNING'):
+            events.check_broker()
+
+
+# Without the overlap a sync returns only rows after the previous one
+@override_settings(SYNC_OVERLAP_SECONDS=0)
+class DeltaSyncTest(MessengerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = create_user('owner')
+        self.client.force_authenticate(self.user)
+        self.dialogue = models.Dialogue.objects.create()
+        self.dialogue.users.set((self.user,))
+        self.url = f'/api/v1/dialogue/{self.dialogue.pk}/messages/'
+
+    def ids(self, response):
+        return [item['id'] for item in response.data['results']]
+
+    def test_messages_since(self):
+        first = models.Message.objects.create(dialogue=self.dialogue, from_user=self.user)
+        second = models.Message.objects.create(dialogue=self.dialogue, from_user=self.user)
+
+        response = self.client.get(self.url, {'since': ''})
+        self.assertEqual(self.ids(response), [first.pk, second.pk])
+        self.assertFalse(response.data['has_more'])
+        token = response.data['since']
+
+        response = self.client.get(self.url, {'since': token})
+        self.assertEqual(self.ids(response), [])
+        self.assertEqual(response.data['since'], token)
+
+        first.is_edited = True
+        first.save()
+        third = models.Message.objects.create(dialogue=self.dialogue, from_user=self.user)
+        response = self.client.get(self.url, {'since': token, 'page_size': 1})
+        self.assertEqual(self.ids(response), [first.pk])
+        self.assertTrue(response.data['has_more'])
+
+        response = self.client.get(self.url, {'since': response.data['since']})
+        self.assertEqual(self.ids(response), [third.pk])
+
+    def test_dialogues_since(self):
+        other = models.Dialogue.objects.create()
+        other.users.set((self.user,))
+
+        response = self.client.get('/api/v1/dialogue/my/', {'since': ''})
+        self.assertEqual(self.ids(response), [self.dialogue.pk, other.pk])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f'{self.url}send/', {'data': create_image_upload(40, 20)})
+        response = self.client.get('/api/v1/dialogue/my/', {'since': response.data['since']})
+        self.assertEqual(self.ids(response), [self.dialogue.pk])
+
+    @override_settings(SYNC_OVERLAP_SECONDS=30)
+    def test_row_committed_late_is_returned(self):
+        first = models.Message.objects.create(dialogue=self.dialogue, from_user=self.user)
+        response = self.client.get(self.url, {'since': ''})
+        self.assertEqual(self.ids(response), [first.pk])
+
+        # Saved by a transaction which started before the sync and committed after it
+        late = models.Message.objects.create(dialogue=self.dialogue, from_user=self.user)
+        models.Message.objects.filter(pk=late.pk).update(edited_at=first.edited_at - datetime.timedelta(seconds=1))
+        response = self.client.get(self.url, {'since': response.data['since']})
+        self.assertEqual(self.ids(response), [late.pk, first.pk])
+
+        # Pages of rows seen again still move forward
+        response = self.client.get(self.url, {'since': response.data['since'], 'page_size': 1})
+        self.assertEqual(self.ids(response), [late.pk])
+        self.assertTrue(response.data['has_more'])
+        response = self.client.get(self.url, {'since': response.data['since'], 'page_size': 1})
+        self.assertEqual(self.ids(response), [first.pk])
+        self.assertFalse(response.data['has_more'])
+
+        # Rows changed before the window are not returned again
+        models.Message.objects.update(edited_at=timezone.now() - datetime.timedelta(minutes=5))
+        response = self.client.get(self.url, {'since': ''})
+        response = self.client.get(self.url, {'since': response.data['since']})
+        self.assertEqual(self.ids(response), [])
+
+
+class UserSuggestTest(MessengerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(create_user('owner'))
+
+    def test_ranking(self):
+        for username, first_name, last_name in (('zzbob', 'Ann', 'Smith'), ('bob', 'Ann', 'Lee'),
+                                                ('alice', 'Bob', 'Stone'), ('carl', 'Ann', 'Bobson')):
+            User.objects.create_user(username=username, first_name=first_name, last_name=last_name)
+
+        response = self.client.get('/api/v1/user/suggest/', {'name_substring': 'bob'})
+        self.assertEqual([user['username'] for user in response.data['results']], ['bob', 'zzbob', 'alice', 'carl'])
+
+        response = self.client.get('/api/v1/user/suggest/', {'name_substring': 'ann sm'})
+        self.assertEqual([user['username'] for user in response.data['results']], ['zzbob'])
+
+
+class ReadStateTest(MessengerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = create_user('owner')
+        self.partner = create_user('partner')
+        self.client.force_authenticate(self.user)
+        response = self.client.post('/api/v1/dialogue/create/', {'with_user': 'partner'})
+        self.dialogue = models.Dialogue.objects.get(pk=response.data['dialogue'])
+
+    def send_message(self, user):
+        self.client.force_authenticate(user)
+        response = self.client.post(f'/api/v1/dialogue/{self.dialogue.pk}/messages/send/',
+                                    {'data': create_image_upload(40, 20)})
+        self.assertEqual(response.status_code, 200)
+        return self.dialogue.messages.latest('id')
+
+    def get_dialogue(self, user):
+        self.client.force_authenticate(user)
+        return self.client.get('/api/v1/dialogue/my/').data['results'][0]
+
+    def test_unread_counts(self):
+        first = self.send_message(self.partner)
+        self.send_message(self.partner)
+        last = self.send_message(self.partner)
+
+        dialogue = self.get_dialogue(self.user)
+        self.assertEqual(dialogue['unread_count'], 3)
+        self.assertIsNone(dialogue['last_read_message'])
+        partner_dialogue = self.get_dialogue(self.partner)
+        self.assertEqual(partner_dialogue['unread_count'], 0)
+        self.assertEqual(partner_dialogue['last_read_message'], last.pk)
+
+        self.client.force_authenticate(self.user)
+        response = self.client.post(f'/api/v1/dialogue/{self.dialogue.pk}/read/', {'message': first.pk})
+        self.assertEqual(response.data, {'last_read_message': first.pk, 'unread_count': 2})
+
+        response = self.client.post(f'/api/v1/dialogue/{self.dialogue.pk}/read/')
+        self.assertEqual(response.data, {'last_read_message': last.pk, 'unread_count': 0})
+
+        response = self.client.post(f'/api/v1/dialogue/{self.dialogue.pk}/read/', {'message': first.pk})
+        self.assertEqual(response.data, {'last_read_message': last.pk, 'unread_count': 0})
+        self.assertEqual(self.get_dialogue(self.user)['unread_count'], 0)
+
+
+class LastMessagePreviewTest(MessengerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = create_user('owner')
+        self.client.force_authenticate(self.user)
+        self.dialogue = models.Dialogue.objects.create()
+        self.dialogue.users.set((self.user,))
+
+    def test_preview_is_maintained_on_send(self):
+        self.assertIsNone(self.client.get('/api/v1/dialogue/my/').data['results'][0]['last_message'])
+
+        for _ in range(2):
+            self.client.post(f'/api/v1/dialogue/{self.dialogue.pk}/messages/send/', {'data': create_image_upload(40, 20)})
+        with self.assertNumQueries(3):
+            preview = self.client.get('/api/v1/dialogue/my/').data['results'][0]['last_message']
+        self.assertEqual(preview['id'], self.dialogue.messages.latest('id').pk)
+        self.assertEqual(preview['from_user']['username'], 'owner')
+        self.assertIsNotNone(preview['picture']['link'])
+
+    def test_rebuild_command(self):
+        models.Message.objects.create(dialogue=self.dialogue, from_user=self.user)
+        latest = models.Message.objects.create(dialogue=self.dialogue, from_user=self.user)
+
+        call_command('rebuild_dialogue_previews', stdout=io.StringIO())
+        self.dialogue.refresh_from_db()
+        self.assertEqual(self.dialogue.last_message, latest)
+
+
+class PairDialogueTest(MessengerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = create_user('owner')
+        self.partner = create_user('partner')
+
+    def test_dialogue_is_created_once_for_both_directions(self):
+        self.client.force_authenticate(self.user)
+        response = self.client.post('/api/v1/dialogue/create/', {'with_user': 'partner'})
+        self.assertEqual(response.status_code, 201)
+        dialogue = models.Dialogue.objects.get(pk=response.data['dialogue'])
+        self.assertEqual((dialogue.pair_low_user, dialogue.pair_high_user), (self.user, self.partner))
+
+        self.client.force_authenticate(self.partner)
+        response = self.client.post('/api/v1/dialogue/create/', {'with_user': 'owner'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_concurrent_create_is_rejected(self):
+        self.client.force_authenticate(self.user)
+        with mock.patch('django.db.models.QuerySet.exists', return_value=False):
+            self.client.post('/api/v1/dialogue/create/', {'with_user': 'partner'})
+            response = self.client.post('/api/v1/dialogue/create/', {'with_user': 'partner'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(models.Dialogue.objects.count(), 1)
+
+
+class ProfileCacheTest(MessengerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = create_user('owner')
+        self.client.force_authenticate(self.user)
+
+    def get_profile(self):
+        return self.client.get('/api/v1/user/my/').data
+
+    def test_profiles_are_cached_until_changed(self):
+        stats = profiles.get_stats()
+        self.get_profile()
+        self.get_profile()
+        self.assertEqual(profiles.get_stats()['hits'] - stats['hits'], 1)
+        self.assertEqual(profiles.get_stats()['misses'] - stats['misses'], 1)
+
+        self.user.first_name = 'Renamed'
+        self.user.save()
+        self.user.refresh_from_db()
+        self.assertEqual(self.get_profile()['first_name'], 'Renamed')
+
+        old_avatar = self.get_profile()['info']['avatar']['link']
+        self.client.post('/api/v1/user/avatar/', {'data': create_image_upload(40, 20)})
+        self.user.refresh_from_db()
+        self.assertNotEqual(self.get_profile()['info']['avatar']['link'], old_avatar)
+
+    def test_listed_profiles_are_fetched_in_one_cache_round_trip(self):
+        create_user('partner')
+        create_user('another')
+        usernames = ['owner', 'partner', 'another']
+        self.client.post('/api/v1/user/lookup/', {'usernames': usernames}, format='json')
+
+        stats = profiles.get_stats()
+        with mock.patch.object(cache, 'get_many', wraps=cache.get_many) as get_many:
+            users = self.client.post('/api/v1/user/lookup/', {'usernames': usernames}, format='json').data['usernames']
+        self.assertEqual(get_many.call_count, 1)
+        self.assertEqual(profiles.get_stats()['hits'] - stats['hits'], 3)
+        self.assertEqual(list(users), usernames)
+
+
+class BatchSendTest(MessengerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = create_user('owner')
+        self.partner = create_user('partner')
+        self.client.force_authenticate(self.user)
+        response = self.client.post('/api/v1/dialogue/create/', {'with_user': 'partner'})
+        self.dialogue = models.Dialogue.objects.get(pk=response.data['dialogue'])
+        self.url = f'/api/v1/dialogue/{self.dialogue.pk}/messages/send/batch/'
+
+    def test_batch_send(self):
+        not_an_image = io.BytesIO(b'not an image')
+        not_an_image.name = 'picture.png'
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            response = self.client.post(self.url, {'data': [create_image_upload(40, 20), not_an_image,
+                                                            create_image_upload(20, 40)]})
+        self.assertEqual(response.status_code, 200)
+
+        messages = list(self.dialogue.messages.order_by('id'))
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(response.data['results'], [
+            {'index': 0, 'message': messages[0].pk},
+            {'index': 1, 'errors': {'data': 'Not an image'}},
+            {'index': 2, 'message': messages[1].pk},
+        ])
+        self.assertEqual(len(callbacks), 1)
+
+        self.dialogue.refresh_from_db()
+        self.assertEqual(self.dialogue.last_message, messages[1])
+        self.assertEqual(self.partner.read_states.get(dialogue=self.dialogue).unread_count, 2)
+
+    def test_batch_limits(self):
+        response = self.client.post(self.url, {})
+        self.assertEqual(response.status_code, 400)
+
+        with override_settings(MESSAGE_BATCH_MAX_PICTURES=1):
+            response = self.client.post(self.url, {'data': [create_image_upload(40, 20), create_image_upload(40, 20)]})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(self.dialogue.messages.exists())
+
+    def test_largest_batch_fits_into_pool(self):
+        self.assertGreater(settings.MESSAGE_BATCH_MAX_PICTURES,
+                           settings.IMAGE_POOL_WORKERS + settings.IMAGE_POOL_QUEUE_SIZE)
+        response = self.client.post(self.url, {'data': [
+            create_image_upload(40, 20) for _ in range(settings.MESSAGE_BATCH_MAX_PICTURES)
+        ]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.dialogue.messages.count(), settings.MESSAGE_BATCH_MAX_PICTURES)
+
+
+class BulkUserLookupTest(MessengerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = create_user('owner')
+        self.client.force_authenticate(self.user)
+
+    def test_lookup(self):
+        partners = [create_user(f'partner{i}') for i in range(5)]
+        with self.assertNumQueries(1):
+            response = self.client.post('/api/v1/user/lookup/', {
+                'usernames': ['partner0', 'partner1', 'nobody'],
+                'ids': [partners[4].pk, 10 ** 6],
+            }, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.data['usernames']), ['partner0', 'partner1'])
+        self.assertEqual(response.data['usernames']['partner1']['first_name'], 'Partner1')
+        self.assertEqual(response.data['ids'][str(partners[4].pk)]['username'], 'partner4')
+        self.assertEqual(response.data['missing'], {'usernames': ['nobody'], 'ids': [10 ** 6]})
+
+    def test_limits(self):
+        response = self.client.post('/api/v1/user/lookup/', {}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+        with override_settings(USER_BULK_LOOKUP_MAX=2):
+            response = self.client.post('/api/v1/user/lookup/', {'usernames': ['a', 'b', 'c']}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+class CachedAuthenticationTest(MessengerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username='owner', password='password')
+        self.token = str(AccessToken.for_user(self.user))
+
+    def get_hello(self):
+        return self.client.get('/api/v1/hello/', HTTP_AUTHORIZATION=f'Bearer {self.token}')
+
+    def test_jwt_user_is_cached(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get_hello().status_code, 200)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_hello().status_code, 200)
+
+    def test_password_hash_is_not_cached(self):
+        self.get_hello()
+        entry = cache.get(f'messenger:auth-user:{self.user.pk}')
+        self.assertNotIn('password', entry['fields'])
+        self.assertNotIn(self.user.password, repr(entry))
+
+        user = authentication.get_cached_user(self.user.pk)
+        self.assertEqual(user.get_deferred_fields(), {'password'})
+        self.assertTrue(user.check_password('password'))
+
+    def test_deactivation_invalidates_cache(self):
+        self.get_hello()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = False
+            self.user.save()
+            # Until the commit other requests would read the old row and cache it again
+            self.assertIsNotNone(cache.get(f'messenger:auth-user:{self.user.pk}'))
+        self.assertIsNone(cache.get(f'messenger:auth-user:{self.user.pk}'))
+        self.assertEqual(self.get_hello().status_code, 401)
+
+    def test_session_user_is_cached_and_invalidated_on_logout(self):
+        self.client.post('/api/v1/auth/session/login/', {'username': 'owner', 'password': 'password'})
+        self.client.get('/api/v1/hello/')
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get('/api/v1/hello/').status_code, 200)
+
+        self.client.post('/api/v1/auth/session/logout/')
+        self.assertEqual(self.client.get('/api/v1/hello/').status_code, 401)
+        self.assertIsNone(cache.get(f'messenger:auth-user:{self.user.pk}'))
+
+
+class DatasetTest(MessengerTestCase):
+    def generate(self, seed):
+        dataset.generate(users=30, dialogues=40, messages=200, pictures=10, members_distribution='2:70,3-6:30', seed=seed)
+        return {
+            'users': list(User.objects.order_by('id').values_list('username', 'first_name', 'last_name')),
+            'pictures': sorted(models.PictureV2.objects.values_list('sha256', flat=True)),
+            'members': [sorted(dialogue.users.values_list('username', flat=True))
+                        for dialogue in models.Dialogue.objects.order_by('id')],
+        }
+
+    def clear(self):
+        models.PictureV2.objects.all().delete()
+        models.Dialogue.objects.all().delete()
+        User.objects.all().delete()
+
+    def test_generation_is_deterministic(self):
+        first = self.generate(seed=1)
+        self.clear()
+        self.assertEqual(self.generate(seed=1), first)
+        self.clear()
+        self.assertNotEqual(self.generate(seed=2), first)
+
+    def test_generated_data_is_consistent(self):
+        self.generate(seed=0)
+        self.assertEqual(models.Message.objects.count(), 200)
+        self.assertEqual(models.UserInfo.objects.count(), 30)
+        for dialogue in models.Dialogue.objects.prefetch_related('users'):
+            self.assertTrue(2 <= dialogue.users.count() <= 6)
+            if dialogue.is_tetatet:
+                self.assertEqual(dialogue.pair_low_user_id, min(user.id for user in dialogue.users.all()))
+            latest = dialogue.messages.order_by('-created_at', '-id').first()
+            self.assertEqual(dialogue.last_message_id, latest.id if latest is not None else None)
+            self.assertEqual(dialogue.read_states.count(), dialogue.users.count())
+
+    def test_invalid_members_distribution(self):
+        with self.assertRaises(ValueError):
+            dataset.parse_members_distribution('1:10')
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'], IMAGE_POOL_WORKERS=0)
+class RunBenchmarkTest(MessengerTestCase):
+    def test_every_route_is_benchmarked(self):
+        with tempfile.NamedTemporaryFile(suffix='.json') as output:
+            call_command('run_benchmark', users=20, dialogues=30, messages=100, pictures=5, repeat=2, warmup=0,
+                         output=output.name, stdout=io.StringIO())
+            results = json.load(output)
+
+        self.assertEqual({str(pattern.pattern) for pattern in urlpatterns},
+                         {endpoint['route'] for endpoint in results['endpoints'].values()})
+        for name, endpoint in results['endpoints'].items():
+            self.assertEqual(endpoint['count'], 2)
+            self.assertTrue(all(200 <= int(status) < 400 for status in endpoint['statuses']), name)
+        self.assertFalse(User.objects.filter(username__startswith=dataset.USERNAME_PREFIX).exists())
+
+
+class MetricsTest(MessengerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = create_user('owner')
+        # Metrics are only served to staff
+        self.user.is_staff = True
+        self.user.save()
+        self.client.force_authenticate(self.user)
+        self.dialogue = models.Dialogue.objects.create()
+        self.dialogue.users.set((self.user,))
+        models.Message.objects.create(dialogue=self.dialogue, from_user=self.user, picture=create_picture())
+
+    def get_metric(self, line_prefix):
+        for line in self.client.get('/api/v1/metrics/').content.decode().splitlines():
+            if line.startswith(line_prefix + ' '):
+                return float(line.split()[-1])
+        return 0.0
+
+    def test_requests_are_recorded(self):
+        labels = '{view="MessagesByDialogueView",method="GET"}'
+        requests_before = self.get_metric('messenger_request_duration_seconds_count' + labels)
+        queries_before = self.get_metric('messenger_request_sql_queries_sum' + labels)
+
+        self.client.get(f'/api/v1/dialogue/{self.dialogue.id}/messages/')
+        self.client.get(f'/api/v1/dialogue/{self.dialogue.id}/messages/')
+
+        self.assertEqual(self.get_metric('messenger_request_duration_seconds_count' + labels), requests_before + 2)
+        self.assertEqual(self.get_metric('messenger_request_sql_queries_sum' + labels), queries_before + 4)
+        self.assertGreater(self.get_metric(
+            'messenger_request_stage_duration_seconds_count{view="MessagesByDialogueView",method="GET",stage="serialize"}'
+        ), 0)
+        self.assertGreater(self.get_metric(
+            'messenger_request_stage_duration_seconds_count{view="MessagesByDialogueView",method="GET",stage="render"}'
+        ), 0)
+        self.assertGreater(self.get_metric(
+            'messenger_requests_total{view="MessagesByDialogueView",method="GET",status="200"}'
+        ), 0)
+        self.assertIn('messenger_profile_cache_misses_total', self.client.get('/api/v1/metrics/').content.decode())
+
+    def test_server_timing_header(self):
+        response = self.client.get(f'/api/v1/dialogue/{self.dialogue.id}/messages/')
+        self.assertNotIn('Server-Timing', response)
+
+        with override_settings(METRICS_SERVER_TIMING=True):
+            response = self.client.get(f'/api/v1/dialogue/{self.dialogue.id}/messages/')
+        self.assertRegex(response['Server-Timing'], r'^total;dur=[\d.]+, sql;dur=[\d.]+;desc="2 queries", '
+                                                    r'serialize;dur=[\d.]+, render;dur=[\d.]+$')
+
+    def test_only_staff_can_read_metrics_without_token(self):
+        self.client.force_authenticate(create_user('partner'))
+        self.assertEqual(self.client.get('/api/v1/metrics/').status_code, 403)
+        self.client.force_authenticate(None)
+        self.assertEqual(self.client.get('/api/v1/metrics/').status_code, 401)
+
+    @override_settings(METRICS_TOKEN='metrics-token')
+    def test_metrics_token(self):
+        self.client.force_authenticate(None)
+        self.assertEqual(self.client.get('/api/v1/metrics/').status_code, 403)
+        response = self.client.get('/api/v1/metrics/', HTTP_AUTHORIZATION='Bearer metrics-token')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+
+
+class FastSerializationTest(MessengerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = create_user('owner')
+        self.partner = create_user('partner')
+        self.partner.first_name = 'Line\u2028separated \u00e9\U0001f600'
+        self.partner.save()
+        self.no_avatar = User.objects.create_user(username='no-avatar', first_name='No', last_name='Avatar')
+        models.UserInfo.objects.create(user=self.no_avatar)
+        self.client.force_authenticate(self.user)
+
+        self.dialogue = models.Dialogue.objects.create()
+        self.dialogue.users.set((self.user, self.partner, self.no_avatar))
+        models.Dialogue.objects.create().users.set((self.user, self.partner))
+        messages = [
+            models.Message.objects.create(dialogue=self.dialogue, from_user=self.partner, picture=create_picture()),
+            models.Message.objects.create(dialogue=self.dialogue, from_user=self.no_avatar, picture=None),
+            models.Message.objects.create(dialogue=self.dialogue, from_user=None, picture=create_picture(b'other')),
+        ]
+        self.dialogue.last_message = messages[-1]
+        self.dialogue.save()
+        models.DialogueReadState.objects.create(user=self.user, dialogue=self.dialogue, unread_count=2,
+                                                last_read_message=messages[0])
+
+    def render_reference(self, path, serializer_class, instances):
+        request = APIRequestFactory().get(path)
+        request.user = self.user
+        data = serializer_class(instances, many=True, context={'request': request}).data
+        return JSONRenderer().render({'count': len(data), 'next': None, 'previous': None, 'results': data})
+
+    def test_messages_are_byte_compatible(self):
+        path = f'/api/v1/dialogue/{self.dialogue.id}/messages/'
+        instances = self.dialogue.messages.order_by('-created_at', '-id')
+        self.assertEqual(self.client.get(path).content,
+                         self.render_reference(path, serializers.MessageResponseSerializer, instances))
+
+    def test_dialogues_are_byte_compatible(self):
+        path = '/api/v1/dialogue/my/'
+        read_state = models.DialogueReadState.objects.filter(dialogue=OuterRef('pk'), user=self.user)
+        instances = self.user.dialogues \
+            .annotate(unread_count=Coalesce(Subquery(read_state.values('unread_count')[:1]), 0),
+                      last_read_message=Subquery(read_state.values('last_read_message')[:1])) \
+            .order_by('-updated_at')
+        self.assertEqual(self.client.get(path).content,
+                         self.render_reference(path, serializers.DialogueResponseSerializer, instances))
+
+    def test_sparse_fieldset(self):
+        response = self.client.get('/api/v1/dialogue/my/', {'fields': 'unread_count,id'})
+        self.assertEqual([list(dialogue) for dialogue in response.data['results']], [['id', 'unread_count']] * 2)
+
+        response = self.client.get(f'/api/v1/dialogue/{self.dialogue.id}/messages/', {'fields': 'id,missing'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_renderer_falls_back_without_orjson(self):
+        data = {'text': 'Line\u2028separated \u00e9', 'id': 1, 'items': [None, True, 1.5], 1: 'key'}
+        with mock.patch.object(renderers, 'orjson', None):
+            fallback = renderers.FastJSONRenderer().render(data)
+        self.assertEqual(renderers.FastJSONRenderer().render(data), fallback)
+        self.assertEqual(fallback, JSONRenderer().render(data))
+
+    def test_orjson_output_matches_json_renderer(self):
+        self.assertIsNotNone(renderers.orjson)
+        data = {
+            'text': 'Line\u2028separated \u00e9 \U0001F600', 'id': 2 ** 70, 'items': [None, True, 1.5, -0.0, 1e300],
+            'created_at': timezone.now(), 'uuid': uuid.uuid4(), 'nested': {'tuple': (1, 'a'), 2: [{}]},
+        }
+        self.assertEqual(renderers.FastJSONRenderer().render(data), JSONRenderer().render(data))
+
+        for value in (float('nan'), float('inf'), float('-inf')):
+            with self.assertRaisesMessage(ValueError, 'Out of range float values are not JSON compliant'):
+                renderers.FastJSONRenderer().render({'items': [None, {'value': value}]})
+
+
+class AsyncUrlConf:
+    urlpatterns = [path('api/v1/', include([
+        path('dialogue/my/', async_views.AsyncMyDialoguesView.as_view()),
+        path('dialogue/<int:pk>/messages/', async_views.AsyncMessagesByDialogueView.as_view()),
+        path('picture/<uuid:uuid>/', async_views.AsyncPictureView.as_view(), name='picture'),
+        path('events/poll/', async_views.AsyncEventsPollView.as_view()),
+        path('user/suggest/', async_views.AsyncUserSuggestView.as_view()),
+        path('metrics/', views.MetricsView.as_view()),
+    ]))]
+
+
+@override_settings(ROOT_URLCONF=AsyncUrlConf, EVENTS_LONG_POLL_TIMEOUT_SECONDS=5)
+class AsyncViewsTest(APITransactionTestCase):
+    # Async views query the database from their own threads, which do not see uncommitted test transactions
+
+    def setUp(self):
+        cache.clear()
+        events._broker = None
+        self.user = create_user('owner')
+        self.partner = create_user('partner')
+        self.dialogue = models.Dialogue.objects.create()
+        self.dialogue.users.set((self.user, self.partner))
+        self.message = models.Message.objects.create(dialogue=self.dialogue, from_user=self.partner,
+                                                     picture=create_picture())
+        self.auth = {'authorization': f'Bearer {AccessToken.for_user(self.user)}'}
+        self.paths = ['/api/v1/dialogue/my/', f'/api/v1/dialogue/{self.dialogue.id}/messages/',
+                      '/api/v1/user/suggest/?name_substring=part']
+
+    async def test_responses_match_sync_views(self):
+        for path in self.paths:
+            response = await self.async_client.get(path, **self.auth)
+            self.assertEqual(response.status_code, 200, path)
+            with override_settings(ROOT_URLCONF='DreaMessenger.urls'):
+                expected = await self.async_client.get(path, **self.auth)
+            self.assertEqual(expected.status_code, 200, path)
+            self.assertEqual(response.content, expected.content, path)
+
+        response = await self.async_client.get(f'/api/v1/picture/{self.message.picture.uuid}/')
+        self.assertEqual(b''.join(response.streaming_content) if response.streaming else response.content,
+                         b'picture')
+
+    async def test_authentication_is_required(self):
+        response = await self.async_client.get('/api/v1/dialogue/my/')
+        self.assertEqual(response.status_code, 401)
+        response = await self.async_client.get('/api/v1/dialogue/my/', authorization='Bearer invalid')
+        self.assertEqual(response.status_code, 401)
+
+    async def test_old_connections_are_closed_once_per_request(self):
+        path = f'/api/v1/dialogue/{self.dialogue.id}/messages/'
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.addCleanup(executor.shutdown)
+        with mock.patch.object(async_views, '_executor', executor), \
+                mock.patch.object(async_views, 'close_old_connections') as close_old_connections:
+            # Authentication and the handler run in the same thread
+            await self.async_client.get(path, **self.auth)
+            self.assertEqual(close_old_connections.call_count, 1)
+            await self.async_client.get(path, **self.auth)
+            self.assertEqual(close_old_connections.call_count, 2)
+
+    async def test_long_poll_waits_on_event_loop(self):
+        asyncio.get_running_loop().call_later(0.05, events.get_broker().publish, [self.user.id], {'type': 'test'})
+        response = await self.async_client.get('/api/v1/events/poll/', {'since': 0}, **self.auth)
+        self.assertEqual(json.loads(response.content), {'events': [{'type': 'test', 'cursor': 1}], 'cursor': 1})
+
+        response = await self.async_client.get('/api/v1/events/poll/', {'since': 'x'}, **self.auth)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.content), {'detail': 'Invalid cursor x'})
+
+    @override_settings(METRICS_TOKEN='metrics-token')
+    async def test_queries_are_recorded_in_metrics(self):
+        await self.async_client.get(f'/api/v1/dialogue/{self.dialogue.id}/messages/', **self.auth)
+        metrics_text = (await self.async_client.get('/api/v1/metrics/', authorization='Bearer metrics-token')) \
+            .content.decode()
+        self.assertRegex(metrics_text, r'messenger_request_sql_queries_sum'
+                                       r'\{view="AsyncMessagesByDialogueView",method="GET"\} [1-9]')
+
+
+@override_settings(DATABASE_REPLICAS=['replica'], REPLICA_STICKY_SECONDS=60)
+class ReplicaRoutingTest(APITransactionTestCase):
+    # The replica is a snapshot of the test database in a second SQLite file, so committed data is needed
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        # Sticky users are kept in a cache shared by worker processes
+        use_shared_cache(self)
+
+        cache.clear()
+        self.user = create_user('owner')
+        self.partner = create_user('partner')
+        self.dialogue = models.Dialogue.objects.create()
+        self.dialogue.users.set((self.user, self.partner))
+        self.message = models.Message.objects.create(dialogue=self.dialogue, from_user=self.partner)
+
+        replica_path = os.path.join(directory.name, 'replica.sqlite3')
+        connection.ensure_connection()
+        with contextlib.closing(sqlite3.connect(replica_path)) as replica:
+            connection.connection.backup(replica)
+
+        connections.settings['replica'] = dict(connections.settings['default'], NAME=replica_path)
+        self.addCleanup(self.remove_replica)
+
+        # Not replicated yet
+        self.new_message = models.Message.objects.create(dialogue=self.dialogue, from_user=self.partner)
+
+    def remove_replica(self):
+        connections['replica'].close()
+        del connections['replica']
+        del connections.settings['replica']
+
+    def get_message_ids(self, user):
+        self.client.force_authenticate(user)
+        response = self.client.get(f'/api/v1/dialogue/{self.dialogue.id}/messages/')
+        self.assertEqual(response.status_code, 200)
+        return [message['id'] for message in response.data['results']]
+
+    def test_reads_go_to_replica_until_user_writes(self):
+        self.assertEqual(self.get_message_ids(self.user), [self.message.id])
+
+        response = self.client.post(f'/api/v1/dialogue/{self.dialogue.id}/read/', {'message': self.new_message.id})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(models.DialogueReadState.objects.filter(user=self.user).exists())
+        self.assertFalse(models.DialogueReadState.objects.using('replica').exists())
+
+        self.assertEqual(self.get_message_ids(self.user), [self.new_message.id, self.message.id])
+        self.assertEqual(self.get_message_ids(self.partner), [self.message.id])
+
+    def test_sticky_window_expires(self):
+        self.client.force_authenticate(self.user)
+        self.client.post(f'/api/v1/dialogue/{self.dialogue.id}/read/', {'message': self.new_message.id})
+        cache.delete(replicas.get_sticky_key(self.user.id))
+        self.assertEqual(self.get_message_ids(self.user), [self.message.id])
+
+    def test_process_local_cache_is_rejected(self):
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            with self.assertRaises(ImproperlyConfigured):
+                replicas.ReplicaMiddleware(lambda request: None)
+
+
+class MessageArchiveTest(MessengerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = create_user('owner')
+        self.partner = create_user('partner')
+        self.client.force_authenticate(self.user)
+        self.dialogue = models.Dialogue.objects.create()
+        self.dialogue.users.set((self.user, self.partner))
+        self.url = f'/api/v1/dialogue/{self.dialogue.pk}/messages/'
+
+        self.messages = [models.Message.objects.create(dialogue=self.dialogue, from_user=self.user)
+                         for _ in range(7)]
+        models.Message.objects.filter(id__in=[message.id for message in self.messages[:5]]) \
+            .update(created_at=timezone.now() - datetime.timedelta(days=365))
+        self.dialogue.last_message = self.messages[-1]
+        self.dialogue.save()
+        models.DialogueReadState.objects.create(user=self.user, dialogue=self.dialogue,
+                                                last_read_message=self.messages[1])
+        models.DialogueReadState.objects.create(user=self.partner, dialogue=self.dialogue,
+                                                last_read_message=self.messages[0], unread_count=6)
+
+    def archive(self):
+        call_command('archive_messages', days=30, batch_size=2, stdout=io.StringIO())
+
+    def walk_cursor_pages(self):
+        ids = []
+        url = self.url + '?before=&page_size=2'
+        while url is not None:
+            response = self.client.get(url)
+            ids.extend(item['id'] for item in response.data['results'])
+            url = response.data['next']
+        return ids
+
+    def test_archives_old_messages_except_referenced_ones(self):
+        self.archive()
+        self.assertEqual(sorted(models.ArchivedMessage.objects.values_list('id', flat=True)),
+                         [self.messages[i].id for i in (2, 3, 4)])
+        self.assertEqual(sorted(models.Message.objects.values_list('id', flat=True)),
+                         [self.messages[i].id for i in (0, 1, 5, 6)])
+        self.dialogue.refresh_from_db()
+        self.assertEqual(self.dialogue.last_message_id, self.messages[-1].id)
+
+        self.archive()
+        self.assertEqual(models.ArchivedMessage.objects.count(), 3)
+
+    def test_history_pages_across_archive(self):
+        # Sync tokens hold the time of the sync, so only the synced rows are compared
+        pages = [self.client.get(self.url).data, self.client.get(self.url, {'since': ''}).data['results']]
+        cursor_ids = self.walk_cursor_pages()
+        self.assertEqual(cursor_ids, [message.id for message in reversed(self.messages)])
+
+        self.archive()
+        self.assertEqual([self.client.get(self.url).data, self.client.get(self.url, {'since': ''}).data['results']],
+                         pages)
+        self.assertEqual(self.walk_cursor_pages(), cursor_ids)
+
+    def test_mark_archived_message_read(self):
+        self.archive()
+        self.client.force_authenticate(self.partner)
+        response = self.client.post(f'/api/v1/dialogue/{self.dialogue.pk}/read/', {'message': self.messages[3].id})
+        self.assertEqual(response.status_code, 200)
+        # Moved to the first hot message after the archived one
+        self.assertEqual(response.data, {'last_read_message': self.messages[5].id, 'unread_count': 1})
+
+        response = self.client.post(f'/api/v1/dialogue/{self.dialogue.pk}/read/', {'message': 10 ** 6})
+        self.assertEqual(response.status_code, 404)
+
+    def test_message_archived_before_marking_read(self):
+        # The view resolved the message before it was archived
+        self.archive()
+        with transaction.atomic():
+            read_state = read_states.mark_read(self.partner, self.dialogue, self.messages[3])
+        self.assertEqual(read_state.last_read_message, self.messages[5])
+        self.assertEqual(read_state.unread_count, 1)
+
+    def test_message_marked_read_while_archiving(self):
+        select_batch = archive.select_batch
+
+        def select_and_mark_read(cutoff, batch_size):
+            rows = select_batch(cutoff, batch_size)
+            models.DialogueReadState.objects.filter(user=self.partner).update(last_read_message_id=rows[0]['id'])
+            return rows
+
+        with mock.patch.object(archive, 'select_batch', side_effect=select_and_mark_read):
+            archive.archive_batch(timezone.now() - datetime.timedelta(days=30), 2)
+        self.assertEqual(models.DialogueReadState.objects.get(user=self.partner).last_read_message,
+                         self.messages[2])
+        self.assertEqual(list(models.ArchivedMessage.objects.values_list('id', flat=True)), [self.messages[3].id])
+
+    def test_unread_count_includes_archived_messages(self):
+        self.archive()
+        self.client.force_authenticate(self.partner)
+        response = self.client.post(f'/api/v1/dialogue/{self.dialogue.pk}/read/', {'message': self.messages[1].id})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['unread_count'], 5)
+
+
+class DialogueExportTest(MessengerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = create_user('owner')
+        self.partner = create_user('partner')
+        self.client.force_authenticate(self.user)
+        self.dialogue = models.Dialogue.objects.create()
+        self.dialogue.users.set((self.user, self.partner))
+        self.url = f'/api/v1/dialogue/{self.dialogue.pk}/export/'
+
+        self.picture = create_picture(b'first')
+        self.other_picture = create_picture(b'second')
+        self.archived = models.ArchivedMessage.objects.create(
+            id=10 ** 6, dialogue=self.dialogue, from_user=self.partner, picture=self.other_picture,
+            edited_at=timezone.now() - datetime.timedelta(days=365),
+            created_at=timezone.now() - datetime.timedelta(days=365))
+        self.messages = [
+            models.Message.objects.create(dialogue=self.dialogue, from_user=self.user, picture=self.picture),
+            models.Message.objects.create(dialogue=self.dialogue, from_user=self.partner, picture=self.picture),
+            models.Message.objects.create(dialogue=self.dialogue, from_user=self.user),
+        ]
+
+    def get_export(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        return zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+
+    def test_export_contains_manifest_and_deduplicated_pictures(self):
+        export = self.get_export()
+        self.assertEqual(sorted(export.namelist()), sorted([
+            'manifest.json', f'pictures/{self.picture.uuid}.jpg', f'pictures/{self.other_picture.uuid}.jpg',
+        ]))
+        self.assertEqual(export.read(f'pictures/{self.picture.uuid}.jpg'), b'first')
+        self.assertEqual(export.read(f'pictures/{self.other_picture.uuid}.jpg'), b'second')
+
+        manifest = json.loads(export.read('manifest.json'))
+        self.assertEqual([user['username'] for user in manifest['dialogue']['users']], ['owner', 'partner'])
+        self.assertEqual([message['id'] for message in manifest['messages']],
+                         [self.archived.id] + [message.id for message in self.messages])
+        self.assertEqual(manifest['messages'][0]['picture'], f'pictures/{self.other_picture.uuid}.jpg')
+        self.assertEqual(manifest['messages'][0]['from_user'], 'partner')
+        self.assertIsNone(manifest['messages'][-1]['picture'])
+
+    def test_only_members_and_staff_can_export(self):
+        outsider = create_user('outsider')
+        self.client.force_authenticate(outsider)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+        outsider.is_staff = True
+        outsider.save()
+        self.assertEqual(len(json.loads(self.get_export().read('manifest.json'))['messages']), 4)
+
+
+class AsgiApplicationTest(APITransactionTestCase):
+    # Views run in a thread of the ASGI handler, which does not see uncommitted test transactions
+
+    def setUp(self):
+        cache.clear()
+        self.user = create_user('owner')
+        self.dialogue = models.Dialogue.objects.create()
+        self.dialogue.users.set((self.user,))
+        models.Message.objects.bulk_create([
+            models.Message(dialogue=self.dialogue, from_user=self.user, picture=create_picture(str(index).encode()))
+            for index in range(export.CHUNK_SIZE + 1)
+        ])
+
+    async def get(self, path, token):
+        communicator = ApplicationCommunicator(application, {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+            'path': path, 'raw_path': path.encode(), 'query_string': b'', 'root_path': '',
+            'headers': [(b'host', b'testserver'), (b'authorization', f'Bearer {token}'.encode())],
+            'client': ('127.0.0.1', 0), 'server': ('testserver', 80),
+        })
+        await communicator.send_input({'type': 'http.request', 'body': b''})
+        start = await communicator.receive_output(5)
+        self.assertEqual(start['status'], 200)
+
+        body = []
+        while True:
+            message = await communicator.receive_output(5)
+            body.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        await communicator.wait()
+        return b''.join(body)
+
+    @override_settings(METRICS_TOKEN='metrics-token')
+    async def test_sync_view_queries_are_recorded_in_metrics(self):
+        labels = '{view="MessagesByDialogueView",method="GET"}'
+        await self.get(f'/api/v1/dialogue/{self.dialogue.pk}/messages/', AccessToken.for_user(self.user))
+        metrics_text = (await self.get('/api/v1/metrics/', 'metrics-token')).decode()
+        self.assertRegex(metrics_text, rf'messenger_request_sql_queries_sum{re.escape(labels)} [1-9]')
+
+    async def test_export_streams_through_asgi_application(self):
+        body = await self.get(f'/api/v1/dialogue/{self.dialogue.pk}/export/', AccessToken.for_user(self.user))
+
+        archive = zipfile.ZipFile(io.BytesIO(body))
+        self.assertEqual(len(json.loads(archive.read('manifest.json'))['messages']), export.CHUNK_SIZE + 1)
+        self.assertEqual(len(archive.namelist()), export.CHUNK_SIZE + 2)
@@ -1,10 +1,21 @@
+from django.conf import settings
 from django.urls import path
 
+import messenger.async_views
 import messenger.views
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 
+
+def read_view(view_class):
+    # With ASYNC_VIEWS read endpoints are served by their async variants
+    if settings.ASYNC_VIEWS:
+        view_class = getattr(messenger.async_views, f'Async{view_class.__name__}')
+    return view_class.as_view()
+
+
 urlpatterns = [
     path('hello/', messenger.views.HelloView.as_view()),
+    path('metrics/', messenger.views.MetricsView.as_view()),
 
     path('auth/session/login/', messenger.views.SessionLoginView.as_view()),
     path('auth/session/logout/', messenger.views.SessionLogoutView.as_view()),
@@ -12,14 +23,20 @@ urlpatterns = [
     path('auth/token/refresh/', TokenRefreshView.as_view()),
     path('auth/register/', messenger.views.RegisterView.as_view()),
 
-    path('dialogue/my/', messenger.views.MyDialoguesView.as_view()),
-    path('dialogue/<int:pk>/messages/', messenger.views.MessagesByDialogueView.as_view()),
+    path('dialogue/my/', read_view(messenger.views.MyDialoguesView)),
+    path('dialogue/<int:pk>/messages/', read_view(messenger.views.MessagesByDialogueView)),
     path('dialogue/<int:pk>/messages/send/', messenger.views.SendDialogueMessageView.as_view()),
-    path('picture/<uuid>/', messenger.views.PictureView.as_view(), name='picture'),
+    path('dialogue/<int:pk>/messages/send/batch/', messenger.views.SendDialogueMessageBatchView.as_view()),
+    path('dialogue/<int:pk>/read/', messenger.views.MarkDialogueReadView.as_view()),
+    path('dialogue/<int:pk>/export/', messenger.views.DialogueExportView.as_view()),
+    path('picture/<uuid:uuid>/', read_view(messenger.views.PictureView), name='picture'),
     path('dialogue/create/', messenger.views.CreateDialogueView.as_view()),
 
+    path('events/poll/', read_view(messenger.views.EventsPollView)),
+
     path('user/my/', messenger.views.MyUserView.as_view()),
     path('user/find/<username>/', messenger.views.UserView.as_view()),
-    path('user/suggest/', messenger.views.UserSuggestView.as_view()),
+    path('user/lookup/', messenger.views.BulkUserLookupView.as_view()),
+    path('user/suggest/', read_view(messenger.views.UserSuggestView)),
     path('user/avatar/', messenger.views.SetUserAvatarView.as_view()),
 ]
@@ -1,17 +1,26 @@
-import datetime
+import logging
+import time
 
+from django.conf import settings
 from django.contrib.auth import authenticate, login, logout, get_user
 from django.contrib.auth.models import User
 from django.db import transaction
-from django.db.models import Value, Q, When, Case
-from django.db.models.functions import StrIndex, Least
-from django.http import HttpResponse
+from django.db.models import OuterRef, Subquery, Q
+from django.db.models.functions import Coalesce
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from django.utils.cache import get_conditional_response
+from rest_framework.exceptions import ParseError
 from rest_framework.generics import ListAPIView, RetrieveAPIView, get_object_or_404, CreateAPIView
-from rest_framework.parsers import MultiPartParser
+from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from messenger import serializers, pagination, models
+from messenger import serializers, pagination, models, responses, storage, events, search, read_states, metrics, \
+    representations, replicas, archive, export, parsers
+
+logger = logging.getLogger(__name__)
 
 
 def create_string_response(response, status=200):
@@ -22,6 +31,14 @@ def create_validation_error_response(errors, status=400):
     return Response(errors, status=status)
 
 
+def log_upload_timings(serializer, db_time):
+    for name, seconds in serializer.timings.items():
+        metrics.add_stage_time(f'image_{name}', seconds)
+    logger.info('Picture upload timings: decode %.1f ms, encode %.1f ms, db %.1f ms',
+                serializer.timings.get('decode', 0) * 1000, serializer.timings.get('encode', 0) * 1000,
+                db_time * 1000)
+
+
 class HelloView(APIView):
     def get(self, request):
         return create_string_response("Hello world!")
@@ -73,31 +90,113 @@ class SessionLogoutView(APIView):
         return create_string_response("Success")
 
 
-class MyDialoguesView(ListAPIView):
-    pagination_class = pagination.DefaultPagination
-    serializer_class = serializers.DialogueResponseSerializer
+class MetricsView(APIView):
+    """
+    Prometheus text exposition of ``messenger.metrics``. When ``METRICS_TOKEN`` is set,
+    it has to be passed as ``Authorization: Bearer <token>``, otherwise only staff can read the metrics.
+    """
 
-    def get_queryset(self):
-        return self.request.user.dialogues.all().order_by('-updated_at')
+    def get_authenticators(self):
+        # The metrics token is not a JWT
+        if settings.METRICS_TOKEN:
+            return []
+        return super().get_authenticators()
 
+    def get_permissions(self):
+        if settings.METRICS_TOKEN:
+            return []
+        return [IsAdminUser()]
 
-class MessagesByDialogueView(ListAPIView):
-    pagination_class = pagination.DefaultPagination
+    def get(self, request):
+        if settings.METRICS_TOKEN:
+            header = request.META.get('HTTP_AUTHORIZATION', '')
+            if not constant_time_compare(header, f'Bearer {settings.METRICS_TOKEN}'):
+                return create_string_response("Invalid metrics token", 403)
+        return HttpResponse(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class MyDialoguesView(replicas.ReplicaReadsMixin, ListAPIView):
+    """
+    Rows are built by ``representations.Builder``, which mirrors ``DialogueResponseSerializer``.
+    """
+    pagination_class = pagination.DialoguePagination
+    serializer_class = serializers.DialogueResponseSerializer
+
+    def get_queryset(self):
+        read_state = models.DialogueReadState.objects.filter(dialogue=OuterRef('pk'), user=self.request.user)
+        return self.request.user.dialogues \
+            .annotate(unread_count=Coalesce(Subquery(read_state.values('unread_count')[:1]), 0),
+                      last_read_message=Subquery(read_state.values('last_read_message')[:1])) \
+            .values(*representations.DIALOGUE_FIELDS) \
+            .order_by('-updated_at')
+
+    def list(self, request, *args, **kwargs):
+        fields = representations.get_requested_fields(request, representations.DIALOGUE_SCHEMA)
+        page = self.paginate_queryset(self.get_queryset())
+        with metrics.stage('serialize'):
+            data = representations.Builder(request).build_dialogues(page, fields)
+        return self.get_paginated_response(data)
+
+
+class MessagesByDialogueView(replicas.ReplicaReadsMixin, ListAPIView):
+    """
+    Rows are built by ``representations.Builder``, which mirrors ``MessageResponseSerializer``.
+    Archived messages are paged together with hot ones, see ``archive.MessageHistory``.
+    """
+    pagination_class = pagination.MessagePagination
     serializer_class = serializers.MessageResponseSerializer
 
     def get_queryset(self):
         pk = self.kwargs['pk']
-        return models.Message.objects \
-            .filter(dialogue__pk=pk, dialogue__users=self.request.user) \
-            .order_by('-created_at')
+        hot = models.Message.objects.filter(dialogue__pk=pk, dialogue__users=self.request.user)
+        archived = models.ArchivedMessage.objects.filter(dialogue__pk=pk, dialogue__users=self.request.user)
+        return archive.MessageHistory(hot, archived, representations.MESSAGE_FIELDS).order_by('-created_at', '-id')
+
+    def list(self, request, *args, **kwargs):
+        fields = representations.get_requested_fields(request, representations.MESSAGE_SCHEMA)
+        page = self.paginate_queryset(self.get_queryset())
+        with metrics.stage('serialize'):
+            data = representations.Builder(request).build_messages(page, fields)
+        return self.get_paginated_response(data)
 
 
-class PictureView(APIView):
+class DialogueExportView(APIView):
+    """
+    Streams the dialogue with its pictures as a ZIP archive, see ``export``. Staff can export any dialogue.
+    """
+
+    def get(self, request, pk):
+        dialogues = models.Dialogue.objects.all() if request.user.is_staff else request.user.dialogues.all()
+        dialogue = get_object_or_404(dialogues, pk=pk)
+        response = StreamingHttpResponse(export.generate_export(dialogue), content_type='application/zip')
+        response['Content-Disposition'] = f'attachment; filename="dialogue-{dialogue.pk}.zip"'
+        return response
+
+
+class PictureView(replicas.ReplicaReadsMixin, APIView):
     permission_classes = []
 
     def get(self, request, uuid):
-        image = get_object_or_404(models.PictureV2.objects, uuid=uuid)
-        return HttpResponse(image.data, content_type='image/jpeg')
+        size = request.query_params.get('size')
+        picture = None
+        if size is not None:
+            if not size.isdigit() or int(size) not in settings.PICTURE_RENDITION_SIZES:
+                return create_string_response(f"Unknown size {size}", 400)
+            rendition = models.PictureRendition.objects \
+                .filter(original__uuid=uuid, size=int(size)) \
+                .select_related('picture') \
+                .defer('picture__data') \
+                .first()
+            # Renditions are not generated for sizes above the original one
+            picture = rendition.picture if rendition is not None else None
+        if picture is None:
+            picture = get_object_or_404(models.PictureV2.objects.defer('data'), uuid=uuid)
+        etag = f'"{picture.sha256}"'
+
+        response = get_conditional_response(request, etag=etag, last_modified=int(picture.created_at.timestamp()))
+        if response is None:
+            response = storage.get_storage(picture.storage).create_response(request, picture, 'image/jpeg', etag)
+        return responses.set_immutable_cache_headers(response, etag, picture.created_at)
 
 
 class MyUserView(RetrieveAPIView):
@@ -109,14 +208,59 @@ class MyUserView(RetrieveAPIView):
 
 class UserView(RetrieveAPIView):
     serializer_class = serializers.UserResponseSerializer
-    queryset = User.objects.all()
+    queryset = User.objects.select_related('info__avatar').defer('info__avatar__data')
     lookup_field = 'username'
 
 
+def save_dialogue_messages(dialogue, user, pictures):
+    """
+    Creates messages with ``pictures`` in ``dialogue`` and updates everything that depends on them.
+    Has to be called in a transaction.
+    """
+    messages = models.Message.objects.bulk_create([
+        models.Message(dialogue=dialogue, from_user=user, picture=picture)
+        for picture in pictures
+    ])
+
+    dialogue.updated_at = timezone.now()
+    dialogue.last_message = messages[-1]
+    dialogue.save(update_fields=['updated_at', 'last_message'])
+
+    user_ids = list(dialogue.users.values_list('id', flat=True))
+    read_states.record_new_messages(dialogue, user, messages[-1], user_ids, count=len(messages))
+    transaction.on_commit(lambda: events.publish_message_events(messages, user_ids))
+    return messages
+
+
+class BulkUserLookupView(APIView):
+    def post(self, request):
+        serializer = serializers.BulkUserLookupSerializer(data=request.data)
+        if not serializer.is_valid():
+            return create_validation_error_response(serializer.errors)
+        usernames = serializer.validated_data['usernames']
+        ids = serializer.validated_data['ids']
+
+        users = list(User.objects
+                     .filter(Q(username__in=usernames) | Q(id__in=ids))
+                     .select_related('info__avatar')
+                     .defer('info__avatar__data'))
+        profiles = serializers.UserResponseSerializer(users, many=True, context={'request': request}).data
+        by_username = {user.username: profile for user, profile in zip(users, profiles)}
+        by_id = {user.id: profile for user, profile in zip(users, profiles)}
+
+        return Response({
+            'usernames': {username: by_username[username] for username in usernames if username in by_username},
+            'ids': {str(user_id): by_id[user_id] for user_id in ids if user_id in by_id},
+            'missing': {
+                'usernames': [username for username in usernames if username not in by_username],
+                'ids': [user_id for user_id in ids if user_id not in by_id],
+            },
+        })
+
+
 class SendDialogueMessageView(APIView):
-    parser_classes = [MultiPartParser]
+    parser_classes = [parsers.PictureUploadParser]
 
-    @transaction.atomic
     def post(self, request, pk):
         dialogue = get_object_or_404(models.Dialogue, pk=pk, users=request.user)
 
@@ -124,74 +268,127 @@ class SendDialogueMessageView(APIView):
         if not serializer.is_valid():
             return create_validation_error_response(serializer.errors)
 
-        picture = serializer.save()
-        message = models.Message(
-            dialogue=dialogue,
-            from_user=request.user,
-            picture=picture,
-        )
-        message.save()
-
-        dialogue.updated_at = datetime.datetime.utcnow()
-        dialogue.save(update_fields=['updated_at'])
+        start = time.perf_counter()
+        with transaction.atomic():
+            save_dialogue_messages(dialogue, request.user, [serializer.save()])
+        log_upload_timings(serializer, time.perf_counter() - start)
 
         return create_string_response("Ok")
 
 
+class SendDialogueMessageBatchView(APIView):
+    parser_classes = [parsers.PictureBatchUploadParser]
+
+    def post(self, request, pk):
+        dialogue = get_object_or_404(models.Dialogue, pk=pk, users=request.user)
+
+        serializer = serializers.PictureBatchSerializer(data=request.data)
+        if not serializer.is_valid():
+            return create_validation_error_response(serializer.errors)
+
+        valid_items = [item for item in serializer.items if item.errors is None]
+        if not valid_items:
+            return create_validation_error_response({
+                'results': [{'index': index, 'errors': item.errors} for index, item in enumerate(serializer.items)],
+            })
+
+        with transaction.atomic():
+            messages = iter(save_dialogue_messages(dialogue, request.user, [item.save() for item in valid_items]))
+
+        results = []
+        for index, item in enumerate(serializer.items):
+            if item.errors is None:
+                results.append({'index': index, 'message': next(messages).id})
+            else:
+                results.append({'index': index, 'errors': item.errors})
+        return Response({'results': results})
+
+
+class MarkDialogueReadView(APIView):
+    def post(self, request, pk):
+        dialogue = get_object_or_404(models.Dialogue, pk=pk, users=request.user)
+
+        serializer = serializers.MarkReadSerializer(data=request.data)
+        if not serializer.is_valid():
+            return create_validation_error_response(serializer.errors)
+
+        message_id = serializer.validated_data.get('message')
+        if message_id is not None:
+            message = read_states.get_read_marker(dialogue, message_id)
+            if message is None:
+                raise Http404()
+        else:
+            message = dialogue.messages.order_by('-created_at', '-id').first()
+        if message is None:
+            return Response({'last_read_message': None, 'unread_count': 0})
+
+        with transaction.atomic():
+            read_state = read_states.mark_read(request.user, dialogue, message)
+            transaction.on_commit(lambda: events.publish_read_event(read_state))
+
+        return Response({
+            'last_read_message': read_state.last_read_message_id,
+            'unread_count': read_state.unread_count,
+        })
+
+
+class EventsPollView(APIView):
+    """
+    Long-poll fallback for the events WebSocket: waits for events after ``since``
+    and returns them along with the cursor for the next request.
+    This sync view holds a worker while it waits, so it only waits ``EVENTS_SYNC_POLL_TIMEOUT_SECONDS``.
+    The async view long polls for ``EVENTS_LONG_POLL_TIMEOUT_SECONDS``.
+    """
+
+    def get_since(self, request):
+        since = request.query_params.get('since')
+        if since is not None and not since.isdigit():
+            raise ParseError(f"Invalid cursor {since}")
+        return int(since) if since is not None else None
+
+    def create_response(self, pending, cursor):
+        return Response({'events': pending, 'cursor': cursor})
+
+    def handle_exception(self, exc):
+        # Shared with the async view, which can't return a response from get_since
+        if isinstance(exc, ParseError):
+            return create_string_response(str(exc.detail), 400)
+        return super().handle_exception(exc)
+
+    def get(self, request):
+        pending, cursor = events.get_broker().wait(request.user.id, self.get_since(request),
+                                                   settings.EVENTS_SYNC_POLL_TIMEOUT_SECONDS)
+        return self.create_response(pending, cursor)
+
+
 class CreateDialogueView(CreateAPIView):
     serializer_class = serializers.PairDialogueCreateSerializer
 
 
-class UserSuggestView(ListAPIView):
+class UserSuggestView(replicas.ReplicaReadsMixin, ListAPIView):
     pagination_class = pagination.DefaultPagination
     serializer_class = serializers.UserResponseSerializer
 
     def get_queryset(self):
         name_substring = self.request.query_params.get('name_substring', '').strip()
-
-        fields = [
-            ('username', name_substring, 'default'),
-            ('first_name', name_substring, 'default'),
-            ('last_name', name_substring, 'default'),
-        ]
-        if ' ' in name_substring:
-            fields.append(('first_name', name_substring[:name_substring.index(' ')].strip(), 'space'))
-            fields.append(('last_name', name_substring[name_substring.index(' '):].strip(), 'space'))
-
-        str_index_expressions = {}
-        search_index_expressions = []
-        for field_name, substring, meta_description in fields:
-            index_expression = StrIndex(field_name, Value(substring))
-            str_index_expression_name = f'{field_name}_{meta_description}'
-            str_index_expressions[str_index_expression_name] = index_expression
-            expression = Case(When(**{str_index_expression_name: 0}, then=10 ** 9), default=str_index_expression_name)
-            search_index_expressions.append(expression)
-
-        query_condition = (Q(username__icontains=name_substring) |
-                           Q(first_name__icontains=name_substring) |
-                           Q(last_name__icontains=name_substring))
-        if ' ' in name_substring:
-            query_condition = (query_condition |
-                               Q(first_name__icontains=name_substring[:name_substring.index(' ')].strip()) &
-                               Q(last_name__icontains=name_substring[name_substring.index(' '):].strip()))
-
-        return User.objects.filter(query_condition) \
-            .annotate(**str_index_expressions) \
-            .annotate(search_index=Least(*search_index_expressions)) \
-            .order_by('search_index', 'username')
+        return search.suggest_users(name_substring) \
+            .select_related('info__avatar') \
+            .defer('info__avatar__data')
 
 
 class SetUserAvatarView(APIView):
-    parser_classes = [MultiPartParser]
+    parser_classes = [parsers.PictureUploadParser]
 
-    @transaction.atomic
     def post(self, request):
         serializer = serializers.PictureSerializer(data=request.data)
         if not serializer.is_valid():
             return create_validation_error_response(serializer.errors)
 
-        picture = serializer.save()
-        request.user.info.avatar = picture
-        request.user.info.save(update_fields=['avatar'])
+        start = time.perf_counter()
+        with transaction.atomic():
+            picture = serializer.save()
+            request.user.info.avatar = picture
+            request.user.info.save(update_fields=['avatar'])
+        log_upload_timings(serializer, time.perf_counter() - start)
 
         return create_string_response("Ok")
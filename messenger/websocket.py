@@ -0,0 +1,106 @@
+import asyncio
+import json
+from http.cookies import SimpleCookie
+from importlib import import_module
+from urllib.parse import parse_qs, urlparse
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib import auth
+from django.http import HttpRequest
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.exceptions import TokenError, InvalidToken
+
+from messenger import events
+from messenger.authentication import CachedJWTAuthentication
+
+EVENTS_PATH = '/api/v1/events/ws/'
+UNAUTHORIZED_CLOSE_CODE = 4401
+
+
+def get_header(scope, name):
+    for key, value in scope.get('headers', ()):
+        if key.decode('latin1').lower() == name:
+            return value.decode('latin1')
+    return None
+
+
+def is_allowed_origin(scope):
+    origin = get_header(scope, 'origin')
+    if origin is None:
+        return True
+    host = get_header(scope, 'host')
+    return urlparse(origin).netloc == host or origin in settings.CORS_ALLOWED_ORIGINS
+
+
+def authenticate_scope(scope):
+    """
+    Authenticates with a JWT access token from ``?token=`` or with the session cookie.
+    Session authentication requires a same-site or CORS-allowed origin to prevent cross-site hijacking.
+    """
+    token = parse_qs(scope.get('query_string', b'').decode('latin1')).get('token')
+    if token:
+        authentication = CachedJWTAuthentication()
+        try:
+            user = authentication.get_user(authentication.get_validated_token(token[0]))
+        except (AuthenticationFailed, InvalidToken, TokenError):
+            return None
+        return user if user.is_active else None
+
+    if not is_allowed_origin(scope):
+        return None
+    cookies = SimpleCookie(get_header(scope, 'cookie') or '')
+    if settings.SESSION_COOKIE_NAME not in cookies:
+        return None
+    request = HttpRequest()
+    request.session = import_module(settings.SESSION_ENGINE).SessionStore(cookies[settings.SESSION_COOKIE_NAME].value)
+    user = auth.get_user(request)
+    return user if user.is_authenticated else None
+
+
+async def events_websocket(scope, receive, send):
+    """
+    Streams broker events of the authenticated user as JSON text frames. Messages from the client are ignored.
+    ``?since=<cursor>`` resumes after the given cursor, otherwise events published after the handshake are sent.
+    """
+    message = await receive()
+    if message['type'] != 'websocket.connect':
+        return
+
+    user = await sync_to_async(authenticate_scope)(scope)
+    if user is None:
+        await send({'type': 'websocket.close', 'code': UNAUTHORIZED_CLOSE_CODE})
+        return
+
+    broker = events.get_broker()
+    since = parse_qs(scope.get('query_string', b'').decode('latin1')).get('since')
+    if since and since[0].isdigit():
+        cursor = int(since[0])
+    else:
+        cursor = await sync_to_async(broker.get_cursor, thread_sensitive=False)()
+    await send({'type': 'websocket.accept'})
+
+    receive_task = asyncio.ensure_future(receive())
+    wait_task = asyncio.ensure_future(broker.wait_async(user.id, cursor, settings.EVENTS_LONG_POLL_TIMEOUT_SECONDS))
+    try:
+        while True:
+            done, _ = await asyncio.wait({receive_task, wait_task}, return_when=asyncio.FIRST_COMPLETED)
+            if receive_task in done:
+                if receive_task.result()['type'] == 'websocket.disconnect':
+                    return
+                receive_task = asyncio.ensure_future(receive())
+            if wait_task in done:
+                pending, cursor = wait_task.result()
+                for event in pending:
+                    await send({'type': 'websocket.send', 'text': json.dumps(event)})
+                wait_task = asyncio.ensure_future(
+                    broker.wait_async(user.id, cursor, settings.EVENTS_LONG_POLL_TIMEOUT_SECONDS))
+    finally:
+        receive_task.cancel()
+        wait_task.cancel()
+
+
+async def reject_websocket(scope, receive, send):
+    message = await receive()
+    if message['type'] == 'websocket.connect':
+        await send({'type': 'websocket.close'})